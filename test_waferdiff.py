@@ -0,0 +1,80 @@
+"""Diffs list exactly the edited values, and merges combine both sides' edits"""
+
+import pytest
+
+from wafercore import Wafer
+from waferdiff import WaferDiff, mergeWafers, checkShapes
+from wafertesting import syntheticWafer, randomEdits, assertSameWafer
+
+def records(a, b):
+    return dict(((kind, index, field), (old, new)) for kind, index, field, old, new in WaferDiff(a, b).records())
+
+def applyRecords(wafer, diff):
+    for kind, index, field, old, new in diff.records():
+        wafer.setField(kind, index, field, new)
+
+def test_diff_lists_exactly_the_edits():
+    a = syntheticWafer(3, 4, 3, 3)
+    b = a.copy()
+    edited = {}
+    def record(change):
+        if change.kind == "samples":
+            for n in range(len(change.new)):
+                edited[("sample", tuple(int(x[n]) for x in change.index), change.field)] = change.new[n]
+        else:
+            edited[(change.kind, change.index, change.field)] = change.new
+    b.addListener(record)
+    randomEdits(b, 0, 100)
+    expected = {}
+    for (kind, index, field), new in edited.items():
+        old = a.getField(kind, index, field)
+        if old != new:
+            expected[(kind, index, field)] = (old, new)
+    diff = WaferDiff(a, b)
+    assert records(a, b) == expected
+    assert len(diff) == len(expected)
+    samples = set(index for kind, index, field in expected if kind == "sample")
+    assert set(zip(*[n.tolist() for n in diff.mask().nonzero()])) == samples
+
+def test_applying_the_diff_gives_the_other_wafer():
+    a = syntheticWafer(3, 4, 3, 3)
+    b = a.copy()
+    randomEdits(b, 1, 100)
+    applyRecords(a, WaferDiff(a, b))
+    assert len(WaferDiff(a, b)) == 0
+    assertSameWafer(a, b)
+
+def test_merge_takes_both_sides():
+    base = syntheticWafer(3, 4, 3, 3)
+    ours, theirs = base.copy(), base.copy()
+    ours.setField("sample", (0, 0, 0, 0), "thick", 1.0)
+    ours.setField("die", (1, 1), "notes", "ours")
+    theirs.setField("sample", (3, 2, 2, 2), "thick", 2.0)
+    theirs.setField("sample", (3, 2, 2, 2), "notes", "theirs")
+    theirs.setField("wafer", (), "notes", "theirs")
+    merged, conflicts = mergeWafers(base, ours, theirs)
+    assert conflicts == []
+    expected = ours.copy()
+    applyRecords(expected, WaferDiff(base, theirs))
+    assertSameWafer(merged, expected)
+
+def test_merge_keeps_ours_and_marks_conflicts():
+    base = syntheticWafer(3, 4, 3, 3)
+    ours, theirs = base.copy(), base.copy()
+    ours.setField("sample", (1, 2, 0, 1), "thick", 1.0)
+    theirs.setField("sample", (1, 2, 0, 1), "thick", 2.0)
+    ours.setField("die", (0, 1), "notes", "ours")
+    theirs.setField("die", (0, 1), "notes", "theirs")
+    # The same change on both sides is no conflict
+    ours.setField("sample", (0, 0, 0, 0), "sizeY", 0.7)
+    theirs.setField("sample", (0, 0, 0, 0), "sizeY", 0.7)
+    merged, conflicts = mergeWafers(base, ours, theirs)
+    assert sorted((c.kind, c.field) for c in conflicts) == [("die", "notes"), ("sample", "thick")]
+    assert merged.sampleThick[1, 2, 0, 1] == 1.0
+    assert merged.sampleSizeY[0, 0, 0, 0] == 0.7
+    assert "theirs 2.0" in merged.sampleNotes[(1, 2, 0, 1)]
+    assert merged.dieNotes[(0, 1)] == "<<<<<<< ours\nours\n=======\ntheirs\n>>>>>>> theirs"
+
+def test_different_layouts_are_refused():
+    with pytest.raises(ValueError):
+        checkShapes(Wafer("a", 2, 2, 2, 2), Wafer("b", 2, 2, 2, 3))
@@ -0,0 +1,79 @@
+"""Measurement tables land on the devices they name, and bad rows are reported"""
+
+import io
+
+import numpy as np
+import pytest
+
+from wafercore import Wafer
+from waferimport import importMeasurements, MeasurementReader
+from wafertesting import syntheticWafer
+
+def writeTable(tmp_path, text, name="m.csv"):
+    filename = str(tmp_path / name)
+    with io.open(filename, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    return filename
+
+def test_rows_by_die_and_device(tmp_path):
+    wafer = Wafer("W1", 3, 4, 2, 3)
+    filename = writeTable(tmp_path, u"Die,Device,Thickness,Status,Notes\n"
+                                    u"Q1,A1,9.5,alive,\n"
+                                    u"S3,C2,8.25,2,\"cracked, remeasure\"\n"
+                                    u"Q1,A1,9.75,,\n")
+    report = importMeasurements(wafer, filename)
+    assert (report.rows, report.matched, report.failed) == (3, 3, 0)
+    assert wafer.sampleThick[0, 0, 0, 0] == 9.75 # The last row naming a device wins
+    assert wafer.sampleStatus[0, 0, 0, 0] == 1
+    assert (wafer.sampleThick[2, 2, 2, 1], wafer.sampleStatus[2, 2, 2, 1]) == (8.25, 2)
+    assert wafer.sampleNotes == {(2, 2, 2, 1): u"cracked, remeasure"}
+
+def test_full_names_in_either_order(tmp_path):
+    wafer = Wafer("W1", 3, 4, 2, 3)
+    filename = writeTable(tmp_path, u"name\tthick\nQ1-B2\t1.0\nA1 R2\t2.0\nQ1B2X\t3.0\n", "m.tsv")
+    report = importMeasurements(wafer, filename)
+    assert wafer.sampleThick[0, 0, 1, 1] == 1.0
+    assert wafer.sampleThick[1, 1, 0, 0] == 2.0
+    assert report.failures == [(4, "no device Q1B2X")]
+
+def test_rows_by_stage_position(tmp_path):
+    wafer = syntheticWafer(3, 3, 2, 2)
+    X, Y = wafer.getAllSampleCoords()
+    lines = [u"x,y,thick"] + [u"%r,%r,%d" % (float(X[index]) + 0.01, float(Y[index]) - 0.01, n)
+                             for n, index in enumerate([(0, 0, 0, 0), (2, 1, 1, 0)])]
+    lines.append(u"1000,1000,7")
+    report = importMeasurements(wafer, writeTable(tmp_path, u"\n".join(lines)))
+    assert wafer.sampleThick[0, 0, 0, 0] == 0 and wafer.sampleThick[2, 1, 1, 0] == 1
+    assert report.matched == 2 and report.failures == [(4, "no device at 1000, 1000")]
+
+def test_other_wafers_and_bad_values_are_skipped(tmp_path):
+    wafer = Wafer("W1", 2, 2, 2, 2)
+    before = wafer.sampleThick.copy()
+    filename = writeTable(tmp_path, u"wafer,die,device,thick,status\n"
+                                    u"W2,Q1,A1,5,\n"
+                                    u"W1,Q1,A1,thin,\n"
+                                    u"W1,Q1,A1,,broken\n"
+                                    u"W1,ZZ,A1,5,\n"
+                                    u",Q1,B2,6,\n")
+    report = importMeasurements(wafer, filename)
+    assert (report.rows, report.matched, report.skipped, report.failed) == (5, 1, 1, 3)
+    assert report.describe() == "5 rows, 1 matched, 3 unmatched, 1 for other wafers"
+    before[0, 0, 1, 1] = 6
+    assert np.array_equal(wafer.sampleThick, before)
+
+def test_batches_hold_distinct_devices(tmp_path):
+    wafer = Wafer("W1", 2, 2, 2, 2)
+    lines = [u"die,device,thick"] + [u"Q1,A1,%d" % n for n in range(25)]
+    reader = MeasurementReader(wafer, writeTable(tmp_path, u"\n".join(lines)), batchSize=10)
+    fractions = []
+    batches = list(reader.batches(fractions.append))
+    assert [len(index[0]) for field, index, values in batches] == [1, 1, 1]
+    assert [list(values) for field, index, values in batches] == [[9], [19], [24]]
+    assert fractions[-1] == 1.0
+
+def test_header_without_measurements_is_refused(tmp_path):
+    wafer = Wafer("W1", 2, 2, 2, 2)
+    with pytest.raises(ValueError):
+        importMeasurements(wafer, writeTable(tmp_path, u"die,device\nQ1,A1\n"))
+    with pytest.raises(ValueError):
+        importMeasurements(wafer, writeTable(tmp_path, u"thick,notes\n1,a\n"))
@@ -0,0 +1,83 @@
+"""Both file formats read back exactly what was written"""
+
+import os
+
+import numpy as np
+import pytest
+
+from waferio import readWafer, writeWafer, convertWafer, readWaferBinary, Cancelled
+from wafertesting import syntheticWafer, randomEdits, assertSameWafer
+
+def editedWafer():
+    wafer = syntheticWafer(3, 4, 3, 2)
+    randomEdits(wafer, 0, 100)
+    wafer.setField("wafer", (), "notes", u"Lot 7 <\u00b5m> & \"quoted\"")
+    wafer.setField("die", (1, 2), "notes", u"crack\nacross two lines")
+    wafer.setField("sample", (0, 1, 1, 2), "notes", u"r\u00e9measured")
+    wafer.wedgeMx, wafer.wedgeMy, wafer.wedgeC = 0.1, -0.2, 9.5
+    return wafer
+
+def test_round_trip(tmp_path):
+    wafer = editedWafer()
+    for extension in (".xml", ".wfb"):
+        filename = str(tmp_path / ("w" + extension))
+        writeWafer(wafer, filename)
+        assertSameWafer(readWafer(filename), wafer)
+
+def test_conversion_keeps_every_field(tmp_path):
+    wafer = editedWafer()
+    xml, binary, back = [str(tmp_path / name) for name in ("w.xml", "w.wfb", "back.xml")]
+    writeWafer(wafer, xml)
+    convertWafer(xml, binary)
+    convertWafer(binary, back)
+    assertSameWafer(readWafer(back), wafer)
+
+def test_progress_reaches_the_end(tmp_path):
+    wafer = editedWafer()
+    for extension in (".xml", ".wfb"):
+        filename = str(tmp_path / ("w" + extension))
+        written, read = [], []
+        writeWafer(wafer, filename, written.append)
+        readWafer(filename, read.append)
+        for fractions in (written, read):
+            assert fractions == sorted(fractions) and fractions[-1] == 1.0
+
+def test_cancelled_write_keeps_the_old_file(tmp_path):
+    old, new = syntheticWafer(2, 2, 2, 2, seed=1), editedWafer()
+    for extension in (".xml", ".wfb"):
+        filename = str(tmp_path / ("w" + extension))
+        writeWafer(old, filename)
+        def cancel(fraction):
+            raise Cancelled()
+        with pytest.raises(Cancelled):
+            writeWafer(new, filename, cancel)
+        assertSameWafer(readWafer(filename), old)
+        assert os.listdir(str(tmp_path)) == [os.path.basename(filename)]
+        os.remove(filename)
+
+def test_binary_notes_load_on_first_use(tmp_path):
+    wafer = editedWafer()
+    filename = str(tmp_path / "w.wfb")
+    writeWafer(wafer, filename)
+    opened = readWaferBinary(filename)
+    assert opened._notesLoader is not None
+    assert np.array_equal(opened.sampleThick, wafer.sampleThick)
+    assert opened._notesLoader is not None
+    assert opened.sampleNotes == wafer.sampleNotes
+    assert opened._notesLoader is None
+    assert opened.dieNotes == wafer.dieNotes
+
+def test_binary_edits_stay_in_memory(tmp_path):
+    wafer = editedWafer()
+    filename = str(tmp_path / "w.wfb")
+    writeWafer(wafer, filename)
+    opened = readWafer(filename)
+    opened.setField("sample", (0, 0, 0, 0), "thick", 1.5)
+    assertSameWafer(readWafer(filename), wafer)
+
+def test_other_files_are_refused(tmp_path):
+    filename = str(tmp_path / "w.wfb")
+    with open(filename, "wb") as f:
+        f.write(b"<?xml version='1.0'?><wafer/>")
+    with pytest.raises(ValueError):
+        readWaferBinary(filename)
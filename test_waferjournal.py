@@ -0,0 +1,95 @@
+"""Replaying a journal over the saved file gives back the edited wafer"""
+
+import os
+
+from waferio import readWafer, writeWafer, Cancelled
+from waferjournal import Journal, replayJournal, hasJournal, journalFiles, COMPACTING_SUFFIX
+from wafertesting import syntheticWafer, randomEdits, assertSameWafer
+
+def journaledWafer(tmp_path, extension=".wfb"):
+    filename = str(tmp_path / ("w" + extension))
+    wafer = syntheticWafer(3, 4, 3, 2)
+    writeWafer(wafer, filename)
+    journal = Journal(wafer, filename)
+    journal.attach()
+    return wafer, filename, journal
+
+def failSnapshot(journal):
+    def cancel(fraction):
+        raise Cancelled()
+    try:
+        journal.writeSnapshot(journal.beginSnapshot(), cancel)
+    except Cancelled:
+        pass
+
+def test_replay_restores_edits(tmp_path):
+    for extension in (".wfb", ".xml"):
+        wafer, filename, journal = journaledWafer(tmp_path, extension)
+        randomEdits(wafer, 1, 200)
+        journal.detach()
+        recovered = readWafer(filename)
+        assert replayJournal(recovered, filename) == journal.records
+        assertSameWafer(recovered, wafer)
+
+def test_replay_is_idempotent(tmp_path):
+    wafer, filename, journal = journaledWafer(tmp_path)
+    randomEdits(wafer, 2, 200)
+    journal.detach()
+    recovered = readWafer(filename)
+    replayJournal(recovered, filename)
+    replayJournal(recovered, filename)
+    assertSameWafer(recovered, wafer)
+
+def test_torn_record_is_skipped(tmp_path):
+    wafer, filename, journal = journaledWafer(tmp_path)
+    randomEdits(wafer, 3, 20)
+    journal.detach()
+    with open(journal.path, "ab") as f:
+        f.write(b'["s",[0,0,0,0],"thick",5')
+    recovered = readWafer(filename)
+    assert replayJournal(recovered, filename) == journal.records
+    assertSameWafer(recovered, wafer)
+
+def test_snapshot_keeps_edits_made_while_writing(tmp_path):
+    wafer, filename, journal = journaledWafer(tmp_path)
+    randomEdits(wafer, 4, 50)
+    snapshot = journal.beginSnapshot()
+    randomEdits(wafer, 5, 50)
+    journal.writeSnapshot(snapshot)
+    journal.detach()
+    assert not os.path.exists(filename + COMPACTING_SUFFIX)
+    saved = readWafer(filename)
+    assertSameWafer(saved, snapshot)
+    replayJournal(saved, filename)
+    assertSameWafer(saved, wafer)
+
+def test_failed_snapshot_leaves_records_for_replay(tmp_path):
+    wafer, filename, journal = journaledWafer(tmp_path)
+    randomEdits(wafer, 6, 50)
+    failSnapshot(journal)
+    randomEdits(wafer, 7, 50)
+    failSnapshot(journal)
+    randomEdits(wafer, 8, 50)
+    journal.detach()
+    recovered = readWafer(filename)
+    replayJournal(recovered, filename)
+    assertSameWafer(recovered, wafer)
+
+def test_detach_leaves_a_compaction_running(tmp_path):
+    wafer, filename, journal = journaledWafer(tmp_path)
+    randomEdits(wafer, 11, 10)
+    snapshot = journal.beginSnapshot()
+    journal.detach()
+    assert journal.compacting() and not journal.wait(0.01)
+    journal.writeSnapshot(snapshot)
+    assert journal.wait(0)
+    assertSameWafer(readWafer(filename), wafer)
+
+def test_discard_removes_journals(tmp_path):
+    wafer, filename, journal = journaledWafer(tmp_path)
+    randomEdits(wafer, 9, 10)
+    failSnapshot(journal)
+    randomEdits(wafer, 10, 10)
+    assert all(os.path.exists(path) for path in journalFiles(filename))
+    journal.discard()
+    assert not hasJournal(filename)
@@ -0,0 +1,70 @@
+"""WaferLayout finds what is under a pixel where the drawing code put it"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cairo")
+pytest.importorskip("gi")
+from waferrender import WaferLayout
+from wafertesting import syntheticWafer
+
+def layoutOf(size=800):
+    return WaferLayout(syntheticWafer(4, 5, 3, 4), size, size)
+
+def test_device_centres_hit_their_device():
+    layout = layoutOf()
+    for index in itertools.product(range(5), range(4), range(4), range(3)):
+        x, y, w, h = layout.sampleRect(*index)
+        assert layout.hit(x + 0.5*w, y + 0.5*h) == index
+
+def test_die_frame_hits_the_die_and_gaps_hit_nothing():
+    layout = layoutOf()
+    for i, j in itertools.product(range(5), range(4)):
+        x, y = layout.toWidget(*layout.dieOrigin(i, j))
+        assert layout.hit(x - 0.5*layout.FRAME, y + 0.5*layout.dieSizeY) == (i, j)
+        assert layout.hit(x + 0.5*layout.sampleMargin, y + 0.5*layout.sampleMargin) == (i, j)
+    assert layout.hit(1, 1) is None
+    x, y = layout.toWidget(*layout.dieOrigin(1, 1))
+    assert layout.hit(x - layout.FRAME - 1, y + 0.5*layout.dieSizeY) is None
+
+def test_hit_matches_the_heatmap_lookup():
+    layout = layoutOf(300)
+    xs = np.arange(0, 300, 0.7)
+    columns, rows = layout.deviceColumns(xs), layout.deviceRows(xs)
+    for x, column in zip(xs[::7], columns[::7]):
+        for y, row in zip(xs[::5], rows[::5]):
+            found = layout.hit(x, y)
+            if column < 0 or row < 0:
+                assert found is None or len(found) == 2
+            else:
+                assert found == (column // 4, row // 3, column % 4, row % 3)
+
+def test_rectangle_selects_the_devices_it_touches():
+    layout = layoutOf()
+    x1, y1, w, h = layout.sampleRect(1, 1, 2, 0)
+    x2, y2, w, h = layout.sampleRect(2, 1, 1, 2)
+    mask = layout.samplesInRect(x2 + w, y2 + h, x1, y1)
+    assert mask[1, 1, 2, 0] and mask[2, 1, 1, 2]
+    assert mask.sum() == 2*2*3
+    assert not layout.samplesInRect(0, 0, 2, 2).any()
+
+def test_labels_are_found_where_they_are_drawn():
+    layout = layoutOf()
+    for i in range(1, 5):
+        x, y = layout.dieOrigin(i, 0)
+        assert layout.hitLabel(*layout.toWidget(x + 0.4*layout.dieSizeX, y - 0.55*layout.dieSizeY)) == ("col", i)
+    for j in range(1, 4):
+        x, y = layout.dieOrigin(0, j)
+        assert layout.hitLabel(*layout.toWidget(x - 0.55*layout.dieSizeX, y + 0.4*layout.dieSizeY)) == ("row", j)
+    for ii in range(4):
+        x, y = layout.sampleOrigin(0, 0, ii, 0)
+        where = layout.toWidget(x + 0.5*layout.sampSizeX, y - 1.1*layout.sampSizeY - 4)
+        assert layout.hitLabel(*where) == ("sampleCol", ii)
+    for jj in range(3):
+        x, y = layout.sampleOrigin(0, 0, 0, jj)
+        where = layout.toWidget(x - 1.1*layout.sampSizeX - 4, y + 0.5*layout.sampSizeY)
+        assert layout.hitLabel(*where) == ("sampleRow", jj)
+    x, y, w, h = layout.sampleRect(2, 2, 1, 1)
+    assert layout.hitLabel(x + 0.5*w, y + 0.5*h) is None
@@ -0,0 +1,54 @@
+"""An index kept up to date from notes edits answers like one rebuilt from scratch"""
+
+from wafersearch import NotesIndex, matchMask, tokenize
+from waferundo import UndoHistory
+from wafertesting import syntheticWafer, randomEdits, NOTES_EDITS
+
+QUERIES = ["remeas", "crack", "re", "probe dust", "CRACKED", "cr re", "nothing", ""]
+
+def assertMatchesRebuild(index, wafer):
+    fresh = NotesIndex(wafer)
+    for query in QUERIES:
+        assert index.search(query) == fresh.search(query), query
+    assert index.postings == fresh.postings
+    assert index.words == sorted(index.postings)
+
+def attachedIndex(wafer):
+    index = NotesIndex(wafer)
+    index.attach()
+    return index
+
+def test_incremental_matches_rebuild():
+    wafer = syntheticWafer(3, 4, 3, 3)
+    index = attachedIndex(wafer)
+    index.search("x") # Sorts the word list, which edits then keep in order
+    for seed in range(8):
+        randomEdits(wafer, seed, 25, NOTES_EDITS)
+        assertMatchesRebuild(index, wafer)
+
+def test_undo_keeps_index_current():
+    wafer = syntheticWafer(3, 4, 3, 3)
+    index = attachedIndex(wafer)
+    history = UndoHistory(wafer)
+    history.attach()
+    randomEdits(wafer, 1, 40, NOTES_EDITS)
+    while history.undo() is not None:
+        pass
+    assertMatchesRebuild(index, wafer)
+
+def test_words_match_as_prefixes():
+    wafer = syntheticWafer(2, 2, 2, 2, noteFraction=0.0)
+    wafer.dieNotes.clear()
+    wafer.setField("sample", (0, 1, 1, 0), "notes", "Remeasured after cleaning")
+    wafer.setField("die", (1, 0), "notes", "cracked corner")
+    index = NotesIndex(wafer)
+    assert index.search("remeas clean") == set([(None, "sample", (0, 1, 1, 0))])
+    assert index.search("remeas crack") == set()
+    keys = index.search("c")
+    assert keys == set([(None, "sample", (0, 1, 1, 0)), (None, "die", (1, 0))])
+    mask = matchMask(keys, wafer.sampleStatus.shape)
+    assert mask.sum() == 1 + wafer.dieCols*wafer.dieRows
+    assert mask[0, 1, 1, 0] and mask[1, 0].all()
+
+def test_tokenize_ignores_case_and_punctuation():
+    assert tokenize("Re-measure, re-MEASURE!") == set(["re", "measure"])
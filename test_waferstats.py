@@ -0,0 +1,55 @@
+"""Statistics kept up to date from edits match a full recompute"""
+
+import numpy as np
+
+from waferstats import YieldStats
+from waferundo import UndoHistory
+from wafertesting import syntheticWafer, randomEdits, STATUS_EDITS, THICK_EDITS
+
+EDITS = STATUS_EDITS + THICK_EDITS
+
+def assertMatchesRecompute(stats):
+    fresh = YieldStats(stats.wafer)
+    for name in ("dieCounts", "colCounts", "rowCounts", "waferCounts", "dieN", "dieMin", "dieMax"):
+        assert np.array_equal(getattr(stats, name), getattr(fresh, name)), name
+    for name in ("dieSum", "dieSumSq"):
+        assert np.allclose(getattr(stats, name), getattr(fresh, name)), name
+    cols, rows = stats.wafer.sampleStatus.shape[:2]
+    for i, j in [(None, None), (0, None), (None, rows - 1), (cols - 1, 0)]:
+        assert stats.counts(i, j) == fresh.counts(i, j)
+        summary, expected = stats.thickness(i, j), fresh.thickness(i, j)
+        assert summary.count == expected.count
+        if expected.count:
+            assert np.allclose(summary[1:], expected[1:])
+
+def attachedStats(wafer):
+    stats = YieldStats(wafer)
+    stats.attach()
+    return stats
+
+def test_incremental_matches_recompute():
+    wafer = syntheticWafer(4, 5, 3, 4)
+    stats = attachedStats(wafer)
+    for seed in range(10):
+        randomEdits(wafer, seed, 20, EDITS)
+        assertMatchesRecompute(stats)
+
+def test_undo_keeps_statistics_current():
+    wafer = syntheticWafer(3, 3, 4, 4)
+    stats = attachedStats(wafer)
+    history = UndoHistory(wafer)
+    history.attach()
+    randomEdits(wafer, 1, 40, EDITS)
+    while history.undo() is not None:
+        pass
+    assertMatchesRecompute(stats)
+    while history.redo() is not None:
+        pass
+    assertMatchesRecompute(stats)
+
+def test_unmeasured_die_has_no_thickness():
+    wafer = syntheticWafer(2, 2, 2, 2)
+    stats = attachedStats(wafer)
+    wafer.setSamples(np.ones(wafer.sampleStatus.shape, dtype=bool), "thick", 0.0)
+    assert stats.thickness() == (0, None, None, None, None)
+    assertMatchesRecompute(stats)
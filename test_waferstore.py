@@ -0,0 +1,158 @@
+"""Wafers come back from the store as they went in, and saves write only the edits"""
+
+import threading
+
+import pytest
+
+from waferstore import WaferStore
+from wafertesting import syntheticWafer, randomEdits, assertSameWafer
+
+@pytest.fixture
+def store(tmp_path):
+    store = WaferStore(str(tmp_path / "lots.wdb"))
+    yield store
+    store.close()
+
+def storedWafer(store, lot="L1", seed=0):
+    wafer = syntheticWafer(3, 4, 3, 2, seed=seed)
+    wafer.name = "W%d" % seed
+    store.importWafer(wafer, lot)
+    return wafer
+
+def test_round_trip(store):
+    wafer = storedWafer(store)
+    randomEdits(wafer, 0, 50)
+    wafer.setWedgeFitState(None)
+    store.importWafer(wafer, "L1")
+    assertSameWafer(store.openWafer("L1", "W0"), wafer)
+    assert store.listWafers() == [("L1", "W0")]
+    with pytest.raises(KeyError):
+        store.openWafer("L2", "W0")
+
+def test_saves_write_back_the_edits(store):
+    storedWafer(store)
+    opened = store.openWafer("L1", "W0")
+    for seed in range(3):
+        randomEdits(opened, seed, 40)
+        store.saveWafer(opened)
+        assertSameWafer(store.openWafer("L1", "W0"), opened)
+
+def test_saves_write_only_edited_rows(store):
+    storedWafer(store)
+    opened = store.openWafer("L1", "W0")
+    store.db.execute("UPDATE samples SET notes='elsewhere' WHERE i=1")
+    opened.setField("sample", (0, 0, 0, 0), "thick", 1.5)
+    opened.setField("die", (2, 1), "notes", "edited")
+    store.saveWafer(opened)
+    assert store.trackers[opened].samples == set()
+    saved = store.openWafer("L1", "W0")
+    assert saved.sampleThick[0, 0, 0, 0] == 1.5 and saved.dieNotes[(2, 1)] == "edited"
+    assert saved.sampleNotes[(1, 0, 0, 0)] == "elsewhere"
+
+def test_rename_and_save_as(store):
+    storedWafer(store)
+    opened = store.openWafer("L1", "W0")
+    opened.setField("wafer", (), "name", "W9")
+    waferId = store.saveWafer(opened)
+    assert store.listWafers() == [("L1", "W9")]
+    copyId = store.saveWafer(opened, "L2")
+    assert copyId != waferId and store.listWafers() == [("L1", "W9"), ("L2", "W9")]
+    opened.setField("sample", (1, 1, 1, 1), "thick", 2.5)
+    store.saveWafer(opened)
+    assert store.openWafer("L2", "W9").sampleThick[1, 1, 1, 1] == 2.5
+    assert store.openWafer("L1", "W9").sampleThick[1, 1, 1, 1] != 2.5
+
+def test_rename_onto_another_wafer_is_refused(store):
+    storedWafer(store, seed=0)
+    other = storedWafer(store, seed=1)
+    opened = store.openWafer("L1", "W0")
+    opened.setField("wafer", (), "name", "W1")
+    with pytest.raises(ValueError):
+        store.saveWafer(opened)
+    assertSameWafer(store.openWafer("L1", "W1"), other)
+
+def test_find_samples_across_a_lot(store):
+    for seed in range(3):
+        storedWafer(store, seed=seed)
+    found = store.findSamples(lot="L1", status=1, thickMin=9.0, thickMax=9.1)
+    assert found and all(row[4] == 1 and 9.0 <= row[5] <= 9.1 for row in found)
+    expected = 0
+    for seed in range(3):
+        wafer = store.openWafer("L1", "W%d" % seed)
+        expected += int(((wafer.sampleStatus == 1) & (wafer.sampleThick >= 9.0) &
+                         (wafer.sampleThick <= 9.1)).sum())
+    assert len(found) == expected
+    assert found == sorted(found, key=lambda row: row[:4])
+
+def test_new_wafer_does_not_replace_a_stored_one(store):
+    stored = storedWafer(store)
+    other = syntheticWafer(3, 4, 3, 2, seed=5)
+    other.name = "W0"
+    with pytest.raises(ValueError):
+        store.saveWafer(other, "L1")
+    assertSameWafer(store.openWafer("L1", "W0"), stored)
+    assert other not in store.trackers
+    store.saveWafer(other, "L2")
+    assert store.listWafers() == [("L1", "W0"), ("L2", "W0")]
+
+def test_replaced_wafer_is_no_longer_tracked(store):
+    storedWafer(store)
+    stale = store.openWafer("L1", "W0")
+    replacement = syntheticWafer(3, 4, 3, 2, seed=5)
+    replacement.name = "W0"
+    store.importWafer(replacement, "L1")
+    assert stale not in store.trackers
+    stale.setField("sample", (0, 0, 0, 0), "thick", 1.5)
+    with pytest.raises(ValueError):
+        store.saveWafer(stale, "L1")
+    assertSameWafer(store.openWafer("L1", "W0"), replacement)
+
+def test_untracked_wafer_stops_recording(store):
+    storedWafer(store)
+    opened = store.openWafer("L1", "W0")
+    store.untrack(opened)
+    opened.setField("sample", (0, 0, 0, 0), "thick", 1.5)
+    assert opened not in store.trackers and opened.listeners == []
+
+def inThread(function, *args):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(function(*args)))
+    thread.start()
+    thread.join()
+    return results
+
+def test_save_written_from_another_thread(store):
+    storedWafer(store)
+    opened = store.openWafer("L1", "W0")
+    randomEdits(opened, 1, 30)
+    saved = opened.copy()
+    pending = store.beginSave(opened)
+    opened.setField("sample", (2, 1, 1, 2), "thick", 7.5) # While the save is written
+    assert inThread(store.writeSave, pending)
+    assertSameWafer(store.openWafer("L1", "W0"), saved)
+    assert store.trackers[opened].samples == set([(2, 1, 1, 2)])
+    store.saveWafer(opened)
+    assertSameWafer(store.openWafer("L1", "W0"), opened)
+
+def test_new_wafer_saved_from_another_thread(store):
+    wafer = syntheticWafer(3, 4, 3, 2)
+    pending = store.beginSave(wafer, "L3")
+    wafer.setField("die", (1, 1), "notes", "later")
+    inThread(store.writeSave, pending)
+    assert store.trackers[wafer].key == ("L3", wafer.name)
+    store.saveWafer(wafer)
+    assertSameWafer(store.openWafer("L3", wafer.name), wafer)
+
+def test_failed_save_keeps_its_edits(store):
+    storedWafer(store, seed=0)
+    storedWafer(store, seed=1)
+    opened = store.openWafer("L1", "W0")
+    opened.setField("sample", (0, 0, 0, 0), "thick", 1.5)
+    opened.setField("wafer", (), "name", "W1")
+    with pytest.raises(ValueError):
+        store.saveWafer(opened)
+    assert store.trackers[opened].samples == set([(0, 0, 0, 0)])
+    opened.setField("wafer", (), "name", "W2")
+    store.saveWafer(opened)
+    assertSameWafer(store.openWafer("L1", "W2"), opened)
+    assert store.listWafers() == [("L1", "W1"), ("L1", "W2")]
@@ -0,0 +1,45 @@
+"""Thickness tables can be read back by the measurement importer"""
+
+import csv
+import io
+
+import numpy as np
+import pytest
+
+from waferimport import importMeasurements
+from waferio import Cancelled
+from waferthick import writeThicknessTable, predictThickness, TABLE_COLUMNS
+from wafertesting import syntheticWafer
+
+def namedWafer():
+    wafer = syntheticWafer(3, 4, 3, 2)
+    wafer.name = u"Lot 7, \"W\u00e9 3\""
+    wafer.sampleThick[1, 1, 1, 1] = 0.0
+    return wafer
+
+def test_table_reads_back(tmp_path):
+    wafer = namedWafer()
+    filename = str(tmp_path / "t.csv")
+    writeThicknessTable(wafer, filename)
+    with io.open(filename, encoding="utf-8", newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == TABLE_COLUMNS and len(rows) == 1 + wafer.sampleThick.size
+    assert set(row[0] for row in rows[1:]) == set([wafer.name])
+    predicted = predictThickness(wafer)
+    copy = namedWafer()
+    copy.sampleThick[...] = 0.0
+    report = importMeasurements(copy, filename)
+    assert report.matched == wafer.sampleThick.size and report.skipped == 0
+    assert np.array_equal(copy.sampleThick, wafer.sampleThick)
+    assert [float(row[6]) for row in rows[1:3]] == [round(p, 4) for p in predicted.ravel()[:2]]
+
+def test_cancelled_export_keeps_the_old_table(tmp_path):
+    filename = str(tmp_path / "t.csv")
+    with open(filename, "w") as f:
+        f.write("old\n")
+    def cancel(fraction):
+        raise Cancelled()
+    with pytest.raises(Cancelled):
+        writeThicknessTable(syntheticWafer(30, 30, 4, 4), filename, progress=cancel)
+    with open(filename) as f:
+        assert f.read() == "old\n"
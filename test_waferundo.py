@@ -0,0 +1,73 @@
+"""Undo and redo walk the wafer back and forth through the states it was in"""
+
+import numpy as np
+
+from waferundo import UndoHistory, stepSize
+from wafertesting import syntheticWafer, randomEdits, assertSameWafer
+
+def historyOf(wafer, **options):
+    history = UndoHistory(wafer, **options)
+    history.attach()
+    return history
+
+def test_undo_and_redo_return_to_each_state():
+    wafer = syntheticWafer(3, 3, 4, 4)
+    history = historyOf(wafer)
+    states = [wafer.copy()]
+    for seed in range(30):
+        randomEdits(wafer, seed, 1)
+        if len(history.undoSteps) == len(states):
+            states.append(wafer.copy())
+    assert len(states) > 20
+    for state in reversed(states[:-1]):
+        assert history.undo() is not None
+        assertSameWafer(wafer, state)
+    assert not history.canUndo() and history.undo() is None
+    for state in states[1:]:
+        assert history.redo() is not None
+        assertSameWafer(wafer, state)
+    assert not history.canRedo()
+
+def test_grouped_edits_are_one_step():
+    wafer = syntheticWafer(3, 3, 4, 4)
+    history = historyOf(wafer)
+    before = wafer.copy()
+    with history.grouped():
+        for seed in range(10):
+            with history.grouped():
+                randomEdits(wafer, seed, 3)
+    after = wafer.copy()
+    assert len(history.undoSteps) == 1
+    history.undo()
+    assertSameWafer(wafer, before)
+    history.redo()
+    assertSameWafer(wafer, after)
+
+def test_new_edit_clears_redo():
+    wafer = syntheticWafer(2, 2, 2, 2)
+    history = historyOf(wafer)
+    wafer.setField("sample", (0, 0, 0, 0), "thick", 1.0)
+    wafer.setField("sample", (0, 0, 0, 0), "thick", 2.0)
+    history.undo()
+    assert history.canRedo()
+    wafer.setField("sample", (1, 1, 1, 1), "thick", 3.0)
+    assert not history.canRedo()
+    assert history.undo()[0].index == (1, 1, 1, 1)
+
+def test_oldest_steps_are_forgotten_past_the_limit():
+    wafer = syntheticWafer(3, 3, 4, 4)
+    history = historyOf(wafer, maxChanges=50)
+    for seed in range(40):
+        randomEdits(wafer, seed, 1)
+        assert history.changes == sum(stepSize(step) for step in history.undoSteps)
+        assert history.changes <= 50 or len(history.undoSteps) == 1
+
+def test_bulk_edit_is_one_record():
+    wafer = syntheticWafer(2, 2, 3, 3)
+    history = historyOf(wafer)
+    before = wafer.copy()
+    wafer.setSamples(np.ones(wafer.sampleStatus.shape, dtype=bool), "thick", 5.0)
+    step = history.undoSteps[-1]
+    assert len(step) == 1 and stepSize(step) == wafer.sampleThick.size
+    history.undo()
+    assertSameWafer(wafer, before)
@@ -1,409 +1,855 @@
 #!/usr/bin/python
 
-from gi.repository import Gtk, Gdk, cairo, Pango, PangoCairo
+from waferprofile import clock
+startupTime = clock()
+
+from gi.repository import Gtk, Gdk, GLib
+import cairo
 import math
-import sys, os
 import numpy as np
-from scipy.optimize import curve_fit, leastsq
-import cPickle as pickle
-import xml.etree.cElementTree as et
-
-def autoconvert(s):
-    for fn in (int, float):
+import sys, os
+import threading
+from wafercore import Wafer, STATUS_NAMES, FIELD_ARRAYS
+from waferio import readWafer, BINARY_EXTENSION, Cancelled, STORE_EXTENSION, isStorePath, splitStorePath, storePath
+from waferrender import WaferLayout, WaferRenderer, Heatmap, drawMap, exportWafer, EXPORT_EXTENSIONS
+from waferjournal import Journal, replayJournal
+from waferundo import UndoHistory
+from waferstats import YieldStats
+from waferthick import ThicknessMap, hasWedgeFit
+from waferprofile import profiler
+
+# Where the profiling overlay goes, as x, y, width, height
+OVERLAY_RECT = (4, 4, 330, 20)
+
+# Pixels the pointer must move with the button held to start a rubber band
+DRAG_THRESHOLD = 4
+
+# Tools > Color By items, the field each colors devices by and its color bar title
+COLOR_MENUS = [("colorStatusMenu", "status", ""),
+               ("colorThickMenu", "thick", "thick (nm)"),
+               ("colorSizeXMenu", "sizeX", "size x"),
+               ("colorSizeYMenu", "sizeY", "size y"),
+               ("colorWedgeMenu", "wedge", "wedge fit (nm)"),
+               ("colorPredictedMenu", "predicted", "predicted (nm)")]
+COLOR_TITLES = dict((field, title) for menu, field, title in COLOR_MENUS)
+
+# Menu items left insensitive while a file is being read or written
+FILE_MENUS = ["newMenu", "openMenu", "saveMenu", "saveasMenu", "importMenu", "exportMenu", "compareMenu",
+              "menuExportPredicted"]
+# Menus that edit the wafer, disabled while an import runs so its undo step holds the import alone
+EDIT_MENUS = ["menuWaferProps", "undoMenu", "redoMenu", "editSelectionMenu"]
+
+class FileTask(object):
+    """A load or save running in a worker thread, reporting back on the main loop
+
+    work(progress) runs in the thread and should pass progress to the
+    reader or writer, which calls it with the fraction done. Progress is
+    shown through GLib.idle_add, at most one update pending at a time, and
+    after cancel() the next progress call raises Cancelled. Once the thread
+    is over done(result), failed(error) or, if Cancelled was raised,
+    stopped() runs on the main loop. Work that ends before it notices the
+    cancel is done all the same, so a cancelled save may still have saved.
+    """
+    def __init__(self, name, work, onProgress, done, failed, stopped):
+        self.name       = name
+        self.work       = work
+        self.onProgress = onProgress
+        self.done       = done
+        self.failed     = failed
+        self.stopped    = stopped
+        self.fraction   = 0.0
+        self.queued     = False
+        self.cancelled  = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
         try:
-            return fn(s)
-        except ValueError:
-            pass
-    return s
-
-class Sample():
-    def __init__(self, sampleName):
-        self.name = sampleName
-        self.sizeX = 0.0
-        self.sizeY = 0.0
-        self.thick = 0.0
-        self.notes = ""
-        self.status = 3 # 3 Unmeasured, 2 Dead, 1 Alive
-    def __str__(self):
-        return self.name
-    def setStatus(self, status):
-        if self.status == status and self.status != 3:
-            self.status = 3
+            result = profiler.run(self.name, self.work, self.progress)
+        except Exception as e: # finish tells Cancelled apart
+            GLib.idle_add(self.finish, None, e)
+        else:
+            GLib.idle_add(self.finish, result, None)
+
+    def progress(self, fraction):
+        if self.cancelled:
+            raise Cancelled()
+        self.fraction = fraction
+        if not self.queued:
+            self.queued = True
+            GLib.idle_add(self.showProgress)
+
+    def showProgress(self):
+        self.queued = False
+        self.onProgress(self.fraction)
+        return False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def finish(self, result, error):
+        if isinstance(error, Cancelled):
+            self.stopped()
+        elif error is not None:
+            self.failed(error)
         else:
-            self.status = status
-
-class Die():
-    def __init__(self, dieName, rows, cols,
-                 startingRowLetter='1', startingColLetter="A"):
-        self.name = dieName
-        self.notes = ""
-        self.status = -1
-        self.rows = rows
-        self.cols = cols
-
-        self.thickTopLeft  = 0.0
-        self.thickTopRight = 0.0
-        self.thickBotRight = 0.0
-        self.thickBotLeft  = 0.0
-
-        # Create the array of samples
-        self.samples = [[Sample(chr(ord(startingColLetter)+i)+chr(ord(startingRowLetter)+j)) for j in range(self.rows)] for i in range(self.cols)]
-
-    def __str__(self):
-        return self.name
-
-class Wafer():
-    def __init__(self, waferName, waferRows, waferCols, dieRows, dieCols,
-                 startingRowLetter='1', startingColLetter="Q"):
-        self.name         = waferName
-        self.notes        = ""
-        self.status       = -1
-        self.waferRows    = waferRows
-        self.waferCols    = waferCols
-        self.dieRows      = dieRows
-        self.dieCols      = dieCols
-
-        self.dieSpacingX  = 10.0 # distance between exposures in mm
-        self.dieSpacingY  = 10.0
-        self.sampleSpacingX = 0.75 # distance between samples in mm
-        self.sampleSpacingY = 0.75
-
-        self.SampleMargin = 2    # For display only
-        self.DieMargin    = 15   # For display only
-
-        self.wedge        = 0 # 0 None, 1 Left to Right, 2 Right to left, 3 Bottom to top, 4 top to bottom
-        self.wedgeMx      = 0 
-        self.wedgeMy      = 0
-        self.wedgeC       = 0
-
-        # Create the array of dies
-        self.dies = [[Die(chr(ord(startingColLetter)+i)+chr(ord(startingRowLetter)+j), self.dieRows, self.dieCols) for j in range(self.waferRows)] for i in range(self.waferCols)]
+            self.done(result)
+        return False
+
+def waitForJournals(journals, progress):
+    """Wait in a FileTask for the compactions of journals, letting Cancel stop the wait"""
+    for journal in journals:
+        while not journal.wait(0.1):
+            progress(0.0)
 
 class WaferDisplay(Gtk.DrawingArea):
 
-    def __init__ (self, upper=9, text=''):
+    def __init__ (self, builder=None):
         Gtk.DrawingArea.__init__(self)
         self.set_size_request (800, 800)
-        self.wafer = Wafer("Test", 5, 5, 5, 7)
-        self.builder = Gtk.Builder()
-        self.builder.add_from_file("interface.glade")
+        self.background = None
+        self.backgroundSize = None
+        self.renderer = WaferRenderer()
+        self.layout = None
+        self.hovered = None
+        self.selection = None # Mask of the selected devices, or None
+        self.dragStart = None
+        self.dragBand  = None # (x1, y1, x2, y2) of the rubber band while dragging
+        self._wafer = None # A default wafer is only made if nothing gets loaded
+        self.history = None
+        self.stats = None
+        self.thickness = None
+        self.colorField = "status" # Or a numeric field shown as a heatmap
+        self.heatmap = None
+        self.comparison = None # Another copy of the wafer whose differences are outlined
+        self.comparisonName = ""
+        self.differences = None # (WaferDiff, mask of the differing devices), made when drawn
+        self.notesIndex = None # Built while loading, or on the first search
+        self.searchQuery = ""
+        self.searchMatches = None # (matching keys, mask of the matching devices), made when drawn
+        self.searchEntry = Gtk.SearchEntry()
+        self.searchEntry.set_placeholder_text("Search notes")
+        self.searchEntry.connect("search-changed", self.search)
+        self.searchEntry.connect("activate", self.selectMatches)
+        self.statsQueued = False
+        self.statsLabel = Gtk.Label()
+        self.statsLabel.set_alignment(0.0, 0.5)
+        self.showOverlay = profiler.enabled
+        self.overlayRefresh = False
+        self.overlayFrames = 0
+        GLib.timeout_add(1000, self.refreshOverlay)
+        if builder is None:
+            builder = Gtk.Builder()
+            builder.add_from_file("interface.glade")
+        self.builder = builder
         self.filename = ""
-
-    def loadWithArg(self, filename):
-        self.filename = filename
-        self.parseXML()
+        self.journal = None
+        self.retiredJournals = [] # Detached journals whose compaction may still be writing
+        self.store = None
+        self.task = None # FileTask being run, if any
+        self.progressBar = Gtk.ProgressBar()
+        self.progressBar.set_show_text(True)
+        self.cancelButton = Gtk.Button.new_from_stock(Gtk.STOCK_CANCEL)
+        self.cancelButton.connect("clicked", self.cancelTask)
+        self.progressBox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        self.progressBox.pack_start(self.progressBar, True, True, 0)
+        self.progressBox.pack_start(self.cancelButton, False, False, 0)
+        self.progressBox.show_all()
+        self.progressBox.hide()
+        self.progressBox.set_no_show_all(True) # Only shown while a task runs
+        GLib.timeout_add_seconds(1, self.syncJournal)
+        self._("wedgeOrder").connect("changed", self.refitWedge)
+        self._("wedgeRobust").connect("toggled", self.refitWedge)
+
+    @property
+    def wafer(self):
+        if self._wafer is None:
+            self.wafer = Wafer("Test", 5, 5, 5, 7)
+        return self._wafer
+
+    @wafer.setter
+    def wafer(self, wafer):
+        self.setWafer(wafer)
+
+    def setWafer(self, wafer, notesIndex=None):
+        """Show wafer, with the index of its notes if one was built while loading"""
+        if self._wafer is not None:
+            self.history.detach()
+            self.stats.detach()
+            self.thickness.detach()
+            if self.notesIndex is not None:
+                self.notesIndex.detach()
+            self._wafer.removeListener(self.queueStatsUpdate)
+            self._wafer.removeListener(self.dropCaches)
+            if self.store is not None and self._wafer is not wafer:
+                self.store.untrack(self._wafer)
+        self._wafer = wafer
+        self.history = UndoHistory(wafer, onChange=self.updateUndoMenus)
+        self.history.attach()
+        self.stats = YieldStats(wafer)
+        self.stats.attach()
+        self.thickness = ThicknessMap(wafer)
+        self.thickness.attach()
+        wafer.addListener(self.queueStatsUpdate)
+        wafer.addListener(self.dropCaches)
+        self.notesIndex = notesIndex # Otherwise built on the first search
+        if notesIndex is not None:
+            notesIndex.attach()
+        self.heatmap = None
+        self.differences = None
+        self.searchMatches = None
+        if self.comparison is not None and self.comparison.sampleStatus.shape != wafer.sampleStatus.shape:
+            self.stopComparing()
+        self.selection = None
+        self.updateUndoMenus()
+        self.updateSelectionMenus()
+        self.updateStats()
+        self.invalidateBackground()
+
+    def loadWithArg(self, filename, onLoaded=None):
+        self.readFile(filename, onLoaded)
+
+    def loading(self):
+        """True while the first wafer is still being read and there is nothing to show yet"""
+        return self._wafer is None and self.task is not None and self.task.name == "load"
+
+    def addFileFilters(self, dialog):
+        for name, pattern in (("Wafer XML", "*.xml"),
+                              ("Wafer binary", "*" + BINARY_EXTENSION),
+                              ("Wafer store", "*" + STORE_EXTENSION),
+                              ("All files", "*")):
+            fileFilter = Gtk.FileFilter()
+            fileFilter.set_name(name)
+            fileFilter.add_pattern(pattern)
+            dialog.add_filter(fileFilter)
 
     def load(self, event):
         dialog = Gtk.FileChooserDialog("Please choose a file", self.get_toplevel(),
                                        Gtk.FileChooserAction.OPEN,
                                        (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
                                         Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+        self.addFileFilters(dialog)
         response = dialog.run()
-        if response == Gtk.ResponseType.OK:
-            self.filename = dialog.get_filename()
-            self.parseXML()
+        filename = dialog.get_filename()
         dialog.destroy()
+        if response == Gtk.ResponseType.OK:
+            if filename.lower().endswith(STORE_EXTENSION):
+                filename = self.chooseStoredWafer(filename)
+            if filename:
+                self.readFile(filename)
         
     def save(self, event):
         if self.filename == "":
             self.saveas(event)
         else:
-            self.generateXML()
+            self.writeFile()
 
     def saveas(self, event):
         dialog = Gtk.FileChooserDialog("Please choose a file", self.get_toplevel(),
                                        Gtk.FileChooserAction.SAVE,
                                        (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
                                         Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+        self.addFileFilters(dialog)
         response = dialog.run()
+        filename = dialog.get_filename()
+        dialog.destroy()
         if response == Gtk.ResponseType.OK:
-            self.filename = dialog.get_filename()
-            self.generateXML()
+            if filename.lower().endswith(STORE_EXTENSION):
+                lot = self.askLot()
+                if lot is None:
+                    return
+                filename = storePath(filename, lot, self.wafer.name)
+            self.filename = filename
+            self.writeFile()
+
+    def readFile(self, filename, onLoaded=None):
+        """Load filename in whichever format its extension names, in the background
+
+        Edits journaled since the file was last written, e.g. before a crash,
+        are replayed on top and then folded back into the file. The current
+        wafer stays on screen until the new one is ready, and then onLoaded,
+        if given, is called.
+        """
+        if isStorePath(filename):
+            # The worker reads through a connection of its own
+            storeFile, lot, name = splitStorePath(filename)
+            store = self.openStore(storeFile)
+            def work(progress):
+                from wafersearch import NotesIndex
+                wafer = store.openWafer(lot, name)
+                return wafer, 0, NotesIndex(wafer)
+        else:
+            # A compaction still writing this file would remove records the replay needs
+            compactions = self.compactions(filename)
+            def work(progress):
+                from wafersearch import NotesIndex
+                waitForJournals(compactions, progress)
+                wafer = readWafer(filename, progress)
+                wafer.loadNotes()
+                recovered = replayJournal(wafer, filename)
+                return wafer, recovered, NotesIndex(wafer)
+
+        def done(result):
+            wafer, recovered, index = result
+            self.detachJournal()
+            self.filename = filename
+            self.setWafer(wafer, index)
+            if not isStorePath(filename): # Stores journal nothing
+                self.attachJournal()
+            if recovered:
+                sys.stderr.write("Recovered %d unsaved edits of %s\n" % (recovered, filename))
+                self.journal.compact()
+            if onLoaded is not None:
+                onLoaded()
+
+        self.runTask("load", "Loading " + os.path.basename(filename), work, done)
+
+    def writeFile(self):
+        """Save to self.filename in whichever format its extension names
+
+        Files are written in the background from a snapshot, as a journal
+        compaction, so editing can go on meanwhile: later edits land in the
+        fresh journal and survive even if the save fails or is cancelled.
+        A save waits for a compaction still writing the file, and a store
+        save writes the edited rows taken when it starts.
+        """
+        if isStorePath(self.filename):
+            # Only the rows edited since the last save are taken, then written by the worker
+            storeFile, lot, name = splitStorePath(self.filename)
+            store = self.openStore(storeFile)
+            pending = store.beginSave(self.wafer, lot)
+            journal = self.journal # Of a file saved into the store, which journals nothing
+            self.detachJournal()
+
+            def work(progress):
+                store.writeSave(pending)
+                if journal is not None:
+                    journal.discard()
+
+            def done(result):
+                self.filename = storePath(storeFile, lot, pending.name) # The wafer may have been renamed
+
+            def failed():
+                store.abortSave(pending)
+                if journal is not None and self.journal is None:
+                    self.journal = journal
+                    journal.attach()
+
+            self.runTask("save", "Saving " + name, work, done, failed)
+            return
+        compactions = self.compactions(self.filename)
+        if compactions:
+            # A compaction that started by itself is writing the file; save once it is over
+            self.runTask("save", "Saving " + os.path.basename(self.filename),
+                         lambda progress: waitForJournals(compactions, progress),
+                         lambda result: self.writeFile())
+            return
+        previous = self.journal
+        if previous is not None and previous.filename == self.filename:
+            previous = None
+        else:
+            self.detachJournal()
+            self.attachJournal()
+        journal = self.journal
+        snapshot = journal.beginSnapshot()
+
+        def work(progress):
+            journal.writeSnapshot(snapshot, progress)
+            if previous is not None:
+                # Saved as another file, which holds the old file's unsaved edits now;
+                # replaying them into the old file on its next open would save them there
+                previous.discard()
+
+        self.runTask("save", "Saving " + os.path.basename(self.filename), work, lambda result: None)
+
+    def importMeasurements(self, event):
+        """Read a measurement table in the background, applying it as one undoable edit
+
+        Batches are applied on the main loop as they are read, a few at most
+        waiting at a time, so memory does not grow with the table. The wafer
+        takes no other edits until the import is over, so undo takes back the
+        import alone.
+        """
+        dialog = Gtk.FileChooserDialog("Import measurements", self.get_toplevel(),
+                                       Gtk.FileChooserAction.OPEN,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+        for name, pattern in (("Measurement tables", "*.csv"), ("All files", "*")):
+            fileFilter = Gtk.FileFilter()
+            fileFilter.set_name(name)
+            fileFilter.add_pattern(pattern)
+            if pattern == "*.csv":
+                fileFilter.add_pattern("*.tsv")
+                fileFilter.add_pattern("*.txt")
+            dialog.add_filter(fileFilter)
+        response = dialog.run()
+        filename = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+
+        from waferimport import MeasurementReader
+        wafer, history = self.wafer, self.history
+        slots = threading.Semaphore(4) # Batches read but not yet applied
+
+        def apply(field, index, values):
+            try:
+                wafer.setSamples(index, field, values)
+            finally:
+                slots.release()
+            self.queue_draw()
+            return False
+
+        def work(progress):
+            reader = MeasurementReader(wafer, filename)
+            try:
+                for batch in reader.batches(progress):
+                    slots.acquire()
+                    GLib.idle_add(apply, *batch)
+            finally:
+                # Queued behind the last batch, and ahead of done, failed or stopped
+                GLib.idle_add(history.end)
+            return reader.report
+
+        def done(report):
+            text = "\n".join("Line %d: %s" % failure for failure in report.failures[:20])
+            if report.failed > 20:
+                text += "\n... %d more" % (report.failed - 20)
+            dialog = Gtk.MessageDialog(self.get_toplevel(), 0, Gtk.MessageType.INFO,
+                                       Gtk.ButtonsType.CLOSE, report.describe())
+            dialog.format_secondary_text(text)
+            dialog.run()
+            dialog.destroy()
+
+        history.begin()
+        self.runTask("import", "Importing " + os.path.basename(filename), work, done)
+
+    def exportMap(self, event):
+        """Export the map as PNG, PDF or SVG at the size it has on screen"""
+        dialog = Gtk.FileChooserDialog("Export map", self.get_toplevel(),
+                                       Gtk.FileChooserAction.SAVE,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name(self.wafer.name + ".png")
+        fileFilter = Gtk.FileFilter()
+        fileFilter.set_name("Images and documents")
+        for extension in EXPORT_EXTENSIONS:
+            fileFilter.add_pattern("*" + extension)
+        dialog.add_filter(fileFilter)
+        response = dialog.run()
+        filename = dialog.get_filename()
         dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        if os.path.splitext(filename)[1].lower() not in EXPORT_EXTENSIONS:
+            filename += ".png"
 
-    def generateXML(self):
-        root = et.Element("wafer")
-        root.set("name"   , str(self.wafer.name))
-        root.text = self.wafer.notes
-        root.set("status"   ,str(self.wafer.status))
-        root.set("waferRows",str(self.wafer.waferRows))
-        root.set("waferCols",str(self.wafer.waferCols))
-        root.set("dieRows"  ,str(self.wafer.dieRows))
-        root.set("dieCols"  ,str(self.wafer.dieCols))
-        root.set("wedge"    ,str(self.wafer.wedge))
-        root.set("wedgeMx"    ,str(self.wafer.wedgeMx))
-        root.set("wedgeMy"    ,str(self.wafer.wedgeMy))
-        root.set("wedgeC"     ,str(self.wafer.wedgeC))
-        root.set("dieSpacingX",    str(self.wafer.dieSpacingX))
-        root.set("dieSpacingY",    str(self.wafer.dieSpacingY))
-        root.set("sampleSpacingX", str(self.wafer.sampleSpacingX))
-        root.set("sampleSpacingY", str(self.wafer.sampleSpacingY))
-        
-        for i in range(self.wafer.waferCols):
-            wafcol = et.SubElement(root, "wafcol")
-            for j in range(self.wafer.waferRows):
-                dieObj = self.wafer.dies[i][j]
-                die = et.SubElement(wafcol, "die")
-                die.text = dieObj.notes
-                die.set("status",str(dieObj.status))
-                die.set("name"  ,str(dieObj.name))
-                die.set("rows"  ,str(dieObj.rows))
-                die.set("cols"  ,str(dieObj.cols))
-                die.set("thickTopLeft",  str(dieObj.thickTopLeft))
-                die.set("thickTopRight", str(dieObj.thickTopRight))
-                die.set("thickBotRight", str(dieObj.thickBotRight))
-                die.set("thickBotLeft",  str(dieObj.thickBotLeft))
-                
-                for ii in range(self.wafer.dieCols):
-                    diecol = et.SubElement(die, "diecol")
-                    for jj in range(self.wafer.dieRows):
-                        devObj = self.wafer.dies[i][j].samples[ii][jj]
-                        device = et.SubElement(diecol, "device")
-                        device.text = devObj.notes
-                        device.set("status",str(devObj.status))
-                        device.set("name"  ,str(devObj.name))
-                        device.set("thick" ,str(devObj.thick))
-                        device.set("sizeX" ,str(devObj.sizeX))
-                        device.set("sizeY" ,str(devObj.sizeY))
-                            
-        tree = et.ElementTree(root)
-        tree.write(self.filename, encoding="utf-8", xml_declaration=True)
-
-    def parseXML(self):
-        tree = et.parse(self.filename)
-        root = tree.getroot()
-        wrows = int(root.get("waferRows"))
-        wcols = int(root.get("waferCols"))
-        drows = int(root.get("dieRows"))
-        dcols = int(root.get("dieCols"))
-
-        self.wafer          = Wafer(root.get("name"), wrows, wcols, drows, dcols)
-        self.wafer.status   = int(root.get("status"))
-        self.wafer.wedge    = int(root.get("wedge"))
-        self.wafer.wedgeMx  = float(root.get("wedgeMx"))
-        self.wafer.wedgeMy  = float(root.get("wedgeMy"))
-        self.wafer.wedgeC   = float(root.get("wedgeC"))
-
-        self.wafer.dieSpacingX    = float(root.get("dieSpacingX")   ) 
-        self.wafer.dieSpacingY    = float(root.get("dieSpacingY")   ) 
-        self.wafer.sampleSpacingX = float(root.get("sampleSpacingX"))
-        self.wafer.sampleSpacingY = float(root.get("sampleSpacingY"))
-
-        notes = root.text
-        if notes == None:
-            notes = ""
-        self.wafer.notes = notes
-
-        for i, wafcol in enumerate(root.findall('wafcol')):
-            for j, die in enumerate(wafcol.findall('die')):
-                for item in die.items():
-                    name, val = item
-                    if val is not None:
-                        setattr(self.wafer.dies[i][j], name, autoconvert(val))
-                    notes = die.text
-                    if notes == None:
-                        notes = ""
-                    self.wafer.dies[i][j].notes = notes
-                    if not die.get("thickTopLeft") is None:
-                        self.wafer.dies[i][j].thickTopLeft  = float(die.get("thickTopLeft")) 
-                    if not die.get("thickTopRight") is None:
-                        self.wafer.dies[i][j].thickTopRight = float(die.get("thickTopRight"))
-                    if not die.get("thickBotRight") is None:
-                        self.wafer.dies[i][j].thickBotRight = float(die.get("thickBotRight")) 
-                    if not die.get("thickBotLeft") is None:
-                        self.wafer.dies[i][j].thickBotLeft  = float(die.get("thickBotLeft"))
-  
-                for ii, diecol in enumerate(die.findall('diecol')):
-                    for jj, device in enumerate(diecol.findall('device')):
-                        for item in device.items():
-                            name, val = item
-                            if val is not None:
-                                setattr(self.wafer.dies[i][j].samples[ii][jj], name, autoconvert(val))
-                            notes = device.text
-                            if notes == None:
-                                notes = ""
-                            self.wafer.dies[i][j].samples[ii][jj].notes = notes
-                            if not device.get("thick") is None:
-                                self.wafer.dies[i][j].samples[ii][jj].thick = float(device.get("thick") )
-                            if not device.get("sizeX") is None:
-                                self.wafer.dies[i][j].samples[ii][jj].sizeX = float(device.get("sizeX") )
-                            if not device.get("sizeY") is None:
-                                self.wafer.dies[i][j].samples[ii][jj].sizeY = float(device.get("sizeY") )
+        rect = self.get_allocation()
+        snapshot = self.wafer.copy()
+        self.runTask("export", "Exporting " + os.path.basename(filename),
+                     lambda progress: exportWafer(snapshot, filename, rect.width, rect.height, progress=progress),
+                     lambda result: None)
+
+    def runTask(self, name, title, work, done, failed=None):
+        """Run work(progress) in a FileTask, then done(result) or, if it fails or is cancelled, failed()"""
+        def stop(callback, *args):
+            if failed is not None:
+                failed()
+            self.endTask(callback, *args)
+        self.task = FileTask(name, work, self.showProgress, lambda result: self.endTask(done, result),
+                             lambda error: stop(self.showError, title, error),
+                             lambda: stop(sys.stderr.write, "%s cancelled\n" % title))
+        self.progressBar.set_text(title)
+        self.progressBar.set_fraction(0.0)
+        self.cancelButton.set_sensitive(True)
+        self.progressBox.show()
+        for menu in FILE_MENUS + (EDIT_MENUS if self.importing() else []):
+            self._(menu).set_sensitive(False)
+        self.task.thread.start()
+
+    def endTask(self, callback, *args):
+        imported = self.importing()
+        self.task = None
+        self.progressBox.hide()
+        for menu in FILE_MENUS:
+            self._(menu).set_sensitive(True)
+        if imported:
+            self._("menuWaferProps").set_sensitive(True)
+            self.updateUndoMenus()
+            self.updateSelectionMenus()
+        callback(*args)
+
+    def importing(self):
+        """True while measurements are imported, when the wafer takes no other edits"""
+        return self.task is not None and self.task.name == "import"
+
+    def showProgress(self, fraction):
+        self.progressBar.set_fraction(fraction)
+
+    def cancelTask(self, button=None):
+        """Ask the task to stop; the menus come back once its thread is over"""
+        if self.task is not None and not self.task.cancelled:
+            self.task.cancel()
+            self.cancelButton.set_sensitive(False)
+            self.progressBar.set_text("Cancelling")
+
+    def showError(self, title, error):
+        sys.stderr.write("%s failed: %s\n" % (title, error))
+        dialog = Gtk.MessageDialog(self.get_toplevel(), 0, Gtk.MessageType.ERROR,
+                                   Gtk.ButtonsType.CLOSE, "%s failed" % title)
+        dialog.format_secondary_text(str(error))
+        dialog.run()
+        dialog.destroy()
+
+    def openStore(self, path):
+        """The wafer store at path, keeping one open so edits are tracked until saved"""
+        if self.store is None or self.store.path != path:
+            from waferstore import WaferStore
+            if self.store is not None:
+                self.store.close()
+            self.store = WaferStore(path)
+        return self.store
+
+    def runDialog(self, title, widget, button):
+        """Show widget in a simple dialog, returning True if it was confirmed"""
+        dialog = Gtk.Dialog(title, self.get_toplevel(), 0,
+                            (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, button, Gtk.ResponseType.OK))
+        dialog.get_content_area().pack_start(widget, True, True, 6)
+        dialog.show_all()
+        confirmed = dialog.run() == Gtk.ResponseType.OK
+        dialog.get_content_area().remove(widget) # Keep it readable after the dialog is gone
+        dialog.destroy()
+        return confirmed
+
+    def chooseStoredWafer(self, path):
+        """Ask which wafer of a store to open, returning its store path or None"""
+        wafers = self.openStore(path).listWafers()
+        combo = Gtk.ComboBoxText()
+        for lot, name in wafers:
+            combo.append_text("%s/%s" % (lot, name))
+        combo.set_active(0)
+        if self.runDialog("Open wafer from store", combo, Gtk.STOCK_OPEN) and combo.get_active() >= 0:
+            lot, name = wafers[combo.get_active()]
+            return storePath(path, lot, name)
+        return None
+
+    def askLot(self):
+        entry = Gtk.Entry()
+        entry.set_placeholder_text("Lot")
+        if self.runDialog("Save wafer to store", entry, Gtk.STOCK_SAVE):
+            return entry.get_text()
+        return None
+
+    def attachJournal(self):
+        """Journal every edit of the wafer next to its file until the next full save"""
+        self.journal = Journal(self.wafer, self.filename)
+        self.journal.attach()
+
+    def detachJournal(self):
+        """Stop journaling without waiting for a compaction, which is kept track of until it is over"""
+        if self.journal is not None:
+            self.journal.detach()
+            self.retiredJournals = [journal for journal in self.retiredJournals if journal.compacting()]
+            if self.journal.compacting():
+                self.retiredJournals.append(self.journal)
+            self.journal = None
+
+    def compactions(self, filename):
+        """Journals of filename, current or retired, whose compaction is still writing"""
+        return [journal for journal in self.retiredJournals + [self.journal]
+                if journal is not None and journal.filename == filename and journal.compacting()]
+
+    def closeJournals(self):
+        """Detach the journal on quitting, letting every compaction finish"""
+        self.detachJournal()
+        for journal in self.retiredJournals:
+            journal.wait()
+
+    def syncJournal(self):
+        if self.journal is not None:
+            self.journal.sync()
+        return True
 
     def _(self, name):
         """Get the GTK object from the builder"""
         return self.builder.get_object(name)
 
     def onPrintRequest(self, widget):
-        pd = Gtk.PrintOperation()
-        pd.set_n_pages(1)
-        pd.connect("draw_page", self.do_draw_cb_wrapper)
-        result = pd.run(
-            Gtk.PrintOperationAction.PRINT_DIALOG, None)
-        print result  # handle errors etc.
+        operation = Gtk.PrintOperation()
+        operation.set_n_pages(1)
+        operation.connect("draw-page", self.drawPage)
+        try:
+            operation.run(Gtk.PrintOperationAction.PRINT_DIALOG, self.get_toplevel())
+        except GLib.Error as e:
+            self.showError("Printing", e)
+
+    def drawPage(self, operation, context, page):
+        """Fit the map to the printable area, laid out as it is on screen"""
+        rect = self.get_allocation()
+        drawMap(context.get_cairo_context(), self.wafer, context.get_width(), context.get_height(),
+                self.renderer, (rect.width, rect.height))
+
+    def invalidateBackground(self):
+        """Drop the cached static layer, e.g. after the wafer layout changed"""
+        self.background = None
+        self.layout = None
+        self.queue_draw()
+
+    def getLayout(self):
+        """Geometry for the current allocation, recomputed only when it changes"""
+        rect = self.get_allocation()
+        if self.layout is None or (self.layout.width, self.layout.height) != (rect.width, rect.height):
+            self.layout = WaferLayout(self.wafer, rect.width, rect.height)
+        return self.layout
+
+    def queueDrawSample(self, i, j, ii, jj):
+        """Repaint just the rectangle covering one device and its selection outline"""
+        x, y, sw, sh = self.getLayout().sampleRect(i, j, ii, jj)
+        self.queueDrawRect(x, y, x+sw, y+sh)
 
-    def do_draw_cb_wrapper(self, operation=None, context=None, page_nr=None):
-        self.do_draw_cb(None, context.get_cairo_context())
+    def queueDrawRect(self, x1, y1, x2, y2, pad=3):
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        x0, y0 = int(math.floor(x1-pad)), int(math.floor(y1-pad))
+        self.queue_draw_area(x0, y0, int(math.ceil(x2+pad))-x0, int(math.ceil(y2+pad))-y0)
 
     def do_draw_cb(self, widget, cr):
+        if self.loading():
+            return # An empty map, rather than the default wafer, until the file is read
+        # Repaints of the overlay alone would skew the frame times it shows
+        overlayOnly, self.overlayRefresh = self.overlayRefresh, False
+        if overlayOnly:
+            self.drawFrame(widget, cr)
+        else:
+            profiler.run("draw", self.drawFrame, widget, cr)
+        if self.showOverlay:
+            self.drawOverlay(cr)
+
+    def drawFrame(self, widget, cr):
         self.get_toplevel().set_title("Wafer Tracker - "+self.wafer.name)
 
-        rect = self.get_allocation()
-        w = rect.width
-        h = rect.height
-        rad = 0.5*min(w,h)-10.0
-        cr.translate ( 0.5*w, 0.5*h)
-        usefulBoxSize = rad*1.3
-
-        # Draw wafer with flat
-        cr.move_to( rad*np.cos(250.0*np.pi/180.0),  rad*np.sin(250.0*np.pi/180.0))
-        cr.line_to( rad*np.cos(290.0*np.pi/180.0),  rad*np.sin(290.0*np.pi/180.0))
-        cr.arc(0.0, 0.0, rad, 290.0*np.pi/180.0, 250.0*np.pi/180.0)
-        cr.set_line_width(3)
-        cr.set_source_rgb(0., 6./16., 1.0)
-        cr.stroke_preserve()
-        cr.set_source_rgb(0.8, 0.8, 0.8)
+        layout = self.getLayout()
+        w = layout.width
+        h = layout.height
+
+        # The static layer only changes with the allocation or the wafer layout
+        if self.background is None or self.backgroundSize != (w, h):
+            self.background = self.get_window().create_similar_surface(cairo.CONTENT_COLOR_ALPHA, w, h)
+            self.backgroundSize = (w, h)
+            self.renderer.drawBackground(cairo.Context(self.background), self.wafer, layout)
+        cr.set_source_surface(self.background, 0, 0)
+        cr.paint()
+        self.renderer.drawDevices(cr, self.wafer, layout, cr.clip_extents())
+        if self.colorField != "status":
+            heatmap = self.getHeatmap(layout)
+            heatmap.paint(cr)
+            self.renderer.drawColorBar(cr, layout, heatmap.lo, heatmap.hi, COLOR_TITLES[self.colorField])
+        if self.comparison is not None:
+            diff, mask = self.getDifferences()
+            self.renderer.outlineDevices(cr, layout, mask, (1.0, 0.5, 0.0), cr.clip_extents())
+        if self.searchQuery:
+            keys, mask = self.getSearchMatches()
+            self.renderer.outlineDevices(cr, layout, mask, (0.9, 0.0, 0.9), cr.clip_extents())
+        if self.selection is not None or self.dragBand is not None:
+            self.renderer.drawSelection(cr, layout, self.selection, self.dragBand, cr.clip_extents())
+
+    def drawOverlay(self, cr):
+        """Last and 95th percentile frame times and the device count, top left"""
+        times = profiler.summary("draw")
+        text = "%d devices" % self.wafer.sampleStatus.size
+        if times is not None:
+            text = "frame %.1f ms  p95 %.1f ms  %s" % (1000*times[0], 1000*times[1], text)
+        x, y, w, h = OVERLAY_RECT
+        cr.save()
+        cr.rectangle(x, y, w, h)
+        cr.set_source_rgba(1.0, 1.0, 1.0, 0.8)
         cr.fill()
-
-        # Draw wedge
-        ubs = usefulBoxSize
-        if self.wafer.wedge == 1:
-            cr.move_to(-0.5*ubs, 0.5*ubs + 10)
-            cr.line_to( 0.5*ubs, 0.5*ubs + 10)
-            cr.line_to( 0.5*ubs, 0.5*ubs + 25)
-            cr.line_to(-0.5*ubs, 0.5*ubs + 10)
-            cr.set_source_rgb(0., 6./16., 1.0)
-            cr.stroke()
-        elif self.wafer.wedge == 2:
-            ubs = usefulBoxSize
-            cr.move_to(-0.5*ubs, 0.5*ubs + 10)
-            cr.line_to(-0.5*ubs, 0.5*ubs + 25)
-            cr.line_to( 0.5*ubs, 0.5*ubs + 10)
-            cr.line_to(-0.5*ubs, 0.5*ubs + 10)
-            cr.set_source_rgb(0., 6./16., 1.0)
-            cr.stroke()
-        elif self.wafer.wedge == 4:
-            ubs = usefulBoxSize
-            cr.move_to(0.5*ubs + 10, -0.5*ubs )
-            cr.line_to(0.5*ubs + 10,  0.5*ubs )
-            cr.line_to(0.5*ubs + 25,  0.5*ubs )
-            cr.line_to(0.5*ubs + 10, -0.5*ubs )
-            cr.set_source_rgb(0., 6./16., 1.0)
-            cr.stroke()
-        elif self.wafer.wedge == 3:
-            ubs = usefulBoxSize
-            cr.move_to(0.5*ubs + 10, -0.5*ubs )
-            cr.line_to(0.5*ubs + 25, -0.5*ubs )
-            cr.line_to(0.5*ubs + 10,  0.5*ubs )
-            cr.line_to(0.5*ubs + 10, -0.5*ubs )
-            cr.set_source_rgb(0., 6./16., 1.0)
-            cr.stroke()
-
-        DieSizeX = (usefulBoxSize - (self.wafer.waferCols-1)*self.wafer.DieMargin)/self.wafer.waferCols
-        DieSizeY = (usefulBoxSize - (self.wafer.waferRows-1)*self.wafer.DieMargin)/self.wafer.waferRows
-        for i in range(self.wafer.waferCols):
-            for j in range(self.wafer.waferRows):
-               
-                # Draw Dies
-                transX = (i-0.5*(self.wafer.waferCols-1))*(DieSizeX+self.wafer.DieMargin)-0.5*DieSizeX
-                transY = (j-0.5*(self.wafer.waferRows-1))*(DieSizeY+self.wafer.DieMargin)-0.5*DieSizeY
-                cr.rectangle(transX-4, transY-4, DieSizeX+8, DieSizeY+8)
-                cr.set_line_width(1.0)
-                if self.wafer.dies[i][j].notes == "":
-                    cr.set_source_rgb(0.1, 0.1, 0.1)
-                else:
-                    cr.set_source_rgb(0., 6./16., 1.0)
-                cr.stroke()
-
-                # Draw Label
-                if j==0:
-                    layout = PangoCairo.create_layout(cr)
-                    layout.set_text(chr(ord("Q")+i), -1)
-                    desc = Pango.font_description_from_string ( "Sans Bold 24" )
-                    layout.set_font_description( desc)
-                    cr.set_source_rgb(0.0, 0.0, 0.0)
-                    cr.save()
-                    cr.move_to( transX + DieSizeX*0.32, transY - 0.6*DieSizeY)
-                    PangoCairo.show_layout (cr, layout)
-                    cr.restore()
-                if i==0:
-                    layout = PangoCairo.create_layout(cr)
-                    layout.set_text(chr(ord("1")+j), -1)
-                    desc = Pango.font_description_from_string ( "Sans Bold 24" )
-                    layout.set_font_description( desc)
-                    cr.set_source_rgb(0.0, 0.0, 0.0)
-                    cr.save()
-                    cr.move_to( transX - 0.6*DieSizeX, transY + 0.35*DieSizeY)
-                    PangoCairo.show_layout (cr, layout)
-                    cr.restore()
-
-                # Draw devices
-                for ii in range(self.wafer.dieCols):
-                    for jj in range(self.wafer.dieRows):
-                        SampSizeX = (DieSizeX - 2*self.wafer.SampleMargin - (self.wafer.dieCols-1)*self.wafer.SampleMargin)/self.wafer.dieCols 
-                        SampSizeY = (DieSizeY - 2*self.wafer.SampleMargin - (self.wafer.dieRows-1)*self.wafer.SampleMargin)/self.wafer.dieRows 
-                        transXX = ii*(SampSizeX+self.wafer.SampleMargin)+ transX + self.wafer.SampleMargin
-                        transYY = jj*(SampSizeY+self.wafer.SampleMargin)+ transY + self.wafer.SampleMargin
-                        cr.rectangle(transXX, transYY, SampSizeX, SampSizeY)
-                        cr.set_line_width(0.5)
-                        if self.wafer.dies[i][j].samples[ii][jj].status == 1:
-                            cr.set_source_rgb(0.0, 0.8, 0.0)
-                            cr.fill()
-                        elif self.wafer.dies[i][j].samples[ii][jj].status == 2:
-                            cr.set_source_rgb(0.8, 0.0, 0.0)
-                            cr.fill()
-                        cr.set_source_rgb(0.2, 0.2, 0.2)
-                        cr.stroke()
-                        if self.wafer.dies[i][j].samples[ii][jj].notes != "":
-                            cr.set_source_rgb(0.1, 0.1, 0.1)
-                            cr.arc(transXX + 0.5*SampSizeX, transYY + 0.5*SampSizeY, 2, 0, 2.0*np.pi)
-                            cr.fill()
-
-                        # Labels
-                        if i==0 and j==0:
-                            if jj==0:
-                                layout = PangoCairo.create_layout(cr)
-                                layout.set_text(chr(ord("A")+ii), -1)
-                                desc = Pango.font_description_from_string ( "Sans 10" )
-                                layout.set_font_description(desc)
-                                cr.save()
-                                cr.move_to( transXX + SampSizeX*0.15, transYY - 1.1*SampSizeY - 6)
-                                PangoCairo.show_layout (cr, layout)
-                                cr.restore()
-                            if ii==0:
-                                layout = PangoCairo.create_layout(cr)
-                                layout.set_text(chr(ord("1")+jj), -1)
-                                desc = Pango.font_description_from_string ( "Sans 10" )
-                                layout.set_font_description(desc)
-                                cr.save()
-                                cr.move_to( transXX - 1.1*SampSizeX - 6 , transYY + 0.15*SampSizeY)
-                                PangoCairo.show_layout (cr, layout)
-                                cr.restore()
+        cr.select_font_face("monospace", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        cr.set_font_size(12)
+        cr.set_source_rgb(0.0, 0.0, 0.0)
+        cr.move_to(x + 4, y + h - 6)
+        cr.show_text(text)
+        cr.restore()
+        x1, y1, x2, y2 = cr.clip_extents()
+        if x1 <= x and y1 <= y and x2 >= x + w and y2 >= y + h:
+            self.overlayFrames = profiler.timings["draw"].count
+
+    def refreshOverlay(self):
+        """Bring the overlay up to date with frames drawn outside its rectangle"""
+        if self.showOverlay and profiler.timings["draw"].count != self.overlayFrames:
+            self.overlayRefresh = True
+            self.queue_draw_area(*OVERLAY_RECT)
+        return True
+
+    def toggleProfiling(self, item):
+        profiler.enabled = item.get_active()
+        self.showOverlay = profiler.enabled
+        self.queue_draw_area(*OVERLAY_RECT)
+
+    def setColorField(self, item, field):
+        if item.get_active():
+            self.colorField = field
+            self.heatmap = None
+            self.queue_draw()
+
+    def heatmapValues(self):
+        """The color field of every device, NaN where there is nothing to show"""
+        if self.colorField == "predicted":
+            return self.thickness.values()
+        if self.colorField == "wedge":
+            if not hasWedgeFit(self.wafer):
+                return np.full(self.wafer.sampleThick.shape, np.nan)
+            return self.wafer.wedgeThickness(*self.wafer.getAllSampleCoords())
+        values = getattr(self.wafer, FIELD_ARRAYS["sample"][self.colorField][0])
+        return np.where(values != 0.0, values, np.nan) # Zero means not measured
+
+    def getHeatmap(self, layout):
+        """Heatmap image for the current allocation, rebuilt only after relevant edits"""
+        if self.heatmap is None or self.heatmap.size != (layout.width, layout.height):
+            self.heatmap = Heatmap(layout, self.heatmapValues())
+        return self.heatmap
+
+    def dropCaches(self, change):
+        """Forget the heatmap, differences and search matches an edit may have made stale"""
+        if self.colorField != "status" and change.field not in ("status", "notes"):
+            self.heatmap = None
+            self.queue_draw() # The range, and with it every color, may have moved
+        if self.comparison is not None:
+            self.differences = None
+            self.queue_draw()
+        if self.searchQuery and change.field == "notes":
+            self.searchMatches = None
+            self.queue_draw()
+
+    def compareWith(self, event):
+        """Outline the devices that differ from another copy of the wafer"""
+        dialog = Gtk.FileChooserDialog("Compare with", self.get_toplevel(),
+                                       Gtk.FileChooserAction.OPEN,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+        fileFilter = Gtk.FileFilter()
+        fileFilter.set_name("Wafer files")
+        fileFilter.add_pattern("*.xml")
+        fileFilter.add_pattern("*" + BINARY_EXTENSION)
+        dialog.add_filter(fileFilter)
+        response = dialog.run()
+        filename = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+
+        def work(progress):
+            other = readWafer(filename, progress)
+            other.loadNotes()
+            return other
+
+        def done(other):
+            from waferdiff import checkShapes
+            try:
+                checkShapes(self.wafer, other)
+            except ValueError as e:
+                self.showError("Comparing", e)
+                return
+            self.comparison = other
+            self.comparisonName = os.path.basename(filename)
+            self.differences = None
+            self._("stopCompareMenu").set_sensitive(True)
+            self.updateStats()
+            self.queue_draw()
+
+        self.runTask("load", "Loading " + os.path.basename(filename), work, done)
+
+    def stopComparing(self, event=None):
+        self.comparison = None
+        self.differences = None
+        self._("stopCompareMenu").set_sensitive(False)
+        self.updateStats()
+        self.queue_draw()
+
+    def getDifferences(self):
+        """The WaferDiff against the comparison and its device mask, redone after edits"""
+        if self.differences is None:
+            from waferdiff import WaferDiff
+            diff = WaferDiff(self.wafer, self.comparison)
+            self.differences = (diff, diff.mask())
+        return self.differences
+
+    def getNotesIndex(self):
+        if self.notesIndex is None:
+            from wafersearch import NotesIndex
+            self.notesIndex = NotesIndex(self.wafer)
+            self.notesIndex.attach()
+        return self.notesIndex
+
+    def search(self, entry):
+        """Outline the devices whose notes, or whose die's notes, match the search box"""
+        self.searchQuery = entry.get_text().strip()
+        self.searchMatches = None
+        self.updateStats()
+        self.queue_draw()
+
+    def getSearchMatches(self):
+        """The keys matching the search and their device mask, redone after notes edits"""
+        if self.searchMatches is None:
+            from wafersearch import matchMask
+            keys = self.getNotesIndex().search(self.searchQuery)
+            self.searchMatches = (keys, matchMask(keys, self.wafer.sampleStatus.shape))
+        return self.searchMatches
+
+    def selectMatches(self, entry):
+        if self.searchQuery:
+            self.select(self.getSearchMatches()[1])
+
+    def findNotes(self, event):
+        self.searchEntry.grab_focus()
+
+    def exportPredicted(self, event):
+        """Save measured and predicted thicknesses of every device as a CSV table"""
+        dialog = Gtk.FileChooserDialog("Export predicted thickness", self.get_toplevel(),
+                                       Gtk.FileChooserAction.SAVE,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name(self.wafer.name + ".csv")
+        response = dialog.run()
+        filename = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        from waferthick import writeThicknessTable
+        snapshot, predicted = self.wafer.copy(), np.array(self.thickness.values())
+        self.runTask("export", "Exporting " + os.path.basename(filename),
+                     lambda progress: writeThicknessTable(snapshot, filename, predicted, progress),
+                     lambda result: None)
+
+    def captureProfile(self, event):
+        """Profile the next run of a chosen operation into a file"""
+        dialog = Gtk.FileChooserDialog("Save profile of the next...", self.get_toplevel(),
+                                       Gtk.FileChooserAction.SAVE,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                        Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+        operations = ["draw", "click", "load", "save", "import", "wedge"]
+        combo = Gtk.ComboBoxText()
+        for operation in operations:
+            combo.append_text(operation)
+        combo.set_active(0)
+        dialog.set_extra_widget(combo)
+        dialog.set_current_name("draw.prof")
+        for name, pattern in (("cProfile data", "*.prof"), ("Collapsed stacks", "*.folded")):
+            fileFilter = Gtk.FileFilter()
+            fileFilter.set_name(name)
+            fileFilter.add_pattern(pattern)
+            dialog.add_filter(fileFilter)
+        if dialog.run() == Gtk.ResponseType.OK:
+            profiler.captureNext(operations[combo.get_active()], dialog.get_filename())
+        dialog.destroy()
 
     def getSampleCoords(self, i,j,ii,jj):
-        coordX = self.wafer.dieSpacingX*(i - 0.5*(self.wafer.waferCols-1))
-        coordY = self.wafer.dieSpacingY*((self.wafer.waferRows-j-1) - 0.5*(self.wafer.waferRows-1))
-        coordX = coordX + self.wafer.sampleSpacingX*(ii - 0.5*(self.wafer.dieCols-1))
-        coordY = coordY + self.wafer.sampleSpacingY*((self.wafer.dieRows-jj-1) - 0.5*(self.wafer.dieRows-1))
-        return [coordX, coordY]
+        return self.wafer.getSampleCoords(i,j,ii,jj)
 
     def getGratingCoords(self, i, j, quadrant):
-        # quadrant is 1-4 as per convention
-        coordX = self.wafer.dieSpacingX*(i - 0.5*(self.wafer.waferCols-1))
-        coordY = self.wafer.dieSpacingY*((self.wafer.waferRows-j-1) - 0.5*(self.wafer.waferRows-1))
-        if quadrant==1:
-            coordX = coordX + 2.00
-            coordY = coordY + 3.05
-        elif quadrant==2:
-            coordX = coordX - 2.00
-            coordY = coordY + 3.05
-        elif quadrant==3:
-            coordX = coordX - 2.00
-            coordY = coordY - 3.05
-        else:
-            coordX = coordX + 2.00
-            coordY = coordY - 3.05
-        return [coordX, coordY]
+        return self.wafer.getGratingCoords(i, j, quadrant)
 
     def openDeviceWindow(self, device, i, j, ii, jj):
         coordX, coordY = self.getSampleCoords(i,j,ii,jj)
@@ -418,20 +864,24 @@ class WaferDisplay(Gtk.DrawingArea):
         self._("sampleNotes").get_buffer().set_text(device.notes)
         self._("wedgeThick").set_label("N/A")
 
-        # Wedge thickness
+        # Interpolated from the die corners, and the plain wedge fit
+        predicted = self.thickness.value(i, j, ii, jj)
         if (self.wafer.wedgeC != 0.0):
-            t = self.wafer.wedgeMx*coordX + self.wafer.wedgeMy*coordY + self.wafer.wedgeC
-            self._("wedgeThick").set_label("%.2f nm" % t)
+            t = float(self.wafer.wedgeThickness(coordX, coordY))
+            self._("wedgeThick").set_label("%.2f nm (wedge %.2f nm)" % (predicted, t))
+        elif predicted is not None:
+            self._("wedgeThick").set_label("%.2f nm" % predicted)
 
         dialogResponse = self._("deviceWindow").run()
         if dialogResponse == 0:
-            device.thick  = self._("sampleThick").get_value()
-            device.sizeX  = self._("sampleSizeX").get_value()
-            device.sizeY  = self._("sampleSizeY").get_value()
-            device.status = self._("sampleStatus").get_active()+1
-            start         = self._("sampleNotes").get_buffer().get_start_iter()
-            end           = self._("sampleNotes").get_buffer().get_end_iter()
-            device.notes  = self._("sampleNotes").get_buffer().get_text(start, end, False)
+            with self.history.grouped():
+                device.thick  = self._("sampleThick").get_value()
+                device.sizeX  = self._("sampleSizeX").get_value()
+                device.sizeY  = self._("sampleSizeY").get_value()
+                device.status = self._("sampleStatus").get_active()+1
+                start         = self._("sampleNotes").get_buffer().get_start_iter()
+                end           = self._("sampleNotes").get_buffer().get_end_iter()
+                device.notes  = self._("sampleNotes").get_buffer().get_text(start, end, False)
         self._("deviceWindow").hide()
 
     def editDieWindow(self, die):
@@ -443,13 +893,15 @@ class WaferDisplay(Gtk.DrawingArea):
         self._("thickBotLeftAdj").set_value(die.thickBotLeft)
         dialogResponse = self._("dieWindow").run()
         if dialogResponse == 0:
-            die.thickTopLeft  = self._("thickTopLeftAdj" ).get_value()
-            die.thickTopRight = self._("thickTopRightAdj").get_value()
-            die.thickBotRight = self._("thickBotRightAdj").get_value()
-            die.thickBotLeft  = self._("thickBotLeftAdj" ).get_value()
-            start         = self._("dieNotes").get_buffer().get_start_iter()
-            end           = self._("dieNotes").get_buffer().get_end_iter()
-            die.notes     = self._("dieNotes").get_buffer().get_text(start, end, False)
+            with self.history.grouped():
+                die.thickTopLeft  = self._("thickTopLeftAdj" ).get_value()
+                die.thickTopRight = self._("thickTopRightAdj").get_value()
+                die.thickBotRight = self._("thickBotRightAdj").get_value()
+                die.thickBotLeft  = self._("thickBotLeftAdj" ).get_value()
+                start         = self._("dieNotes").get_buffer().get_start_iter()
+                end           = self._("dieNotes").get_buffer().get_end_iter()
+                die.notes     = self._("dieNotes").get_buffer().get_text(start, end, False)
+            self.invalidateBackground()
         self._("dieWindow").hide()
 
     def newWaferWindow(self, event):
@@ -467,6 +919,7 @@ class WaferDisplay(Gtk.DrawingArea):
             start = self._("waferNotes").get_buffer().get_start_iter()
             end   = self._("waferNotes").get_buffer().get_end_iter()
 
+            self.detachJournal()
             self.wafer = Wafer(name, drows, dcols, srows, scols)
             self.wafer.wedge = int(self._("wedgeType").get_active())
             self.wafer.notes = self._("waferNotes").get_buffer().get_text(start, end, False)
@@ -507,139 +960,387 @@ class WaferDisplay(Gtk.DrawingArea):
             scols = int(self._("sampColsAdj").get_value())
             srows = int(self._("sampRowsAdj").get_value())
 
-            self.wafer.dieSpacingX    = self._("dieSpacingXAdj" ).get_value()
-            self.wafer.dieSpacingY    = self._("dieSpacingYAdj").get_value()
-            self.wafer.sampleSpacingX = self._("sampleSpacingXAdj").get_value()
-            self.wafer.sampleSpacingY = self._("sampleSpacingYAdj" ).get_value()
-
             start = self._("waferNotes").get_buffer().get_start_iter()
             end   = self._("waferNotes").get_buffer().get_end_iter()
 
             #self.wafer = Wafer(name, drows, dcols, srows, scols)
-            self.wafer.name  = self._("waferNameEdit").get_text()
-            self.wafer.wedge = int(self._("wedgeType").get_active())
-            self.wafer.notes = self._("waferNotes").get_buffer().get_text(start, end, False)
+            fields = (("dieSpacingX",    self._("dieSpacingXAdj" ).get_value()),
+                      ("dieSpacingY",    self._("dieSpacingYAdj").get_value()),
+                      ("sampleSpacingX", self._("sampleSpacingXAdj").get_value()),
+                      ("sampleSpacingY", self._("sampleSpacingYAdj" ).get_value()),
+                      ("name",  self._("waferNameEdit").get_text()),
+                      ("wedge", int(self._("wedgeType").get_active())),
+                      ("notes", self._("waferNotes").get_buffer().get_text(start, end, False)))
+            with self.history.grouped():
+                for field, value in fields:
+                    self.wafer.setField("wafer", (), field, value)
+            self.invalidateBackground()
             
         self._("waferNotes").get_buffer().set_text("")
         self._("waferNameEdit").set_text("")
         self._("wedgeType").set_active(0)
         self._("newWindow").hide()
 
-    def onclick (self, box, event):
+    def undo(self, event):
+        self.queueDrawChanges(self.history.undo())
 
-        # Draw dies
-        rect = self.get_allocation()
-        w = rect.width
-        h = rect.height
-        rad = 0.5*min(w,h)-10.0
-        usefulBoxSize = rad*1.3
-        DieSizeX = (usefulBoxSize - (self.wafer.waferCols-1)*self.wafer.DieMargin)/self.wafer.waferCols
-        DieSizeY = (usefulBoxSize - (self.wafer.waferRows-1)*self.wafer.DieMargin)/self.wafer.waferRows
-        SampSizeX = (DieSizeX - 2*self.wafer.SampleMargin - (self.wafer.dieCols-1)*self.wafer.SampleMargin)/self.wafer.dieCols 
-        SampSizeY = (DieSizeY - 2*self.wafer.SampleMargin - (self.wafer.dieRows-1)*self.wafer.SampleMargin)/self.wafer.dieRows 
+    def redo(self, event):
+        self.queueDrawChanges(self.history.redo())
 
+    def updateUndoMenus(self):
+        self._("undoMenu").set_sensitive(self.history.canUndo() and not self.importing())
+        self._("redoMenu").set_sensitive(self.history.canRedo() and not self.importing())
+
+    def queueDrawChanges(self, changes):
+        """Repaint the devices touched by changes, or everything if the dies or wafer changed"""
+        if not changes:
+            return
+        if any(change.kind in ("die", "wafer") for change in changes):
+            self.invalidateBackground()
+        elif len(changes) > 200 or any(change.kind == "samples" for change in changes):
+            self.queue_draw() # Device edits leave the cached background as it is
+        else:
+            for change in changes:
+                self.queueDrawSample(*change.index)
+
+    def select(self, mask, extend=False):
+        """Make mask (or with extend, mask and the current selection) the selection"""
+        if extend and self.selection is not None and mask is not None:
+            mask = mask | self.selection
+        if mask is not None and not mask.any():
+            mask = None
+        elif mask is not None:
+            mask = mask.copy() # toggleSelected changes the selection in place, e.g. cached search matches
+        self.selection = mask
+        self.updateSelectionMenus()
+        self.queue_draw()
+
+    def toggleSelected(self, i, j, ii, jj):
+        mask = self.selection
+        if mask is None:
+            mask = np.zeros(self.wafer.sampleStatus.shape, dtype=bool)
+        mask[i, j, ii, jj] = not mask[i, j, ii, jj]
+        self.selection = mask if mask.any() else None
+        self.updateSelectionMenus()
+        self.queueDrawSample(i, j, ii, jj)
+
+    def labelSelection(self, label):
+        """Mask of a die column or row, or a column or row of devices in every die"""
+        kind, n = label
+        mask = np.zeros(self.wafer.sampleStatus.shape, dtype=bool)
+        axis = ("col", "row", "sampleCol", "sampleRow").index(kind)
+        mask[(slice(None),)*axis + (n,)] = True
+        return mask
+
+    def selectAll(self, event):
+        self.select(np.ones(self.wafer.sampleStatus.shape, dtype=bool))
+
+    def selectNone(self, event):
+        self.select(None)
+
+    def updateSelectionMenus(self):
+        self._("editSelectionMenu").set_sensitive(self.selection is not None and not self.importing())
+
+    def applyToSelection(self, field, value):
+        """Set one field of every selected device as a single edit, then repaint once"""
+        self.wafer.setSamples(self.selection, field, value)
+        self.queue_draw()
+
+    def editSelectionWindow(self, event):
+        """Set the status, thickness or notes of all selected devices at once"""
+        if self.selection is None:
+            return
+        status = Gtk.ComboBoxText()
+        status.append_text("(unchanged)")
+        for value in sorted(STATUS_NAMES):
+            status.append_text(STATUS_NAMES[value])
+        status.set_active(0)
+        thickCheck = Gtk.CheckButton(label="Thickness")
+        thick = Gtk.SpinButton.new_with_range(0.0, 100.0, 0.01)
+        thick.set_value(float(np.mean(self.wafer.sampleThick[self.selection])))
+        notesCheck = Gtk.CheckButton(label="Notes")
+        notes = Gtk.Entry()
+        grid = Gtk.Grid(row_spacing=6, column_spacing=6)
+        grid.attach(Gtk.Label(label="Status"), 0, 0, 1, 1)
+        grid.attach(status,     1, 0, 1, 1)
+        grid.attach(thickCheck, 0, 1, 1, 1)
+        grid.attach(thick,      1, 1, 1, 1)
+        grid.attach(notesCheck, 0, 2, 1, 1)
+        grid.attach(notes,      1, 2, 1, 1)
+
+        count = int(np.count_nonzero(self.selection))
+        if self.runDialog("Edit %d selected devices" % count, grid, Gtk.STOCK_APPLY):
+            with self.history.grouped():
+                if status.get_active() > 0:
+                    self.wafer.setSamples(self.selection, "status", status.get_active())
+                if thickCheck.get_active():
+                    self.wafer.setSamples(self.selection, "thick", thick.get_value())
+                if notesCheck.get_active():
+                    self.wafer.setSamples(self.selection, "notes", notes.get_text())
+            self.queue_draw()
+
+    def queueStatsUpdate(self, change=None):
+        """Refresh the statistics line once the current burst of edits is over"""
+        if not self.statsQueued:
+            self.statsQueued = True
+            GLib.idle_add(self.updateStats)
+
+    def updateStats(self):
+        self.statsQueued = False
+        text = "Wafer: " + self.stats.describe()
+        if self.hovered is not None:
+            i, j = self.hovered[:2]
+            text += "\nDie %s: %s" % (self.wafer.dieName(i, j), self.stats.describe(i, j))
+        if self.comparison is not None:
+            text += "\nCompared with %s: %s" % (self.comparisonName, self.getDifferences()[0].describe())
+        if self.searchQuery:
+            from wafersearch import describeMatches
+            text += "\nNotes matching \"%s\": %s" % (self.searchQuery, describeMatches(self.getSearchMatches()[0]))
+        self.statsLabel.set_text(text)
+        return False
+
+    @profiler.timed("click")
+    def onclick (self, box, event):
+        if self.loading() or event.button > 3:
+            return # Back, forward and other extra buttons name no status
         xclick, yclick = event.get_coords()
-        xclick = xclick - 0.5*w 
-        yclick = yclick - 0.5*h 
-
-        hitSample = False
-        for i in range(self.wafer.waferCols):
-            transX = (i-0.5*(self.wafer.waferCols-1))*(DieSizeX+self.wafer.DieMargin)-0.5*DieSizeX
-            if xclick > (transX-4) and xclick < (transX + DieSizeX+8):
-                for j in range(self.wafer.waferRows):
-                    transY = (j-0.5*(self.wafer.waferRows-1))*(DieSizeY+self.wafer.DieMargin)-0.5*DieSizeY
-                    if yclick > (transY-4) and yclick < (transY + DieSizeY + 8):
-                         # We've clicked on a die
-                         for ii in range(self.wafer.dieCols):
-                            transXX = ii*(SampSizeX+self.wafer.SampleMargin)+ transX + self.wafer.SampleMargin
-                            if xclick > transXX and xclick < transXX + SampSizeX:
-                                for jj in range(self.wafer.dieRows):
-                                    transYY = jj*(SampSizeY+self.wafer.SampleMargin)+ transY + self.wafer.SampleMargin
-                                    if yclick >= transYY and yclick <= transYY + SampSizeY:
-                                        # We've clicked on a sample
-                                        hitSample = True
-                                        if event.button == 1:
-                                            self.openDeviceWindow(self.wafer.dies[i][j].samples[ii][jj], i, j, ii, jj)
-                                        if event.button > 1:
-                                            self.wafer.dies[i][j].samples[ii][jj].setStatus(event.button-1)
-                                        self.queue_draw()
-                                        break
-                         # But we didn't click on a sample
-                         if hitSample == False:
-                             self.editDieWindow(self.wafer.dies[i][j])
+        if event.button == 1:
+            # Handled on release, once it is known whether this starts a drag
+            self.dragStart = (xclick, yclick)
+            return
+        hit = self.getLayout().hit(xclick, yclick)
+        if hit is None or self.importing():
+            return
+        if len(hit) == 2:
+            # Inside a die frame but not on a sample
+            i, j = hit
+            self.editDieWindow(self.wafer.dies[i][j])
+            return
+
+        i, j, ii, jj = hit
+        if self.selection is not None and self.selection[hit]:
+            self.applyToSelection("status", event.button-1)
+            return
+        self.wafer.dies[i][j].samples[ii][jj].setStatus(event.button-1)
+        self.queueDrawSample(i, j, ii, jj)
+
+    @profiler.timed("click")
+    def onrelease(self, box, event):
+        """Select the dragged region, or act on a left click
+
+        Clicking a label selects its row or column, and clicking empty space
+        clears the selection. With Shift held regions and labels add to the
+        selection, a die margin adds the whole die and a device is toggled.
+        """
+        if event.button != 1 or self.dragStart is None or self.loading():
+            return
+        self.dragStart = None
+        band, self.dragBand = self.dragBand, None
+        extend = bool(event.get_state() & Gdk.ModifierType.SHIFT_MASK)
+        layout = self.getLayout()
+        if band is not None:
+            self.select(layout.samplesInRect(*band), extend)
+            return
 
-    def calcWedge(self, event):
-        coords = []
-        thicks = []
-
-        for i in range(self.wafer.waferCols):
-            for j in range(self.wafer.waferRows):
-                if self.wafer.dies[i][j].thickTopRight != 0.0:
-                    coords.append(self.getGratingCoords(i,j,1))
-                    thicks.append(self.wafer.dies[i][j].thickTopRight)
-                if self.wafer.dies[i][j].thickTopLeft != 0.0:
-                    coords.append(self.getGratingCoords(i,j,2))
-                    thicks.append(self.wafer.dies[i][j].thickTopLeft)
-                if self.wafer.dies[i][j].thickBotLeft != 0.0:
-                    coords.append(self.getGratingCoords(i,j,3))
-                    thicks.append(self.wafer.dies[i][j].thickBotLeft)
-                if self.wafer.dies[i][j].thickBotRight != 0.0:
-                    coords.append(self.getGratingCoords(i,j,4))
-                    thicks.append(self.wafer.dies[i][j].thickBotRight)
-
-        coords = np.array(coords)
-        thicks = np.array(thicks)
-
-        def bilinear(v):
-            mx, my, c = v
-            return thicks - (mx*np.array(coords[:,0]) + my*np.array(coords[:,1]) + c)
-
-        v0 = [0.1,-0.1,5.0]
-        popt, success = leastsq(bilinear, v0, maxfev=10000)
-        
-        self._("labelMx").set_label("mx: %g" % popt[0])
-        self._("labelMy").set_label("my: %g" % popt[1])
-        self._("labelC").set_label("c: %g" % popt[2])
-        self.wafer.wedgeMx = popt[0]
-        self.wafer.wedgeMy = popt[1]
-        self.wafer.wedgeC  = popt[2]
+        xclick, yclick = event.get_coords()
+        hit = layout.hit(xclick, yclick)
+        if hit is None:
+            label = layout.hitLabel(xclick, yclick)
+            if label is not None:
+                self.select(self.labelSelection(label), extend)
+            elif not extend:
+                self.select(None)
+        elif extend and len(hit) == 2:
+            mask = np.zeros(self.wafer.sampleStatus.shape, dtype=bool)
+            mask[hit] = True
+            self.select(mask, True)
+        elif extend:
+            self.toggleSelected(*hit)
+        elif self.importing():
+            return
+        elif len(hit) == 2:
+            i, j = hit
+            self.editDieWindow(self.wafer.dies[i][j])
+        else:
+            i, j, ii, jj = hit
+            self.openDeviceWindow(self.wafer.dies[i][j].samples[ii][jj], i, j, ii, jj)
+            self.queueDrawSample(i, j, ii, jj)
+
+    def drag(self, x, y):
+        """Stretch the rubber band to (x, y) once the pointer has moved far enough"""
+        x0, y0 = self.dragStart
+        if self.dragBand is None and abs(x - x0) + abs(y - y0) <= DRAG_THRESHOLD:
+            return
+        old, self.dragBand = self.dragBand, (x0, y0, x, y)
+        if old is not None:
+            self.queueDrawRect(min(old[0], old[2], x), min(old[1], old[3], y),
+                               max(old[0], old[2], x), max(old[1], old[3], y))
+        else:
+            self.queueDrawRect(*self.dragBand)
+
+    def onhover(self, box, event):
+        if self.loading():
+            return
+        if self.dragStart is not None:
+            self.drag(event.x, event.y)
+        hit = self.getLayout().hit(event.x, event.y)
+        if hit == self.hovered:
+            return
+        self.hovered = hit
+        box.set_tooltip_text(self.describe(hit))
+        self.updateStats()
+
+    def describe(self, hit):
+        """Short tooltip text for a layout hit"""
+        if hit is None:
+            return None
+        die = self.wafer.dies[hit[0]][hit[1]]
+        if len(hit) == 2:
+            text = die.name
+            notes = die.notes
+        else:
+            sample = die.samples[hit[2]][hit[3]]
+            text = "%s %s: %s" % (die.name, sample.name, STATUS_NAMES.get(sample.status, sample.status))
+            notes = sample.notes
+        if notes:
+            text += "\n" + notes
+        return text
 
+    def calcWedge(self, event):
+        self.refitWedge()
         dialogResponse = self._("wedgeWindow").run()
 
         self._("wedgeWindow").hide()
 
+    @profiler.timed("wedge")
+    def refitWedge(self, widget=None):
+        """Fit with the surface options chosen in the wedge dialog and show the result"""
+        order  = self._("wedgeOrder").get_active() + 1
+        robust = self._("wedgeRobust").get_active()
+        try:
+            fit = self.wafer.fitWedge(order, robust)
+        except ValueError as e:
+            for name in ("labelMx", "labelMy", "labelC", "labelResidual"):
+                self._(name).set_label("")
+            self._("labelC1").set_label(str(e))
+            return
+
+        self._("labelMx").set_label("mx: %g" % fit.mx)
+        self._("labelMy").set_label("my: %g" % fit.my)
+        self._("labelC").set_label("c: %g" % fit.c)
+        self._("labelResidual").set_label("rms: %.3g  max: %.3g  (%d points, %d outliers)" %
+                                          (fit.rms, fit.maxResidual, fit.points, fit.outliers))
+        if order == 1:
+            self._("labelC1").set_label("mx*x + my*y + c = thick")
+        else:
+            import waferfit
+            terms = ["%g*x^%d*y^%d" % (c, px, py) for c, (px, py)
+                     in zip(fit.coeffs, waferfit.polyTerms(order))]
+            self._("labelC1").set_label(" + ".join(terms) + " = thick")
+        if self.colorField in ("wedge", "predicted"):
+            self.heatmap = None
+            self.queue_draw()
+
 def destroy(window):
     Gtk.main_quit()
-       
+
+# Keys of Edit menu accelerators (select all, edit selection, undo, redo)
+# that mean text editing while a text entry has the focus
+TEXT_KEYS = set([Gdk.KEY_a, Gdk.KEY_A, Gdk.KEY_e, Gdk.KEY_E, Gdk.KEY_z, Gdk.KEY_Z, Gdk.KEY_y, Gdk.KEY_Y])
+
+def keyPress(window, event):
+    """Give a focused text entry the keys it uses before the menu accelerators see them"""
+    if not isinstance(window.get_focus(), Gtk.Editable):
+        return False
+    return window.propagate_key_event(event) or event.keyval in TEXT_KEYS
+
+class StartupTimer(object):
+    """Time spent in each start-up phase, reported once the first frame is drawn"""
+    def __init__(self, start):
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        now = clock()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = sum(t for phase, t in self.phases)
+        for phase, t in self.phases + [("total", total)]:
+            sys.stderr.write("%-12s %8.1f ms\n" % (phase, 1000.0*t))
+
 def main():
-    
+    args = sys.argv[1:]
+    timing = "--startup-timing" in args or bool(os.environ.get("WAFERTRACKER_STARTUP_TIMING"))
+    args = [a for a in args if a != "--startup-timing"]
+    timer = StartupTimer(startupTime)
+    timer.mark("imports")
+
     builder = Gtk.Builder()
     builder.add_from_file("interface.glade")
     window = builder.get_object("mainWindow")
     box = builder.get_object("mainBox")
+    timer.mark("builder")
 
-    app = WaferDisplay()
+    app = WaferDisplay(builder)
 
-    if len(sys.argv) > 1:
-        app.loadWithArg(sys.argv[1])
+    if len(args) > 0:
+        # Read in the background while the window comes up, so "load" is the wait left once it is shown
+        app.loadWithArg(args[0], lambda: timer.mark("load"))
                       
     app.connect('draw', app.do_draw_cb)
     eventbox = Gtk.EventBox()
     eventbox.set_above_child(True)
     eventbox.connect("button-press-event", app.onclick)
+    eventbox.connect("button-release-event", app.onrelease)
+    eventbox.add_events(Gdk.EventMask.POINTER_MOTION_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK)
+    eventbox.connect("motion-notify-event", app.onhover)
     eventbox.add(app)
+    box.pack_end(app.progressBox, False, False, 2)
+    box.pack_end(app.statsLabel, False, False, 2)
+    box.pack_end(app.searchEntry, False, False, 2)
     box.pack_end(eventbox, True, True, 0)
 
     builder.get_object("newMenu").connect('activate', app.newWaferWindow)
     builder.get_object("saveMenu").connect('activate', app.save)
     builder.get_object("saveasMenu").connect('activate', app.saveas)
+    builder.get_object("importMenu").connect('activate', app.importMeasurements)
+    builder.get_object("exportMenu").connect('activate', app.exportMap)
     builder.get_object("openMenu").connect('activate', app.load)
     builder.get_object("quitMenu").connect('activate', destroy)
     builder.get_object("menuWaferProps").connect('activate', app.editWaferWindow)
+    builder.get_object("undoMenu").connect('activate', app.undo)
+    builder.get_object("redoMenu").connect('activate', app.redo)
+    builder.get_object("selectAllMenu").connect('activate', app.selectAll)
+    builder.get_object("selectNoneMenu").connect('activate', app.selectNone)
+    builder.get_object("editSelectionMenu").connect('activate', app.editSelectionWindow)
+    builder.get_object("findNotesMenu").connect('activate', app.findNotes)
     builder.get_object("menuCalcWedge").connect('activate', app.calcWedge)
+    builder.get_object("compareMenu").connect('activate', app.compareWith)
+    builder.get_object("stopCompareMenu").connect('activate', app.stopComparing)
+    for menu, field, title in COLOR_MENUS:
+        builder.get_object(menu).connect('toggled', app.setColorField, field)
+    builder.get_object("menuExportPredicted").connect('activate', app.exportPredicted)
+    builder.get_object("menuProfiling").set_active(profiler.enabled)
+    builder.get_object("menuProfiling").connect('toggled', app.toggleProfiling)
+    builder.get_object("menuCaptureProfile").connect('activate', app.captureProfile)
     builder.get_object("menuPrint").connect('activate', app.onPrintRequest)
+    window.connect('key-press-event', keyPress)
+    window.connect('destroy', lambda window: app.closeJournals())
+    window.connect('destroy', lambda window: profiler.report())
     window.connect_after('destroy', destroy)
     window.show_all()        
+    timer.mark("show")
+
+    if timing:
+        def firstDraw(widget, cr):
+            if app.loading():
+                return # The first frame worth timing shows the file
+            timer.mark("first draw")
+            timer.report()
+            app.disconnect(handler)
+        handler = app.connect_after('draw', firstDraw)
     Gtk.main()
        
 if __name__ == "__main__":
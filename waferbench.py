@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""Benchmarks of loading, saving, drawing, hit-testing and wedge fitting
+
+Synthetic wafers of several sizes are filled with random statuses,
+thicknesses and notes, and each operation is timed a few times on each.
+Results are printed (or written with -o) as JSON; passing an earlier result
+file with --baseline reports every case whose time or peak memory grew more
+than the tolerance allows and exits with status 1, so the run can guard
+against regressions. Memory is traced with tracemalloc, so it covers the
+allocations of each case alone; under Python 2 it is reported as n/a.
+
+    python waferbench.py -o baseline.json
+    python waferbench.py --baseline baseline.json
+
+Drawing and hit-testing use the same WaferRenderer and WaferLayout calls as
+do_draw_cb and onclick, rendering into an offscreen cairo.ImageSurface; they
+are skipped when cairo or Pango are not installed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from waferio import readWaferXML, writeWaferXML, readWaferBinary, writeWaferBinary
+from waferprofile import clock
+from wafertesting import syntheticWafer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2, which has no per-case measure of memory
+
+# Name: (waferRows, waferCols, dieRows, dieCols)
+SIZES = [("small",  (5, 5, 5, 7)),
+         ("medium", (12, 12, 10, 10)),
+         ("large",  (25, 25, 16, 16)),
+         ("huge",   (40, 40, 25, 25))]
+
+class Case(object):
+    """One benchmarked operation; setup runs untimed, run is timed"""
+    def __init__(self, name, setup, run):
+        self.name = name
+        self.setup = setup
+        self.run = run
+
+def ioCases(workdir):
+    xmlFile = os.path.join(workdir, "bench.xml")
+    wfbFile = os.path.join(workdir, "bench.wfb")
+    def readBinary(w):
+        r = readWaferBinary(wfbFile)
+        r.loadNotes()
+        np.sum(r.sampleThick) # Touch the mapped pages
+    return [Case("xml-write",    lambda w: None,                        lambda w, s: writeWaferXML(w, xmlFile)),
+            Case("xml-read",     lambda w: writeWaferXML(w, xmlFile),    lambda w, s: readWaferXML(xmlFile)),
+            Case("binary-write", lambda w: None,                        lambda w, s: writeWaferBinary(w, wfbFile)),
+            Case("binary-read",  lambda w: writeWaferBinary(w, wfbFile), lambda w, s: readBinary(w))]
+
+def fitCases():
+    return [Case("wedge-fit",        lambda w: None, lambda w, s: w.fitWedge(1)),
+            Case("wedge-fit-robust", lambda w: None, lambda w, s: w.fitWedge(2, robust=True))]
+
+def drawCases(width, height, clicks):
+    try:
+        import cairo
+        from waferrender import WaferLayout, WaferRenderer
+    except (ImportError, ValueError) as e:
+        sys.stderr.write("Skipping drawing benchmarks: %s\n" % e)
+        return []
+
+    def render(w, state):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        # A fresh renderer each time, as after opening a wafer
+        WaferRenderer().render(cairo.Context(surface), w, WaferLayout(w, width, height))
+
+    def clickSetup(w):
+        rng = np.random.RandomState(1)
+        return WaferLayout(w, width, height), rng.uniform(0, width, clicks), rng.uniform(0, height, clicks)
+
+    def click(w, state):
+        layout, xs, ys = state
+        for x, y in zip(xs, ys):
+            layout.hit(x, y)
+
+    return [Case("render", lambda w: None, render),
+            Case("hit-test", clickSetup, click)]
+
+def measure(case, wafer, repeat):
+    """Best and median time of repeat runs, plus the peak memory of one run if it can be traced"""
+    state = case.setup(wafer)
+    times = []
+    for n in range(repeat):
+        start = clock()
+        case.run(wafer, state)
+        times.append(clock() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        case.run(wafer, state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"best": min(times), "median": float(np.median(times)), "peakBytes": peak}
+
+def formatBytes(size):
+    return "n/a" if size is None else "%.1f MB" % (size/1048576.0)
+
+def runBenchmarks(sizes, repeat=5, width=800, height=800, clicks=10000, only=None):
+    workdir = tempfile.mkdtemp(prefix="waferbench")
+    try:
+        cases = ioCases(workdir) + fitCases() + drawCases(width, height, clicks)
+        if only:
+            cases = [case for case in cases if case.name in only]
+        results = []
+        for sizeName, shape in sizes:
+            wafer = syntheticWafer(*shape)
+            for case in cases:
+                result = {"case": case.name, "size": sizeName,
+                          "devices": int(wafer.sampleStatus.size)}
+                result.update(measure(case, wafer, repeat))
+                results.append(result)
+                sys.stderr.write("%-17s %-7s %10.2f ms %10s\n" % (case.name, sizeName, 1000.0*result["best"],
+                                                                  formatBytes(result["peakBytes"])))
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+def compareToBaseline(results, baseline, tolerance):
+    """Cases whose best time or peak memory grew by more than tolerance
+
+    Returned as (case, size, key, old, new) with key "best" or "peakBytes".
+    Memory is only compared where both runs could trace it.
+    """
+    previous = dict(((r["case"], r["size"]), r) for r in baseline["results"])
+    worse = []
+    for r in results:
+        old = previous.get((r["case"], r["size"]))
+        if old is None:
+            continue
+        for key in ("best", "peakBytes"):
+            if old.get(key) is not None and r[key] is not None and r[key] > old[key]*(1.0 + tolerance):
+                worse.append((r["case"], r["size"], key, old[key], r[key]))
+    return worse
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Benchmark WaferTracker on synthetic wafers")
+    parser.add_argument("--sizes", default="small,medium,large",
+                        help="comma separated, from: " + ", ".join(name for name, shape in SIZES))
+    parser.add_argument("--only", default=None, help="comma separated case names to run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--clicks", type=int, default=10000, help="hit tests per hit-test run")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON results here")
+    parser.add_argument("--baseline", default=None, help="earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed growth of time and memory against the baseline (0.25 is 25%%)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    known = dict(SIZES)
+    sizes = [(name, known[name]) for name in args.sizes.split(",")]
+    only = args.only.split(",") if args.only else None
+    report = {"python":  platform.python_version(),
+              "numpy":   np.__version__,
+              "machine": platform.machine(),
+              "results": runBenchmarks(sizes, args.repeat, clicks=args.clicks, only=only)}
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            worse = compareToBaseline(report["results"], json.load(f), args.tolerance)
+        for case, size, key, old, new in worse:
+            if key == "best":
+                sys.stderr.write("SLOWER %s %s: %.2f ms -> %.2f ms\n" % (case, size, 1000.0*old, 1000.0*new))
+            else:
+                sys.stderr.write("LARGER %s %s: %s -> %s\n" % (case, size, formatBytes(old), formatBytes(new)))
+        return 1 if worse else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+"""Batch processing of wafer files without a display
+
+Each command runs over every wafer file named on the command line, where
+a directory stands for all wafer files inside it and glob patterns are
+expanded even if the shell did not. Files are spread over a pool of
+worker processes and results are printed as tab-separated lines in the
+order the files were given.
+"""
+
+import argparse
+import functools
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from wafercore import STATUS_NAMES
+from waferio import readWafer, writeWafer, BINARY_EXTENSION
+from waferdiff import WaferDiff, mergeWafers, plain
+from waferimport import importMeasurements
+from wafersearch import NotesIndex, notesOf
+from waferstore import WaferStore
+from waferstats import YieldStats
+from waferthick import predictThickness, writeThicknessTable
+
+WAFER_EXTENSIONS = (".xml", BINARY_EXTENSION)
+
+def findWaferFiles(paths):
+    """Expand directories and glob patterns into a sorted, de-duplicated file list"""
+    found = []
+    for path in paths:
+        matches = sorted(glob.glob(path)) or [path]
+        for match in matches:
+            if os.path.isdir(match):
+                found.extend(sorted(os.path.join(match, name) for name in os.listdir(match)
+                                    if os.path.splitext(name)[1].lower() in WAFER_EXTENSIONS))
+            else:
+                found.append(match)
+    seen = set()
+    return [f for f in found if not (f in seen or seen.add(f))]
+
+def outputName(filename, outputDir, extension):
+    base = os.path.splitext(os.path.basename(filename))[0] + extension
+    return os.path.join(outputDir or os.path.dirname(filename), base)
+
+SUMMARY_COLUMNS = (["file", "wafer", "dies", "devices"] + [STATUS_NAMES[s] for s in (1, 2, 3)] +
+                   ["yield", "thickMean", "thickStd"])
+
+def summaryTask(filename, options):
+    wafer = readWafer(filename)
+    stats = YieldStats(wafer)
+    fraction = stats.yieldFraction()
+    thick = stats.thickness()
+    return ([filename, wafer.name, wafer.waferCols*wafer.waferRows, wafer.sampleStatus.size] +
+            list(stats.counts()) +
+            ["%.1f%%" % (100.0*fraction) if fraction is not None else "-",
+             "%g" % thick.mean if thick.count else "-",
+             "%g" % thick.std if thick.count else "-"])
+
+WEDGE_COLUMNS = ["file", "wafer", "order", "mx", "my", "c", "rms", "maxResidual", "points", "outliers"]
+
+def wedgeTask(filename, options):
+    wafer = readWafer(filename)
+    fit = wafer.fitWedge(options["order"], options["robust"])
+    if options["save"]:
+        writeWafer(wafer, filename)
+    return [filename, wafer.name, fit.order, "%g" % fit.mx, "%g" % fit.my, "%g" % fit.c,
+            "%g" % fit.rms, "%g" % fit.maxResidual, fit.points, fit.outliers]
+
+CONVERT_COLUMNS = ["file", "output"]
+
+def convertTask(filename, options):
+    extension = BINARY_EXTENSION if options["to"] == "wfb" else ".xml"
+    destination = outputName(filename, options["outputDir"], extension)
+    if os.path.abspath(destination) == os.path.abspath(filename):
+        raise ValueError("refusing to convert %s onto itself" % filename)
+    writeWafer(readWafer(filename), destination)
+    return [filename, destination]
+
+EXPORT_COLUMNS = ["file", "output"]
+
+def exportTask(filename, options):
+    # Imported here so the other commands do not need Pango
+    from waferrender import exportWafer
+    destination = outputName(filename, options["outputDir"], "." + options["format"])
+    exportWafer(readWafer(filename), destination, options["width"], options["height"], options["scale"])
+    return [filename, destination]
+
+PREDICT_COLUMNS = ["file", "output", "devices", "predicted", "fromFit", "min", "max"]
+
+def predictTask(filename, options):
+    wafer = readWafer(filename)
+    if options["order"] is not None:
+        wafer.fitWedge(options["order"])
+    predicted = predictThickness(wafer)
+    destination = outputName(filename, options["outputDir"], ".csv")
+    writeThicknessTable(wafer, destination, predicted)
+    known = predicted[~np.isnan(predicted)]
+    # Devices of dies with an unmeasured corner rely on the wedge fit
+    partial = (wafer.dieThick == 0.0).any(axis=2)
+    fromFit = int(np.sum(~np.isnan(predicted[partial])))
+    return [filename, destination, predicted.size, known.size, fromFit,
+            "%g" % known.min() if known.size else "", "%g" % known.max() if known.size else ""]
+
+IMPORT_COLUMNS = ["file", "lot", "wafer"]
+
+def importCommand(args):
+    """Load wafer files into a store; SQLite takes one writer, so this runs in-process"""
+    store = WaferStore(args.store)
+    failed = 0
+    print("\t".join(IMPORT_COLUMNS))
+    try:
+        for filename in findWaferFiles(args.paths):
+            try:
+                wafer = readWafer(filename)
+                store.importWafer(wafer, args.lot)
+            except Exception as e:
+                failed += 1
+                sys.stderr.write("%s: %s\n" % (filename, e))
+                continue
+            print("\t".join([filename, args.lot, wafer.name]))
+    finally:
+        store.close()
+    return 1 if failed else 0
+
+QUERY_COLUMNS = ["lot", "wafer", "die", "device", "status", "thick"]
+
+def queryCommand(args):
+    statusCodes = dict((name, code) for code, name in STATUS_NAMES.items())
+    store = WaferStore(args.store)
+    try:
+        rows = store.findSamples(lot=args.lot, wafer=args.wafer,
+                                 status=statusCodes.get(args.status),
+                                 thickMin=args.thick[0] if args.thick else None,
+                                 thickMax=args.thick[1] if args.thick else None)
+    finally:
+        store.close()
+    print("\t".join(QUERY_COLUMNS))
+    for lot, wafer, die, device, status, thick in rows:
+        print("\t".join([lot, wafer, die, device, STATUS_NAMES.get(status, str(status)), "%g" % thick]))
+    return 0
+
+APPLY_COLUMNS = ["table", "rows", "matched", "unmatched", "otherWafers"]
+
+def applyCommand(args):
+    """Import measurement tables into one wafer file, in order, then save it"""
+    wafer = readWafer(args.wafer)
+    print("\t".join(APPLY_COLUMNS))
+    for table in args.tables:
+        report = importMeasurements(wafer, table, tolerance=args.tolerance)
+        print("\t".join(str(value) for value in
+                        [table, report.rows, report.matched, report.failed, report.skipped]))
+        for line, reason in report.failures:
+            sys.stderr.write("%s:%d: %s\n" % (table, line, reason))
+        if report.failed > len(report.failures):
+            sys.stderr.write("%s: %d more unmatched rows\n" % (table, report.failed - len(report.failures)))
+    writeWafer(wafer, args.output or args.wafer)
+    return 0
+
+def location(wafer, kind, index):
+    """Die and device columns naming what a difference or conflict is about"""
+    if kind == "wafer":
+        return ["", ""]
+    die = wafer.dieName(*index[:2])
+    return [die, wafer.sampleName(*index[2:]) if kind == "sample" else ""]
+
+def cell(value):
+    """A value as one tab-separated cell, notes included"""
+    return ("%s" % (value,)).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+DIFF_COLUMNS = ["kind", "die", "device", "field", "a", "b"]
+
+def diffCommand(args):
+    """List what differs between two copies of a wafer; exits with 1 if anything does"""
+    a, b = readWafer(args.a), readWafer(args.b)
+    diff = WaferDiff(a, b)
+    print("\t".join(DIFF_COLUMNS))
+    for kind, index, field, old, new in diff.records():
+        print("\t".join([kind] + location(a, kind, index) + [field, cell(old), cell(new)]))
+    sys.stderr.write("%s\n" % diff.describe())
+    return 1 if len(diff) else 0
+
+MERGE_COLUMNS = ["kind", "die", "device", "field", "base", "ours", "theirs"]
+
+def mergeCommand(args):
+    """Three-way merge of two copies of a wafer; exits with 1 if there are conflicts"""
+    base, ours, theirs = readWafer(args.base), readWafer(args.ours), readWafer(args.theirs)
+    merged, conflicts = mergeWafers(base, ours, theirs)
+    writeWafer(merged, args.output)
+    print("\t".join(MERGE_COLUMNS))
+    count = 0
+    for c in conflicts:
+        for n in range(len(c.ours)):
+            index = tuple(int(a[n]) for a in c.index)
+            print("\t".join([c.kind] + location(merged, c.kind, index) + [c.field] +
+                            [cell(plain(values[n])) for values in (c.base, c.ours, c.theirs)]))
+            count += 1
+    sys.stderr.write("%d conflicts, marked in the notes of %s\n" % (count, args.output) if count else
+                     "merged without conflicts into %s\n" % args.output)
+    return 1 if count else 0
+
+def notesTask(filename, options):
+    """The notes of one wafer, each with the die and device it is about"""
+    wafer = readWafer(filename)
+    notes = notesOf(wafer)
+    return wafer.name, notes, [location(wafer, kind, index) for kind, index, text in notes]
+
+SEARCH_COLUMNS = ["file", "wafer", "kind", "die", "device", "note"]
+KIND_ORDER = {"wafer": 0, "die": 1, "sample": 2}
+
+def searchCommand(args):
+    """Notes matching a query across wafer files, read in parallel into one index"""
+    filenames = findWaferFiles(args.paths)
+    index = NotesIndex()
+    names, places = {}, {}
+    failed = 0
+    for filename, (ok, result) in zip(filenames, runAll(notesTask, {}, filenames, args.jobs)):
+        if not ok:
+            failed += 1
+            sys.stderr.write(result + "\n")
+            continue
+        names[filename], notes, locations = result
+        index.addNotes(filename, notes)
+        for (kind, where, text), place in zip(notes, locations):
+            places[(filename, kind, tuple(where))] = place
+    order = dict((filename, n) for n, filename in enumerate(filenames))
+    keys = sorted(index.search(args.query), key=lambda key: (order[key[0]], KIND_ORDER[key[1]], key[2]))
+    print("\t".join(SEARCH_COLUMNS))
+    for key in keys:
+        filename, kind = key[:2]
+        print("\t".join([filename, names[filename], kind] + places[key] + [cell(index.texts[key])]))
+    sys.stderr.write("%d notes in %d files match\n" % (len(keys), len(set(key[0] for key in keys))))
+    return 1 if failed else 0
+
+def runTask(task, options, filename):
+    """Run one task, turning failures into a message so one bad file does not stop the batch"""
+    try:
+        return True, task(filename, options)
+    except Exception as e:
+        return False, "%s: %s" % (filename, e)
+
+def runAll(task, options, filenames, jobs):
+    work = functools.partial(runTask, task, options)
+    if jobs == 1:
+        return [work(f) for f in filenames]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(work, filenames))
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Batch processing of wafer files")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: one per CPU, 1 runs in-process)")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    summary = commands.add_parser("summary", help="device yield per wafer")
+    summary.set_defaults(task=summaryTask, columns=SUMMARY_COLUMNS)
+
+    wedge = commands.add_parser("wedge", help="fit the thickness wedge of each wafer")
+    wedge.add_argument("--order", type=int, default=1, help="polynomial order of the surface")
+    wedge.add_argument("--robust", action="store_true", help="down-weight outlying gratings")
+    wedge.add_argument("--save", action="store_true", help="store the fit back into each file")
+    wedge.set_defaults(task=wedgeTask, columns=WEDGE_COLUMNS)
+
+    convert = commands.add_parser("convert", help="convert between the XML and binary formats")
+    convert.add_argument("--to", choices=["xml", "wfb"], required=True)
+    convert.add_argument("-o", "--output-dir", dest="outputDir", default=None)
+    convert.set_defaults(task=convertTask, columns=CONVERT_COLUMNS)
+
+    export = commands.add_parser("export", help="render a wafer map of each wafer, no display needed")
+    export.add_argument("--format", choices=["png", "pdf", "svg"], default="png")
+    export.add_argument("--width", type=int, default=800, help="map size in points")
+    export.add_argument("--height", type=int, default=800)
+    export.add_argument("--scale", type=float, default=1.0,
+                        help="PNG pixels per point, e.g. 4 for print resolution")
+    export.add_argument("-o", "--output-dir", dest="outputDir", default=None)
+    export.set_defaults(task=exportTask, columns=EXPORT_COLUMNS)
+
+    predict = commands.add_parser("predict", help="write measured and predicted thickness of every device as CSV")
+    predict.add_argument("--order", type=int, default=None,
+                         help="refit the wedge with this order first, for dies with unmeasured corners")
+    predict.add_argument("-o", "--output-dir", dest="outputDir", default=None)
+    predict.set_defaults(task=predictTask, columns=PREDICT_COLUMNS)
+
+    storeImport = commands.add_parser("import", help="load wafer files into a lot store")
+    storeImport.add_argument("store", help="store file (.wdb), created if missing")
+    storeImport.add_argument("--lot", default="", help="lot the wafers belong to")
+    storeImport.set_defaults(run=importCommand)
+
+    query = commands.add_parser("query", help="find devices across the wafers of a lot store")
+    query.add_argument("store", help="store file (.wdb)")
+    query.add_argument("--lot", default=None)
+    query.add_argument("--wafer", default=None)
+    query.add_argument("--status", choices=[STATUS_NAMES[s] for s in (1, 2, 3)])
+    query.add_argument("--thick", type=float, nargs=2, metavar=("MIN", "MAX"))
+    query.set_defaults(run=queryCommand)
+
+    applyTables = commands.add_parser("apply", help="import measurement CSV/TSV tables into a wafer file")
+    applyTables.add_argument("wafer", help="wafer file, saved in place unless -o is given")
+    applyTables.add_argument("tables", nargs="+", help="tables with die and device, name, or x and y columns")
+    applyTables.add_argument("--tolerance", type=float, default=None,
+                             help="largest distance in mm from x, y to a device (default half its spacing)")
+    applyTables.add_argument("-o", "--output", default=None, help="save the result here instead")
+    applyTables.set_defaults(run=applyCommand)
+
+    diff = commands.add_parser("diff", help="list the differences between two copies of a wafer")
+    diff.add_argument("a", help="wafer file")
+    diff.add_argument("b", help="another copy of the same wafer")
+    diff.set_defaults(run=diffCommand)
+
+    merge = commands.add_parser("merge", help="three-way merge of two copies of a wafer")
+    merge.add_argument("base", help="the copy both were made from")
+    merge.add_argument("ours", help="edited copy whose values win conflicts")
+    merge.add_argument("theirs", help="edited copy whose other changes are taken")
+    merge.add_argument("-o", "--output", required=True, help="merged wafer file")
+    merge.set_defaults(run=mergeCommand)
+
+    search = commands.add_parser("search", help="find notes mentioning words across wafer files")
+    search.add_argument("query", help="words every matching note contains, each as a word prefix")
+    search.set_defaults(run=searchCommand)
+
+    for sub in (summary, wedge, convert, export, predict, storeImport, search):
+        sub.add_argument("paths", nargs="+", help="wafer files, directories or glob patterns")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    if getattr(args, "run", None) is not None:
+        return args.run(args)
+    options = dict((name, value) for name, value in vars(args).items()
+                   if name not in ("task", "columns", "paths", "jobs", "command"))
+    filenames = findWaferFiles(args.paths)
+    if options.get("outputDir") and not os.path.isdir(options["outputDir"]):
+        os.makedirs(options["outputDir"])
+
+    print("\t".join(args.columns))
+    failed = 0
+    for ok, result in runAll(args.task, options, filenames, args.jobs):
+        if ok:
+            print("\t".join(str(value) for value in result))
+        else:
+            failed += 1
+            sys.stderr.write(result + "\n")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
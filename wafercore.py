@@ -0,0 +1,463 @@
+#!/usr/bin/python
+"""GUI-free wafer model: Wafer with its per-field arrays, and Die/Sample views"""
+
+import collections
+import numpy as np
+
+class Sample(object):
+    """View of a single device, backed by the arrays of its Wafer"""
+    def __init__(self, wafer, i, j, ii, jj):
+        self.wafer = wafer
+        self.index = (i, j, ii, jj)
+    def __str__(self):
+        return self.name
+    @property
+    def name(self):
+        i, j, ii, jj = self.index
+        return self.wafer.sampleName(ii, jj)
+    @property
+    def status(self):
+        return int(self.wafer.sampleStatus[self.index]) # 3 Unmeasured, 2 Dead, 1 Alive
+    @status.setter
+    def status(self, value):
+        self.wafer.setField("sample", self.index, "status", value)
+    @property
+    def thick(self):
+        return float(self.wafer.sampleThick[self.index])
+    @thick.setter
+    def thick(self, value):
+        self.wafer.setField("sample", self.index, "thick", value)
+    @property
+    def sizeX(self):
+        return float(self.wafer.sampleSizeX[self.index])
+    @sizeX.setter
+    def sizeX(self, value):
+        self.wafer.setField("sample", self.index, "sizeX", value)
+    @property
+    def sizeY(self):
+        return float(self.wafer.sampleSizeY[self.index])
+    @sizeY.setter
+    def sizeY(self, value):
+        self.wafer.setField("sample", self.index, "sizeY", value)
+    @property
+    def notes(self):
+        return self.wafer.sampleNotes.get(self.index, "")
+    @notes.setter
+    def notes(self, value):
+        self.wafer.setField("sample", self.index, "notes", value)
+    def setStatus(self, status):
+        if self.status == status and self.status != 3:
+            self.status = 3
+        else:
+            self.status = status
+
+class Die(object):
+    """View of a single die, backed by the arrays of its Wafer"""
+    def __init__(self, wafer, i, j):
+        self.wafer = wafer
+        self.index = (i, j)
+        self.rows = wafer.dieRows
+        self.cols = wafer.dieCols
+        # Access the samples as samples[ii][jj]
+        self.samples = Grid(self.cols, self.rows, lambda ii, jj: Sample(wafer, i, j, ii, jj))
+
+    def __str__(self):
+        return self.name
+    @property
+    def name(self):
+        i, j = self.index
+        return self.wafer.dieName(i, j)
+    @property
+    def status(self):
+        return int(self.wafer.dieStatus[self.index])
+    @status.setter
+    def status(self, value):
+        self.wafer.setField("die", self.index, "status", value)
+    @property
+    def notes(self):
+        return self.wafer.dieNotes.get(self.index, "")
+    @notes.setter
+    def notes(self, value):
+        self.wafer.setField("die", self.index, "notes", value)
+
+def cornerProperty(corner):
+    """Die attribute for the grating thickness at one corner"""
+    def fget(self):
+        return self.wafer.getField("die", self.index, corner)
+    def fset(self, value):
+        self.wafer.setField("die", self.index, corner, value)
+    return property(fget, fset)
+
+# Die corners follow the getGratingCoords quadrant convention
+CORNERS = ["thickTopRight", "thickTopLeft", "thickBotLeft", "thickBotRight"]
+# Position of each corner grating relative to the die centre in mm
+GRATING_OFFSETS = [(2.00, 3.05), (-2.00, 3.05), (-2.00, -3.05), (2.00, -3.05)]
+for corner in CORNERS:
+    setattr(Die, corner, cornerProperty(corner))
+
+def setNote(notes, index, value):
+    """Store a note in a sparse notes dict, dropping empty ones"""
+    if value:
+        notes[index] = value
+    else:
+        notes.pop(index, None)
+
+class Grid(object):
+    """Lazy 2D accessor so that views can be reached as grid[col][row]"""
+    def __init__(self, cols, rows, factory):
+        self.cols = cols
+        self.rows = rows
+        self.factory = factory
+    def __len__(self):
+        return self.cols
+    def __getitem__(self, col):
+        if col < 0 or col >= self.cols:
+            raise IndexError(col)
+        return GridColumn(self, col)
+
+class GridColumn(object):
+    def __init__(self, grid, col):
+        self.grid = grid
+        self.col = col
+    def __len__(self):
+        return self.grid.rows
+    def __getitem__(self, row):
+        if row < 0 or row >= self.grid.rows:
+            raise IndexError(row)
+        return self.grid.factory(self.col, row)
+
+# Per-field model arrays, with the dtype they are stored with on disk
+ARRAY_FIELDS = [("sampleStatus", "|i1"),
+                ("sampleThick",  "<f8"),
+                ("sampleSizeX",  "<f8"),
+                ("sampleSizeY",  "<f8"),
+                ("dieStatus",    "|i1"),
+                ("dieThick",     "<f8")]
+
+# Editable fields of samples and dies, with the array and trailing index holding them.
+# Notes are kept in sparse dicts instead.
+FIELD_ARRAYS = {"sample": {"status": ("sampleStatus", ()),
+                           "thick":  ("sampleThick",  ()),
+                           "sizeX":  ("sampleSizeX",  ()),
+                           "sizeY":  ("sampleSizeY",  ())},
+                "die":    dict([("status", ("dieStatus", ()))] +
+                               [(corner, ("dieThick", (q,))) for q, corner in enumerate(CORNERS)])}
+# Editable attributes of the wafer itself
+WAFER_FIELDS = ["name", "notes", "wedge", "dieSpacingX", "dieSpacingY", "sampleSpacingX", "sampleSpacingY"]
+
+# One edit of the model. kind is "sample", "die" or "wafer", and index is
+# (i, j, ii, jj), (i, j) or () accordingly. Bulk edits of many devices have
+# kind "samples", index arrays (I, J, II, JJ) and arrays (or for notes,
+# lists) of old and new values, one entry per device that changed.
+Change = collections.namedtuple("Change", "kind index field old new")
+
+class Wafer(object):
+    def __init__(self, waferName, waferRows, waferCols, dieRows, dieCols,
+                 startingRowLetter='1', startingColLetter="Q", arrays=None):
+        self.name         = waferName
+        self.notes        = ""
+        self.status       = -1
+        self.waferRows    = waferRows
+        self.waferCols    = waferCols
+        self.dieRows      = dieRows
+        self.dieCols      = dieCols
+
+        self.startingRowLetter = startingRowLetter
+        self.startingColLetter = startingColLetter
+        self.coordTables  = {}
+
+        self.dieSpacingX  = 10.0 # distance between exposures in mm
+        self.dieSpacingY  = 10.0
+        self.sampleSpacingX = 0.75 # distance between samples in mm
+        self.sampleSpacingY = 0.75
+
+        self.SampleMargin = 2    # For display only
+        self.DieMargin    = 15   # For display only
+
+        self.wedge        = 0 # 0 None, 1 Left to Right, 2 Right to left, 3 Bottom to top, 4 top to bottom
+        self.wedgeMx      = 0 
+        self.wedgeMy      = 0
+        self.wedgeC       = 0
+
+        # Full surface from the last fitWedge, see waferfit
+        self.wedgeOrder   = 1
+        self.wedgeRobust  = False
+        self.wedgeCoeffs  = None # Ordered as waferfit.polyTerms(wedgeOrder)
+        self.wedgeRMS     = 0.0
+        self.wedgeMaxResidual = 0.0
+        self.wedgePoints  = 0
+
+        # Per-device data indexed by (i, j, ii, jj), per-die data by (i, j).
+        # Readers may hand over ready-made (e.g. memory-mapped) arrays instead.
+        if arrays is None:
+            shape = (waferCols, waferRows, dieCols, dieRows)
+            arrays = {"sampleStatus": np.full(shape, 3, dtype=np.int8), # 3 Unmeasured, 2 Dead, 1 Alive
+                      "sampleThick":  np.zeros(shape),
+                      "sampleSizeX":  np.zeros(shape),
+                      "sampleSizeY":  np.zeros(shape),
+                      "dieStatus":    np.full((waferCols, waferRows), -1, dtype=np.int8),
+                      "dieThick":     np.zeros((waferCols, waferRows, 4))} # Ordered as CORNERS
+        for field, dtype in ARRAY_FIELDS:
+            setattr(self, field, arrays[field])
+        self._sampleNotes = {}
+        self._dieNotes    = {}
+        self._notesLoader = None
+        self.listeners    = [] # Called with each Change made through setField
+
+        # Access the dies as dies[i][j]
+        self.dies = Grid(waferCols, waferRows, lambda i, j: Die(self, i, j))
+
+    def spacingProperty(name):
+        """Stage spacing attribute whose changes invalidate the coordinate tables"""
+        def fget(self):
+            return getattr(self, "_" + name)
+        def fset(self, value):
+            setattr(self, "_" + name, value)
+            self.coordTables = {}
+        return property(fget, fset)
+    dieSpacingX    = spacingProperty("dieSpacingX")
+    dieSpacingY    = spacingProperty("dieSpacingY")
+    sampleSpacingX = spacingProperty("sampleSpacingX")
+    sampleSpacingY = spacingProperty("sampleSpacingY")
+    del spacingProperty
+
+    def getAllSampleCoords(self):
+        """Stage coordinates (X, Y) of every sample, each shaped like sampleStatus"""
+        if "samples" not in self.coordTables:
+            dieX, dieY = self.dieCenterCoords()
+            offX = self.sampleSpacingX*(np.arange(self.dieCols) - 0.5*(self.dieCols-1))
+            offY = self.sampleSpacingY*((self.dieRows-np.arange(self.dieRows)-1) - 0.5*(self.dieRows-1))
+            X, Y = np.broadcast_arrays(dieX[:,:,None,None] + offX[None,None,:,None],
+                                       dieY[:,:,None,None] + offY[None,None,None,:])
+            self.coordTables["samples"] = self.readOnly(X, Y)
+        return self.coordTables["samples"]
+
+    def getAllGratingCoords(self):
+        """Stage coordinates (X, Y) of every die corner grating, each shaped like dieThick"""
+        if "gratings" not in self.coordTables:
+            dieX, dieY = self.dieCenterCoords()
+            offX, offY = np.array(GRATING_OFFSETS).T
+            X = dieX[:,:,None] + offX[None,None,:]
+            Y = dieY[:,:,None] + offY[None,None,:]
+            self.coordTables["gratings"] = self.readOnly(X, Y)
+        return self.coordTables["gratings"]
+
+    def dieCenterCoords(self):
+        X = self.dieSpacingX*(np.arange(self.waferCols) - 0.5*(self.waferCols-1))
+        Y = self.dieSpacingY*((self.waferRows-np.arange(self.waferRows)-1) - 0.5*(self.waferRows-1))
+        return np.broadcast_arrays(X[:,None], Y[None,:])
+
+    @staticmethod
+    def readOnly(*arrays):
+        """Copies that cannot be modified, since they are shared through the cache"""
+        arrays = tuple(np.array(a) for a in arrays)
+        for a in arrays:
+            a.setflags(write=False)
+        return arrays
+
+    def getSampleCoords(self, i,j,ii,jj):
+        X, Y = self.getAllSampleCoords()
+        return [float(X[i,j,ii,jj]), float(Y[i,j,ii,jj])]
+
+    def locateSamples(self, x, y, tolerance=None):
+        """Devices at the stage coordinates x, y: the inverse of getAllSampleCoords
+
+        Returns index arrays (I, J, II, JJ) of the nearest device to each
+        point and a mask of the points lying within tolerance of it on both
+        axes, by default half the device spacing.
+        """
+        X, Y = self.getAllSampleCoords()
+        # X only depends on (i, ii) and Y on (j, jj), so each axis is a 1D lookup
+        I, II, foundX = nearestIndex(X[:,0,:,0], np.ravel(x),
+                                     0.5*self.sampleSpacingX if tolerance is None else tolerance)
+        J, JJ, foundY = nearestIndex(Y[0,:,0,:], np.ravel(y),
+                                     0.5*self.sampleSpacingY if tolerance is None else tolerance)
+        return (I, J, II, JJ), foundX & foundY
+
+    def getGratingCoords(self, i, j, quadrant):
+        # quadrant is 1-4 as per convention
+        X, Y = self.getAllGratingCoords()
+        return [float(X[i,j,quadrant-1]), float(Y[i,j,quadrant-1])]
+
+    def fitWedge(self, order=1, robust=False):
+        """Fit a thickness surface to all measured die corner gratings"""
+        import waferfit
+        X, Y = self.getAllGratingCoords()
+        measured = self.dieThick != 0.0
+        fit = waferfit.fitSurface(X[measured], Y[measured], self.dieThick[measured],
+                                  order=order, robust=robust)
+        self.wedgeMx, self.wedgeMy, self.wedgeC = fit.mx, fit.my, fit.c
+        self.wedgeOrder   = fit.order
+        self.wedgeRobust  = fit.robust
+        self.wedgeCoeffs  = fit.coeffs
+        self.wedgeRMS     = fit.rms
+        self.wedgeMaxResidual = fit.maxResidual
+        self.wedgePoints  = fit.points
+        return fit
+
+    def wedgeThickness(self, x, y):
+        """Thickness predicted by the wedge fit at stage coordinates (x, y)"""
+        if self.wedgeCoeffs is None:
+            return self.wedgeMx*np.asarray(x) + self.wedgeMy*np.asarray(y) + self.wedgeC
+        import waferfit
+        return waferfit.evalSurface(self.wedgeCoeffs, self.wedgeOrder, x, y)
+
+    def wedgeFitState(self):
+        """The fitted surface as plain values for the file formats, or None"""
+        if self.wedgeCoeffs is None:
+            return None
+        return {"wedgeOrder":       int(self.wedgeOrder),
+                "wedgeRobust":      bool(self.wedgeRobust),
+                "wedgeCoeffs":      [float(c) for c in self.wedgeCoeffs],
+                "wedgeRMS":         float(self.wedgeRMS),
+                "wedgeMaxResidual": float(self.wedgeMaxResidual),
+                "wedgePoints":      int(self.wedgePoints)}
+
+    def setWedgeFitState(self, state):
+        if state is not None:
+            for name, value in state.items():
+                setattr(self, name, value)
+
+    def getField(self, kind, index, field):
+        """Current value of one field as a plain Python value"""
+        if kind == "wafer":
+            return getattr(self, field)
+        if field == "notes":
+            return self.notesFor(kind).get(tuple(index), "")
+        array, sub = FIELD_ARRAYS[kind][field]
+        return getattr(self, array)[tuple(index) + sub].item()
+
+    def setField(self, kind, index, field, value):
+        """Change one field of the wafer, a die or a sample and tell the listeners
+
+        All edits should come through here (the Die and Sample views do), so
+        that journals, undo history and statistics see every change.
+        """
+        index = tuple(int(n) for n in index)
+        old = self.getField(kind, index, field)
+        if kind == "wafer":
+            if field not in WAFER_FIELDS:
+                raise ValueError("%s is not an editable wafer field" % field)
+            setattr(self, field, value)
+        elif field == "notes":
+            setNote(self.notesFor(kind), index, value)
+        else:
+            array, sub = FIELD_ARRAYS[kind][field]
+            getattr(self, array)[index + sub] = value
+        new = self.getField(kind, index, field)
+        if new != old:
+            self.notify(Change(kind, index, field, old, new))
+
+    def setSamples(self, index, field, value):
+        """Change one field of many devices at once and tell the listeners in one Change
+
+        index is a boolean mask shaped like sampleStatus or a tuple of index
+        arrays (I, J, II, JJ) naming each device at most once; value is one
+        value for all or one per device.
+        """
+        if isinstance(index, tuple):
+            index = tuple(np.asarray(a, dtype=int).ravel() for a in index)
+        else:
+            index = np.nonzero(np.asarray(index, dtype=bool))
+        if field == "notes":
+            keys = list(zip(*[a.tolist() for a in index]))
+            values = [value]*len(keys) if np.ndim(value) == 0 else list(value)
+            old = [self.sampleNotes.get(k, "") for k in keys]
+            for k, text in zip(keys, values):
+                setNote(self.sampleNotes, k, text)
+            new = [self.sampleNotes.get(k, "") for k in keys]
+            changed = np.array([a != b for a, b in zip(old, new)], dtype=bool)
+            old = [text for text, c in zip(old, changed) if c]
+            new = [text for text, c in zip(new, changed) if c]
+        else:
+            array = getattr(self, FIELD_ARRAYS["sample"][field][0])
+            old = array[index]
+            array[index] = value
+            new = array[index]
+            changed = old != new
+            old, new = old[changed], new[changed]
+        if np.any(changed):
+            self.notify(Change("samples", tuple(a[changed] for a in index), field, old, new))
+
+    def applyChange(self, change, undo=False):
+        """Redo (or with undo=True revert) a recorded change"""
+        value = change.old if undo else change.new
+        if change.kind == "samples":
+            self.setSamples(change.index, change.field, value)
+        else:
+            self.setField(change.kind, change.index, change.field, value)
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify(self, change):
+        for listener in list(self.listeners):
+            listener(change)
+
+    def notesFor(self, kind):
+        return self.sampleNotes if kind == "sample" else self.dieNotes
+
+    def copy(self):
+        """Independent copy without listeners, e.g. a snapshot to save while editing goes on"""
+        arrays = dict((field, np.array(getattr(self, field))) for field, dtype in ARRAY_FIELDS)
+        other = Wafer(self.name, self.waferRows, self.waferCols, self.dieRows, self.dieCols,
+                      self.startingRowLetter, self.startingColLetter, arrays)
+        for name in WAFER_FIELDS + ["status", "SampleMargin", "DieMargin",
+                                    "wedgeMx", "wedgeMy", "wedgeC"]:
+            setattr(other, name, getattr(self, name))
+        other.setWedgeFitState(self.wedgeFitState())
+        other._sampleNotes = dict(self.sampleNotes)
+        other._dieNotes    = dict(self.dieNotes)
+        return other
+
+    @property
+    def sampleNotes(self):
+        self.loadNotes()
+        return self._sampleNotes
+
+    @property
+    def dieNotes(self):
+        self.loadNotes()
+        return self._dieNotes
+
+    def setNotesLoader(self, loader):
+        """Defer reading notes until first use; loader returns (sampleNotes, dieNotes)"""
+        self._notesLoader = loader
+
+    def loadNotes(self):
+        if self._notesLoader is not None:
+            loader, self._notesLoader = self._notesLoader, None
+            self._sampleNotes, self._dieNotes = loader()
+
+    def dieName(self, i, j):
+        return dieName(i, j, self.startingColLetter, self.startingRowLetter)
+
+    def sampleName(self, ii, jj):
+        return sampleName(ii, jj)
+
+def dieName(i, j, startingColLetter, startingRowLetter):
+    return chr(ord(startingColLetter)+i)+chr(ord(startingRowLetter)+j)
+
+def sampleName(ii, jj):
+    return chr(ord("A")+ii)+chr(ord("1")+jj)
+
+def nearestIndex(grid, points, tolerance):
+    """Indices into the 2D grid of the value nearest each point, and whether it is within tolerance"""
+    values = grid.ravel()
+    order = np.argsort(values, kind="mergesort")
+    ordered = values[order]
+    points = np.asarray(points, dtype=float)
+    if len(ordered) > 1:
+        right = np.clip(np.searchsorted(ordered, points), 1, len(ordered) - 1)
+    else:
+        right = np.zeros(points.shape, dtype=int)
+    left = np.maximum(right - 1, 0)
+    nearest = np.where(np.abs(ordered[left] - points) <= np.abs(ordered[right] - points), left, right)
+    found = np.abs(ordered[nearest] - points) <= tolerance
+    return np.unravel_index(order[nearest], grid.shape) + (found,)
+
+STATUS_NAMES = {1: "alive", 2: "dead", 3: "unmeasured"}
@@ -0,0 +1,195 @@
+"""Differences between copies of a wafer, and three-way merges of them
+
+Copies of one wafer probed on different stations hold the same arrays, so
+comparing them is one vectorized != per field, and only the notes, which
+are sparse dicts, are compared key by key. Differences and conflicts keep
+the convention of bulk Change records: index arrays (I, J, II, JJ) or
+(I, J) and one value per entry, so they can be applied with
+Wafer.setSamples and reported without visiting unchanged devices.
+
+mergeWafers takes ours, adds every edit theirs made to the common base
+that ours did not also make, and lists the true conflicts, where both
+changed a value differently. Conflicting fields keep our value and the
+notes of the device, die or wafer get a marker with both values, so they
+can be found and resolved in the GUI.
+"""
+
+import collections
+import numpy as np
+from wafercore import CORNERS, FIELD_ARRAYS, WAFER_FIELDS, setNote
+
+SAMPLE_FIELDS = ["status", "thick", "sizeX", "sizeY"]
+DIE_FIELDS    = ["status"] + CORNERS
+
+# One field that differs: kind is "sample", "die" or "wafer", index is a
+# tuple of index arrays (empty for the wafer) and the values are arrays, or
+# lists for notes and wafer fields, one entry per differing item.
+Difference = collections.namedtuple("Difference", "kind field index old new")
+Conflict   = collections.namedtuple("Conflict", "kind field index base ours theirs")
+
+def fieldArray(wafer, kind, field):
+    """The model array of one sample or die field, as a view"""
+    array, sub = FIELD_ARRAYS[kind][field]
+    return getattr(wafer, array)[(Ellipsis,) + sub]
+
+def checkShapes(*wafers):
+    shapes = set(w.sampleStatus.shape for w in wafers)
+    if len(shapes) > 1:
+        raise ValueError("wafers of different layouts cannot be compared: %s" %
+                         ", ".join("%s %s" % (w.name, "x".join(str(n) for n in w.sampleStatus.shape))
+                                   for w in wafers))
+
+def plain(value):
+    """Python value of a NumPy scalar, for reports"""
+    return value.item() if hasattr(value, "item") else value
+
+def changedNotes(old, new):
+    """Sorted keys whose note differs between two sparse notes dicts"""
+    return sorted(k for k in set(old) | set(new) if old.get(k, "") != new.get(k, ""))
+
+def keyArrays(keys):
+    """Index arrays from a non-empty list of index tuples"""
+    return tuple(np.array(a, dtype=int) for a in zip(*keys))
+
+class WaferDiff(object):
+    """Every field that differs between two copies of a wafer
+
+    Array fields are kept as masks, which is all highlighting needs; index
+    arrays and values are only gathered when the differences are listed.
+    """
+    def __init__(self, a, b):
+        checkShapes(a, b)
+        self.a, self.b = a, b
+        self.shape = a.sampleStatus.shape
+        self.masks = [] # (kind, field, mask) of the array fields that differ
+        for kind, fields in (("die", DIE_FIELDS), ("sample", SAMPLE_FIELDS)):
+            for field in fields:
+                mask = fieldArray(a, kind, field) != fieldArray(b, kind, field)
+                if mask.any():
+                    self.masks.append((kind, field, mask))
+        self.wafer = [Difference("wafer", field, (), [getattr(a, field)], [getattr(b, field)])
+                      for field in WAFER_FIELDS if getattr(a, field) != getattr(b, field)]
+        self.notes = []
+        for kind in ("die", "sample"):
+            old, new = a.notesFor(kind), b.notesFor(kind)
+            keys = changedNotes(old, new)
+            if keys:
+                self.notes.append(Difference(kind, "notes", keyArrays(keys),
+                                             [old.get(k, "") for k in keys], [new.get(k, "") for k in keys]))
+
+    def __len__(self):
+        """Number of differing values"""
+        return (sum(int(mask.sum()) for kind, field, mask in self.masks) +
+                sum(len(d.old) for d in self.wafer + self.notes))
+
+    def mask(self, kind="sample"):
+        """Mask of the devices (or with kind "die", dies) with any difference"""
+        mask = np.zeros(self.shape if kind == "sample" else self.shape[:2], dtype=bool)
+        for k, field, fieldMask in self.masks:
+            if k == kind:
+                mask |= fieldMask
+        for d in self.notes:
+            if d.kind == kind:
+                mask[d.index] = True
+        return mask
+
+    def differences(self):
+        """Difference records, wafer first, then dies, then devices"""
+        for d in self.wafer:
+            yield d
+        for kind in ("die", "sample"):
+            for k, field, mask in self.masks:
+                if k == kind:
+                    # flatnonzero is much faster than nonzero on 4D masks
+                    index = np.unravel_index(np.flatnonzero(mask), mask.shape)
+                    yield Difference(kind, field, index, fieldArray(self.a, kind, field)[index],
+                                     fieldArray(self.b, kind, field)[index])
+            for d in self.notes:
+                if d.kind == kind:
+                    yield d
+
+    def records(self):
+        """(kind, index, field, old, new) of each differing value"""
+        for d in self.differences():
+            for n in range(len(d.old)):
+                index = tuple(int(a[n]) for a in d.index)
+                yield (d.kind, index, d.field, plain(d.old[n]), plain(d.new[n]))
+
+    def describe(self):
+        devices, dies = int(self.mask("sample").sum()), int(self.mask("die").sum())
+        text = "%d devices and %d dies differ" % (devices, dies)
+        if self.wafer:
+            text += ", and the wafer's " + ", ".join(d.field for d in self.wafer)
+        return text
+
+def conflictNote(field, ours, theirs):
+    return "merge conflict: %s ours %s, theirs %s" % (field, ours, theirs)
+
+def noteConflict(ours, theirs):
+    """Both versions of a note, between conflict markers"""
+    return "<<<<<<< ours\n%s\n=======\n%s\n>>>>>>> theirs" % (ours, theirs)
+
+def mergeWafers(base, ours, theirs):
+    """Three-way merge of two edited copies of base: (merged wafer, conflicts)
+
+    The merged wafer is a copy of ours with the changes of theirs applied
+    wherever ours left base alone. Where both changed a value differently
+    ours is kept, the conflict is listed and marked in the notes.
+    """
+    checkShapes(base, ours, theirs)
+    merged = ours.copy()
+    conflicts = []
+    for field in WAFER_FIELDS:
+        b, o, t = getattr(base, field), getattr(ours, field), getattr(theirs, field)
+        if t != b and o == b:
+            setattr(merged, field, t)
+        elif t != b and o != t:
+            conflicts.append(Conflict("wafer", field, (), [b], [o], [t]))
+
+    for kind, fields in (("die", DIE_FIELDS), ("sample", SAMPLE_FIELDS)):
+        for field in fields:
+            b, o, t = [fieldArray(w, kind, field) for w in (base, ours, theirs)]
+            theirsChanged = t != b
+            take = theirsChanged & (o == b)
+            np.copyto(fieldArray(merged, kind, field), t, where=take)
+            clash = theirsChanged & (o != b) & (o != t)
+            if clash.any():
+                index = np.unravel_index(np.flatnonzero(clash), clash.shape)
+                conflicts.append(Conflict(kind, field, index, b[index], o[index], t[index]))
+
+        baseNotes, ourNotes, theirNotes = [w.notesFor(kind) for w in (base, ours, theirs)]
+        mergedNotes = merged.notesFor(kind)
+        clashes = []
+        for key in changedNotes(baseNotes, theirNotes):
+            if ourNotes.get(key, "") == baseNotes.get(key, ""):
+                setNote(mergedNotes, key, theirNotes.get(key, ""))
+            elif ourNotes.get(key, "") != theirNotes.get(key, ""):
+                clashes.append(key)
+        if clashes:
+            conflicts.append(Conflict(kind, "notes", keyArrays(clashes),
+                                      [baseNotes.get(k, "") for k in clashes],
+                                      [ourNotes.get(k, "") for k in clashes],
+                                      [theirNotes.get(k, "") for k in clashes]))
+    markConflicts(merged, conflicts)
+    return merged, conflicts
+
+def markConflicts(merged, conflicts):
+    """Put both sides of every conflict into the notes of what it concerns"""
+    markers = collections.defaultdict(list)
+    for c in conflicts:
+        for n in range(len(c.ours)):
+            key = (c.kind, tuple(int(a[n]) for a in c.index))
+            if c.field == "notes":
+                # Replaces our note, which it contains
+                markers[key].insert(0, noteConflict(c.ours[n], c.theirs[n]))
+            else:
+                markers[key].append(conflictNote(c.field, plain(c.ours[n]), plain(c.theirs[n])))
+    for (kind, index), lines in markers.items():
+        old = merged.notes if kind == "wafer" else merged.notesFor(kind).get(index, "")
+        if not lines[0].startswith("<<<<<<<"):
+            lines.insert(0, old)
+        text = "\n".join(line for line in lines if line)
+        if kind == "wafer":
+            merged.notes = text
+        else:
+            setNote(merged.notesFor(kind), index, text)
@@ -0,0 +1,89 @@
+"""Polynomial surface fits of film thickness over wafer stage coordinates
+
+Every fit is a linear least squares problem in the polynomial coefficients,
+so it is solved in closed form rather than iteratively. The robust mode
+repeats that solve with Tukey bisquare weights (iteratively reweighted least
+squares), which keeps a few bad grating readings from tilting the surface.
+"""
+
+import numpy as np
+
+def polyTerms(order):
+    """Exponents (px, py) of each term of a surface of the given order
+
+    Terms are ordered by total degree, so the first three are always
+    1, x and y, the constant and slopes of the plane fit.
+    """
+    return [(total-py, py) for total in range(order+1) for py in range(total+1)]
+
+def designMatrix(x, y, order):
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    return np.column_stack([x**px * y**py for px, py in polyTerms(order)])
+
+def evalSurface(coeffs, order, x, y):
+    """Evaluate a fitted surface at any array of coordinates"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    result = np.zeros(np.broadcast(x, y).shape)
+    for c, (px, py) in zip(coeffs, polyTerms(order)):
+        result += c * x**px * y**py
+    return result
+
+class SurfaceFit(object):
+    """Coefficients and residual statistics of one fit"""
+    def __init__(self, order, coeffs, residuals, weights, robust):
+        self.order     = order
+        self.coeffs    = [float(c) for c in coeffs]
+        self.robust    = robust
+        self.points    = len(residuals)
+        self.rms       = float(np.sqrt(np.mean(residuals**2))) if len(residuals) else 0.0
+        self.maxResidual = float(np.max(np.abs(residuals))) if len(residuals) else 0.0
+        # Points the robust weights rejected outright
+        self.outliers  = int(np.sum(weights == 0.0))
+
+    @property
+    def c(self):
+        return self.coeffs[0]
+
+    @property
+    def mx(self):
+        return self.coeffs[1] if self.order > 0 else 0.0
+
+    @property
+    def my(self):
+        return self.coeffs[2] if self.order > 0 else 0.0
+
+    def __call__(self, x, y):
+        return evalSurface(self.coeffs, self.order, x, y)
+
+def fitSurface(x, y, thick, order=1, robust=False, maxIter=50, tol=1e-10):
+    """Fit thick ~ sum c_k x^px y^py over the given points
+
+    With robust=True the solve is repeated with Tukey bisquare weights
+    derived from the median absolute deviation of the residuals, until the
+    coefficients stop changing.
+    """
+    thick = np.asarray(thick, dtype=float).ravel()
+    A = designMatrix(x, y, order)
+    if len(thick) < A.shape[1]:
+        raise ValueError("An order %d surface needs at least %d measured points, got %d"
+                         % (order, A.shape[1], len(thick)))
+
+    weights = np.ones(len(thick))
+    coeffs = np.linalg.lstsq(A, thick, rcond=None)[0]
+    if robust:
+        for iteration in range(maxIter):
+            residuals = thick - A.dot(coeffs)
+            scale = np.median(np.abs(residuals - np.median(residuals)))/0.6745
+            if scale == 0.0:
+                break
+            u = residuals/(4.685*scale)
+            weights = np.where(np.abs(u) < 1.0, (1.0 - u**2)**2, 0.0)
+            sw = np.sqrt(weights)
+            previous = coeffs
+            coeffs = np.linalg.lstsq(A*sw[:,None], thick*sw, rcond=None)[0]
+            if np.max(np.abs(coeffs - previous)) <= tol*max(1.0, np.max(np.abs(coeffs))):
+                break
+
+    return SurfaceFit(order, coeffs, thick - A.dot(coeffs), weights, robust)
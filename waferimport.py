@@ -0,0 +1,236 @@
+"""Streaming import of measurement tables from the ellipsometer and prober
+
+CSV and TSV files (the delimiter is sniffed) are read one row at a time and
+each row is matched to a device in one of three ways, whichever columns the
+header names:
+
+    die, device   e.g. Q1 and A1
+    name          die and device together, e.g. Q1A1, Q1-A1 or A1 Q1
+    x, y          stage coordinates in mm, matched by Wafer.locateSamples
+
+Names are looked up in dicts of the die and device names built once per
+import, so matching a row never searches the wafer. Matched values are
+gathered into batches and each batch is applied with Wafer.setSamples, one
+vectorized write per field. A wafer column, if present, restricts the import
+to the rows naming this wafer. Rows matching no device or holding values
+that cannot be read are listed in the ImportReport rather than stopping
+the import.
+"""
+
+import csv
+import io
+import os
+import sys
+
+import numpy as np
+from wafercore import STATUS_NAMES, dieName, sampleName
+
+# Header names, lower case without spaces or underscores, to column roles
+COLUMN_NAMES = {"wafer": "wafer", "die": "die", "device": "device", "sample": "device",
+                "name": "name", "x": "x", "y": "y", "status": "status",
+                "thick": "thick", "thickness": "thick", "sizex": "sizeX", "sizey": "sizeY",
+                "notes": "notes", "note": "notes"}
+VALUE_FIELDS = ["status", "thick", "sizeX", "sizeY", "notes"]
+STATUS_CODES = dict((name, code) for code, name in STATUS_NAMES.items())
+
+class ImportReport(object):
+    """Counts of the rows of one table, and the first maxListed that could not be used"""
+    def __init__(self, maxListed=100):
+        self.rows      = 0
+        self.matched   = 0
+        self.skipped   = 0 # Rows of other wafers
+        self.failed    = 0
+        self.failures  = [] # (line number, reason)
+        self.maxListed = maxListed
+
+    def fail(self, line, reason):
+        self.failed += 1
+        if len(self.failures) < self.maxListed:
+            self.failures.append((line, reason))
+
+    def describe(self):
+        text = "%d rows, %d matched, %d unmatched" % (self.rows, self.matched, self.failed)
+        if self.skipped:
+            text += ", %d for other wafers" % self.skipped
+        return text
+
+def openTable(filename):
+    """Open a table for the csv module, which wants bytes under Python 2"""
+    if sys.version_info[0] < 3:
+        return open(filename, "rb")
+    return io.open(filename, newline="", encoding="utf-8-sig")
+
+def toText(cell):
+    if isinstance(cell, bytes):
+        return cell.decode("utf-8")
+    return cell
+
+def parseHeader(row):
+    """Column number of each role named in a header row"""
+    columns = {}
+    for n, cell in enumerate(row):
+        key = toText(cell).lstrip(u"\ufeff").strip().lower().replace(" ", "").replace("_", "")
+        if key in COLUMN_NAMES:
+            columns.setdefault(COLUMN_NAMES[key], n)
+    if not any(field in columns for field in VALUE_FIELDS):
+        raise ValueError("no measurement columns (%s) in the header" % ", ".join(VALUE_FIELDS))
+    if not ("name" in columns or ("die" in columns and "device" in columns) or
+            ("x" in columns and "y" in columns)):
+        raise ValueError("the header needs die and device, name, or x and y columns")
+    return columns
+
+def parseValue(field, text):
+    """Model value of one cell; raises ValueError for unreadable ones"""
+    if field == "notes":
+        return text
+    if field == "status":
+        code = STATUS_CODES.get(text.lower())
+        if code is None:
+            code = int(text)
+            if code not in STATUS_NAMES:
+                raise ValueError(text)
+        return code
+    return float(text)
+
+class MeasurementReader(object):
+    """Reads one table into batches of (field, index arrays, values) for Wafer.setSamples
+
+    Reading only looks at the wafer, so it can run in a worker thread while
+    the batches are applied elsewhere.
+    """
+    def __init__(self, wafer, filename, batchSize=10000, tolerance=None):
+        self.wafer     = wafer
+        self.filename  = filename
+        self.batchSize = batchSize
+        self.tolerance = tolerance
+        self.report    = ImportReport()
+        self.dies = dict((dieName(i, j, wafer.startingColLetter, wafer.startingRowLetter), (i, j))
+                         for i in range(wafer.waferCols) for j in range(wafer.waferRows))
+        self.devices = dict((sampleName(ii, jj), (ii, jj))
+                            for ii in range(wafer.dieCols) for jj in range(wafer.dieRows))
+        # Row names past 9 run on through ":", ";" and so on, which then are no separators
+        used = set("".join(self.dies) + "".join(self.devices))
+        self.separators = set(c for c in " -_/:." if c not in used)
+
+    def findName(self, die, device):
+        if die in self.dies and device in self.devices:
+            return self.dies[die] + self.devices[device]
+        return None
+
+    def findFullName(self, name):
+        """Index of a die and device name run together, in either order"""
+        name = "".join(c for c in name if c not in self.separators)
+        # Die and device names are two characters each
+        return self.findName(name[:2], name[2:]) or self.findName(name[2:], name[:2])
+
+    def batches(self, progress=None):
+        """Yield (field, (I, J, II, JJ), values) with distinct devices in each batch"""
+        with openTable(self.filename) as f:
+            size = os.path.getsize(self.filename)
+            sample = f.read(65536)
+            f.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",\t;")
+            except csv.Error:
+                dialect = csv.excel_tab if "\t" in sample else csv.excel
+            reader = csv.reader(f, dialect)
+            try:
+                columns = parseHeader(next(reader))
+            except StopIteration:
+                raise ValueError("%s is empty" % self.filename)
+            fields = [field for field in VALUE_FIELDS if field in columns]
+
+            rows = []
+            for row in reader:
+                if not any(row):
+                    continue
+                self.report.rows += 1
+                parsed = self.parseRow(reader.line_num, row, columns, fields)
+                if parsed is not None:
+                    rows.append(parsed)
+                if len(rows) >= self.batchSize:
+                    for batch in self.resolve(rows, fields):
+                        yield batch
+                    rows = []
+                    if progress is not None:
+                        progress(min(float(getattr(f, "buffer", f).tell())/size, 1.0) if size else 1.0)
+            for batch in self.resolve(rows, fields):
+                yield batch
+        if progress is not None:
+            progress(1.0)
+
+    def parseRow(self, line, row, columns, fields):
+        """(line, index or (x, y), values, byPosition) of one row, or None if it is skipped or fails"""
+        def cell(role):
+            return toText(row[columns[role]]).strip() if columns[role] < len(row) else u""
+        if "wafer" in columns and cell("wafer") and cell("wafer") != self.wafer.name:
+            self.report.skipped += 1
+            return None
+        values = {}
+        for field in fields:
+            text = cell(field)
+            if text: # Blank cells leave the field as it is
+                try:
+                    values[field] = parseValue(field, text)
+                except ValueError:
+                    self.report.fail(line, "unreadable %s %r" % (field, text))
+                    return None
+
+        if "die" in columns and "device" in columns and cell("die"):
+            index = self.findName(cell("die"), cell("device"))
+            where = "%s %s" % (cell("die"), cell("device"))
+        elif "name" in columns and cell("name"):
+            index = self.findFullName(cell("name"))
+            where = cell("name")
+        elif "x" in columns and "y" in columns:
+            try:
+                return (line, (float(cell("x")), float(cell("y"))), values, True)
+            except ValueError:
+                self.report.fail(line, "unreadable coordinates %r, %r" % (cell("x"), cell("y")))
+                return None
+        else:
+            index, where = None, "(blank)"
+        if index is None:
+            self.report.fail(line, "no device %s" % where)
+            return None
+        return (line, index, values, False)
+
+    def resolve(self, rows, fields):
+        """Locate the rows given by coordinates, then split the batch by field"""
+        byPosition = [k for k, row in enumerate(rows) if row[3]]
+        indices = [row[1] for row in rows]
+        found = np.ones(len(rows), dtype=bool)
+        if byPosition:
+            x, y = np.array([rows[k][1] for k in byPosition]).T
+            located, ok = self.wafer.locateSamples(x, y, self.tolerance)
+            for n, k in enumerate(byPosition):
+                if ok[n]:
+                    indices[k] = tuple(int(a[n]) for a in located)
+                else:
+                    found[k] = False
+                    self.report.fail(rows[k][0], "no device at %g, %g" % rows[k][1])
+        self.report.matched += int(found.sum())
+
+        shape = self.wafer.sampleStatus.shape
+        for field in fields:
+            picked = [k for k in range(len(rows)) if found[k] and field in rows[k][2]]
+            if not picked:
+                continue
+            index = tuple(np.array(a, dtype=int) for a in zip(*[indices[k] for k in picked]))
+            values = [rows[k][2][field] for k in picked]
+            # A device listed twice takes its last value
+            flat = np.ravel_multi_index(index, shape)
+            last = len(flat) - 1 - np.unique(flat[::-1], return_index=True)[1]
+            index = tuple(a[last] for a in index)
+            if field == "notes":
+                values = [values[k] for k in last]
+            else:
+                values = np.array(values)[last]
+            yield field, index, values
+
+def importMeasurements(wafer, filename, batchSize=10000, tolerance=None, progress=None):
+    """Apply one measurement table to wafer, returning its ImportReport"""
+    reader = MeasurementReader(wafer, filename, batchSize, tolerance)
+    for field, index, values in reader.batches(progress):
+        wafer.setSamples(index, field, values)
+    return reader.report
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+"""Reading and writing wafers in the XML and binary formats"""
+
+import os
+import contextlib, tempfile, shutil
+import json, struct
+import numpy as np
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+from xml.sax.saxutils import escape, quoteattr
+
+from wafercore import Wafer, ARRAY_FIELDS, CORNERS, setNote
+
+class Cancelled(Exception):
+    """Raised by a progress callback to abandon a read or write part way through
+
+    Writes go through atomicFile, so a cancelled save leaves the previous
+    file untouched.
+    """
+
+def reportProgress(progress, done, total):
+    if progress is not None:
+        progress(float(done)/total if total else 1.0)
+
+def floatAttrs(elem, names, out):
+    """Parse the float attributes present on elem into the matching slots of out"""
+    for n, name in enumerate(names):
+        val = elem.get(name)
+        if val is not None:
+            out[n] = float(val)
+
+def readWaferXML(filename, progress=None):
+    """Build a Wafer from an XML file, streaming elements as they are parsed
+
+    Each element is read exactly once and cleared as soon as it has been
+    copied into the model, so the ElementTree never holds more than the
+    current device alongside the (empty) wafcol skeleton. progress, if
+    given, is called with the fraction read after each wafer column.
+    """
+    wafer = None
+    i = j = ii = jj = -1
+    sampleFields = ("thick", "sizeX", "sizeY")
+    values = np.zeros(3)
+    for event, elem in et.iterparse(filename, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if tag == "device":
+                jj += 1
+            elif tag == "diecol":
+                ii += 1
+                jj = -1
+            elif tag == "die":
+                j += 1
+                ii = -1
+            elif tag == "wafcol":
+                i += 1
+                j = -1
+            elif tag == "wafer":
+                wafer = Wafer(elem.get("name"),
+                              int(elem.get("waferRows")), int(elem.get("waferCols")),
+                              int(elem.get("dieRows")),   int(elem.get("dieCols")))
+                wafer.status = int(elem.get("status", -1))
+                wafer.wedge  = int(elem.get("wedge", 0))
+                for name in ("wedgeMx", "wedgeMy", "wedgeC", "dieSpacingX", "dieSpacingY",
+                             "sampleSpacingX", "sampleSpacingY"):
+                    if elem.get(name) is not None:
+                        setattr(wafer, name, float(elem.get(name)))
+                if elem.get("wedgeCoeffs") is not None:
+                    wafer.setWedgeFitState({
+                        "wedgeOrder":       int(elem.get("wedgeOrder")),
+                        "wedgeRobust":      elem.get("wedgeRobust") == "1",
+                        "wedgeCoeffs":      [float(c) for c in elem.get("wedgeCoeffs").split()],
+                        "wedgeRMS":         float(elem.get("wedgeRMS", 0.0)),
+                        "wedgeMaxResidual": float(elem.get("wedgeMaxResidual", 0.0)),
+                        "wedgePoints":      int(elem.get("wedgePoints", 0))})
+            continue
+
+        if tag == "device":
+            index = (i, j, ii, jj)
+            wafer.sampleStatus[index] = int(elem.get("status", 3))
+            values[:] = 0.0
+            floatAttrs(elem, sampleFields, values)
+            wafer.sampleThick[index], wafer.sampleSizeX[index], wafer.sampleSizeY[index] = values
+            setNote(wafer.sampleNotes, index, elem.text)
+        elif tag == "die":
+            wafer.dieStatus[i,j] = int(elem.get("status", -1))
+            floatAttrs(elem, CORNERS, wafer.dieThick[i,j])
+            setNote(wafer.dieNotes, (i,j), elem.text)
+        elif tag == "wafcol":
+            reportProgress(progress, i+1, wafer.waferCols)
+        elif tag == "wafer":
+            wafer.notes = elem.text or ""
+        elem.clear()
+    return wafer
+
+@contextlib.contextmanager
+def atomicFile(filename):
+    """Write to a temporary file next to filename, moving it into place only on success"""
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmpname)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpname, 0o666 & ~umask)
+        getattr(os, "replace", os.rename)(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def toText(s):
+    """Unicode for whatever GTK or ElementTree handed us"""
+    if isinstance(s, bytes):
+        return s.decode("utf-8")
+    return s
+
+def xmlAttrs(pairs):
+    return u"".join(u" %s=%s" % (name, quoteattr(toText(val))) for name, val in pairs)
+
+def writeWaferXML(wafer, filename, progress=None):
+    """Serialize a Wafer as XML, streaming one die at a time to disk
+
+    The output goes to a temporary file that replaces filename atomically
+    once everything has been written, so a failed save never clobbers the
+    previous copy. progress, if given, is called with the fraction written
+    after each wafer column.
+    """
+    w = wafer
+    header = [("name",           w.name),
+              ("status",         str(w.status)),
+              ("waferRows",      str(w.waferRows)),
+              ("waferCols",      str(w.waferCols)),
+              ("dieRows",        str(w.dieRows)),
+              ("dieCols",        str(w.dieCols)),
+              ("wedge",          str(w.wedge)),
+              ("wedgeMx",        repr(float(w.wedgeMx))),
+              ("wedgeMy",        repr(float(w.wedgeMy))),
+              ("wedgeC",         repr(float(w.wedgeC))),
+              ("dieSpacingX",    repr(float(w.dieSpacingX))),
+              ("dieSpacingY",    repr(float(w.dieSpacingY))),
+              ("sampleSpacingX", repr(float(w.sampleSpacingX))),
+              ("sampleSpacingY", repr(float(w.sampleSpacingY)))]
+    fit = w.wedgeFitState()
+    if fit is not None:
+        header += [("wedgeOrder",       str(fit["wedgeOrder"])),
+                   ("wedgeRobust",      str(int(fit["wedgeRobust"]))),
+                   ("wedgeCoeffs",      " ".join(repr(c) for c in fit["wedgeCoeffs"])),
+                   ("wedgeRMS",         repr(fit["wedgeRMS"])),
+                   ("wedgeMaxResidual", repr(fit["wedgeMaxResidual"])),
+                   ("wedgePoints",      str(fit["wedgePoints"]))]
+    sampleNames = [[w.sampleName(ii, jj) for jj in range(w.dieRows)] for ii in range(w.dieCols)]
+
+    with atomicFile(filename) as f:
+        f.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        f.write((u"<wafer%s>%s" % (xmlAttrs(header), escape(toText(w.notes)))).encode("utf-8"))
+        for i in range(w.waferCols):
+            f.write(b"<wafcol>")
+            for j in range(w.waferRows):
+                out = [u"<die%s>%s" % (xmlAttrs([("status", str(w.dieStatus[i,j])),
+                                                 ("name",   w.dieName(i,j)),
+                                                 ("rows",   str(w.dieRows)),
+                                                 ("cols",   str(w.dieCols))] +
+                                                [(corner, repr(thick)) for corner, thick
+                                                 in zip(CORNERS, w.dieThick[i,j].tolist())]),
+                                       escape(toText(w.dieNotes.get((i,j), ""))))]
+                status = w.sampleStatus[i,j].tolist()
+                thick  = w.sampleThick[i,j].tolist()
+                sizeX  = w.sampleSizeX[i,j].tolist()
+                sizeY  = w.sampleSizeY[i,j].tolist()
+                for ii in range(w.dieCols):
+                    out.append(u"<diecol>")
+                    for jj in range(w.dieRows):
+                        out.append(u'<device status="%d" name="%s" thick="%r" sizeX="%r" sizeY="%r">%s</device>' %
+                                   (status[ii][jj], sampleNames[ii][jj], thick[ii][jj], sizeX[ii][jj],
+                                    sizeY[ii][jj], escape(toText(w.sampleNotes.get((i,j,ii,jj), "")))))
+                    out.append(u"</diecol>")
+                out.append(u"</die>")
+                f.write(u"".join(out).encode("utf-8"))
+            f.write(b"</wafcol>")
+            reportProgress(progress, i+1, w.waferCols)
+        f.write(b"</wafer>")
+
+BINARY_MAGIC     = b"WAFB"
+BINARY_VERSION   = 1
+BINARY_EXTENSION = ".wfb"
+BINARY_ALIGN     = 64
+
+def isBinaryWaferFile(filename):
+    return os.path.splitext(filename)[1].lower() == BINARY_EXTENSION
+
+def alignUp(offset):
+    return -(-offset // BINARY_ALIGN) * BINARY_ALIGN
+
+def writeWaferBinary(wafer, filename, progress=None):
+    """Serialize a Wafer into the binary columnar format
+
+    The file starts with a magic number, a format version and the length
+    of a JSON header holding the wafer-level fields plus the offset, dtype
+    and shape of every array in ARRAY_FIELDS. The arrays follow as raw
+    little-endian blocks aligned for np.memmap, and the sparse sample and
+    die notes come last as a JSON section that is only read when needed.
+    progress is called as for writeWaferXML, after each block written.
+    """
+    w = wafer
+    arrays = [(field, dtype, np.ascontiguousarray(getattr(w, field), dtype=dtype))
+              for field, dtype in ARRAY_FIELDS]
+    notes = json.dumps({"samples": [list(index) + [toText(text)] for index, text in sorted(w.sampleNotes.items())],
+                        "dies":    [list(index) + [toText(text)] for index, text in sorted(w.dieNotes.items())]})
+    notes = notes.encode("utf-8")
+    header = {"name":           toText(w.name),
+              "notes":          toText(w.notes),
+              "status":         int(w.status),
+              "waferRows":      int(w.waferRows),
+              "waferCols":      int(w.waferCols),
+              "dieRows":        int(w.dieRows),
+              "dieCols":        int(w.dieCols),
+              "startingRowLetter": w.startingRowLetter,
+              "startingColLetter": w.startingColLetter,
+              "wedge":          int(w.wedge),
+              "wedgeMx":        float(w.wedgeMx),
+              "wedgeMy":        float(w.wedgeMy),
+              "wedgeC":         float(w.wedgeC),
+              "wedgeFit":       w.wedgeFitState(),
+              "dieSpacingX":    float(w.dieSpacingX),
+              "dieSpacingY":    float(w.dieSpacingY),
+              "sampleSpacingX": float(w.sampleSpacingX),
+              "sampleSpacingY": float(w.sampleSpacingY),
+              "arrays":         {},
+              "notesOffset":    0,
+              "notesLength":    len(notes)}
+
+    # The header size depends on the offsets it records, so reserve room for
+    # the widest offsets before laying out the data blocks.
+    layout = dict(header, arrays=dict((field, {"offset": 2**62, "dtype": dtype, "shape": list(a.shape)})
+                                      for field, dtype, a in arrays), notesOffset=2**62)
+    offset = alignUp(12 + len(json.dumps(layout).encode("utf-8")))
+    for field, dtype, a in arrays:
+        header["arrays"][field] = {"offset": offset, "dtype": dtype, "shape": list(a.shape)}
+        offset = alignUp(offset + a.nbytes)
+    header["notesOffset"] = offset
+    headerBytes = json.dumps(header).encode("utf-8")
+
+    blocks = sum(len(a) for field, dtype, a in arrays)
+    written = 0
+    with atomicFile(filename) as f:
+        f.write(BINARY_MAGIC + struct.pack("<II", BINARY_VERSION, len(headerBytes)) + headerBytes)
+        for field, dtype, a in arrays:
+            start = header["arrays"][field]["offset"]
+            f.write(b"\0" * (start - f.tell()))
+            for block in a: # One wafer column at a time
+                f.write(block.tobytes())
+                written += 1
+                reportProgress(progress, written, blocks)
+        f.write(b"\0" * (header["notesOffset"] - f.tell()))
+        f.write(notes)
+
+def readWaferBinary(filename):
+    """Open a binary wafer file, memory-mapping its arrays and deferring the notes
+
+    Arrays are mapped copy-on-write, so edits stay in memory until the
+    wafer is saved again.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+        if magic != BINARY_MAGIC:
+            raise ValueError("%s is not a binary wafer file" % filename)
+        version, length = struct.unpack("<II", f.read(8))
+        if version > BINARY_VERSION:
+            raise ValueError("%s uses binary wafer format version %d" % (filename, version))
+        header = json.loads(f.read(length).decode("utf-8"))
+
+    arrays = {}
+    for field, dtype in ARRAY_FIELDS:
+        info = header["arrays"][field]
+        shape = tuple(info["shape"])
+        if np.prod(shape) == 0:
+            arrays[field] = np.zeros(shape, dtype=info["dtype"])
+        else:
+            arrays[field] = np.memmap(filename, dtype=info["dtype"], mode="c",
+                                      offset=info["offset"], shape=shape)
+
+    w = Wafer(header["name"], header["waferRows"], header["waferCols"],
+              header["dieRows"], header["dieCols"],
+              header["startingRowLetter"], header["startingColLetter"], arrays=arrays)
+    for name in ("notes", "status", "wedge", "wedgeMx", "wedgeMy", "wedgeC",
+                 "dieSpacingX", "dieSpacingY", "sampleSpacingX", "sampleSpacingY"):
+        setattr(w, name, header[name])
+    w.setWedgeFitState(header.get("wedgeFit"))
+
+    def loadNotes():
+        with open(filename, "rb") as f:
+            f.seek(header["notesOffset"])
+            notes = json.loads(f.read(header["notesLength"]).decode("utf-8"))
+        return (dict((tuple(n[:4]), n[4]) for n in notes["samples"]),
+                dict((tuple(n[:2]), n[2]) for n in notes["dies"]))
+    w.setNotesLoader(loadNotes)
+    return w
+
+def readWafer(filename, progress=None):
+    """Load a wafer, choosing the format from the file extension
+
+    Binary files are mapped rather than read, so their progress jumps
+    straight to the end.
+    """
+    if isBinaryWaferFile(filename):
+        wafer = readWaferBinary(filename)
+        reportProgress(progress, 1, 1)
+        return wafer
+    return readWaferXML(filename, progress)
+
+def writeWafer(wafer, filename, progress=None):
+    """Save a wafer, choosing the format from the file extension"""
+    if isBinaryWaferFile(filename):
+        writeWaferBinary(wafer, filename, progress)
+    else:
+        writeWaferXML(wafer, filename, progress)
+
+def convertWafer(source, destination):
+    """Convert between the XML and binary formats without losing any field"""
+    writeWafer(readWafer(source), destination)
+
+# Wafers kept in a wafer store (see waferstore.py) are named "<store>#<lot>/<wafer>".
+# The names are handled here, so telling them from files does not load sqlite3.
+STORE_EXTENSION = ".wdb"
+
+def isStorePath(path):
+    return "#" in path and path.split("#", 1)[0].lower().endswith(STORE_EXTENSION)
+
+def splitStorePath(path):
+    """Split "<store>#<lot>/<wafer>" into (store, lot, wafer); the lot may be empty"""
+    store, name = path.split("#", 1)
+    lot, slash, wafer = name.rpartition("/")
+    return store, lot, wafer
+
+def storePath(store, lot, wafer):
+    return "%s#%s/%s" % (store, lot, wafer)
@@ -0,0 +1,252 @@
+"""Append-only edit journal kept next to a wafer file
+
+Every change made through Wafer.setField is appended to "<file>.journal" as
+one short JSON line holding the kind of item, its index, the field and the
+new value. Lines reach the OS as soon as they are written and are fsynced in
+batches, so a crash loses nothing and a power cut at most the last batch.
+
+Records hold absolute values, which makes replaying them idempotent: after a
+crash replayJournal() is simply run over whatever the wafer file contains.
+Compaction writes a snapshot of the wafer into the main file from a
+background thread. The journal is rotated to "<file>.journal.compacting" at
+the moment of the snapshot, and that file is removed once the main file has
+been replaced, so edits made during the write stay in the fresh journal.
+Saving from the GUI is the same operation, run with progress reporting.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from waferio import writeWafer
+
+JOURNAL_SUFFIX    = ".journal"
+COMPACTING_SUFFIX = ".journal.compacting"
+JOURNAL_HEADER    = ["WaferTracker journal", 1]
+
+KIND_CODES = {"sample": "s", "die": "d", "wafer": "w", "samples": "S"}
+CODE_KINDS = dict((code, kind) for kind, code in KIND_CODES.items())
+
+def journalFiles(filename):
+    """Journal files of a wafer file, oldest records first"""
+    return [filename + COMPACTING_SUFFIX, filename + JOURNAL_SUFFIX]
+
+def encodeChange(change):
+    if change.kind == "samples":
+        # One record for a whole bulk edit, with lists of indices and values
+        index = [a.tolist() for a in change.index]
+        new = change.new if isinstance(change.new, list) else change.new.tolist()
+    else:
+        index, new = list(change.index), change.new
+    return json.dumps([KIND_CODES[change.kind], index, change.field, new], separators=(",", ":"))
+
+def readJournal(path):
+    """Yield (kind, index, field, value) for every complete record of one journal file"""
+    with open(path, "rb") as f:
+        for number, line in enumerate(f):
+            if not line.endswith(b"\n"):
+                break # Torn final record from a crash mid-write
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue # A torn record that later ones were appended after
+            if number == 0:
+                if record != JOURNAL_HEADER:
+                    raise ValueError("%s is not a wafer journal" % path)
+                continue
+            code, index, field, value = record
+            yield CODE_KINDS[code], tuple(index), field, value
+
+def replayJournal(wafer, filename):
+    """Apply any journals left next to filename to wafer, returning the number of records"""
+    count = 0
+    for path in journalFiles(filename):
+        if os.path.exists(path):
+            for kind, index, field, value in readJournal(path):
+                if kind == "samples":
+                    wafer.setSamples(index, field, value)
+                else:
+                    wafer.setField(kind, index, field, value)
+                count += 1
+    return count
+
+def hasJournal(filename):
+    return any(os.path.exists(path) for path in journalFiles(filename))
+
+def fsyncDirectory(path):
+    """Make renames and unlinks in a directory durable, where the OS allows it"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Journal(object):
+    """Records every change of a wafer into the journal of its file
+
+    syncEvery and syncInterval bound how many records, and how many seconds'
+    worth, may be waiting for an fsync; call sync() from an idle timer to
+    cover quiet spells. After compactEvery records the wafer is written back
+    into its file in the background.
+    """
+    def __init__(self, wafer, filename, syncEvery=32, syncInterval=1.0, compactEvery=2000):
+        self.wafer        = wafer
+        self.filename     = filename
+        self.path         = filename + JOURNAL_SUFFIX
+        self.syncEvery    = syncEvery
+        self.syncInterval = syncInterval
+        self.compactEvery = compactEvery
+        self.unsynced     = 0
+        self.lastSync     = time.time()
+        self.records      = 0 # Since the main file was last written
+        self.idle         = threading.Event() # Clear while a snapshot is being written
+        self.idle.set()
+        self.error        = None # Failure of the last background compaction
+        self.file         = None
+
+    def attach(self):
+        self.wafer.addListener(self.record)
+
+    def detach(self):
+        """Stop recording; a running compaction goes on, and wait() waits for it"""
+        self.wafer.removeListener(self.record)
+        self.close()
+
+    def open(self):
+        if self.file is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self.file = open(self.path, "ab")
+            if new:
+                self.write(json.dumps(JOURNAL_HEADER))
+                self.sync()
+                fsyncDirectory(self.path)
+
+    def write(self, line):
+        self.file.write(line.encode("utf-8") + b"\n")
+        self.file.flush()
+
+    def record(self, change):
+        self.open()
+        self.write(encodeChange(change))
+        self.records  += 1
+        self.unsynced += 1
+        if self.unsynced >= self.syncEvery or time.time() - self.lastSync >= self.syncInterval:
+            self.sync()
+        if self.needsCompaction():
+            self.compact()
+
+    def sync(self):
+        """fsync the records written so far; returns True so it can serve as a GLib timeout"""
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.lastSync = time.time()
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def needsCompaction(self):
+        return self.records >= self.compactEvery and not self.compacting()
+
+    def compacting(self):
+        return not self.idle.is_set()
+
+    def compact(self, wait=False):
+        """Write the wafer into its file in the background and retire the journal so far"""
+        if self.compacting():
+            return
+        snapshot = self.beginSnapshot()
+        compactor = threading.Thread(target=self.compactInBackground, args=(snapshot,))
+        compactor.daemon = True
+        compactor.start()
+        if wait:
+            compactor.join()
+
+    def beginSnapshot(self):
+        """Retire the journal so far and return a copy of the wafer for writeSnapshot
+
+        Only one snapshot may be outstanding; call wait() first if one is.
+        """
+        if os.path.exists(self.filename + COMPACTING_SUFFIX):
+            # A previous compaction did not finish; keep its records for replay
+            # and let them be covered by this snapshot as well.
+            self.close()
+            if os.path.exists(self.path):
+                self.appendTo(self.filename + COMPACTING_SUFFIX)
+        else:
+            self.close()
+            if os.path.exists(self.path):
+                os.rename(self.path, self.filename + COMPACTING_SUFFIX)
+        self.records = 0
+        self.error = None
+        self.idle.clear()
+        return self.wafer.copy()
+
+    def appendTo(self, path):
+        """Move the records of the current journal onto the end of another journal file"""
+        with open(self.path, "rb") as source:
+            lines = source.readlines()[1:]
+        with open(path, "ab") as target:
+            if os.path.getsize(path) and not self.endsWithNewline(path):
+                target.write(b"\n")
+            target.writelines(line for line in lines if line.endswith(b"\n"))
+            target.flush()
+            os.fsync(target.fileno())
+        os.remove(self.path)
+
+    @staticmethod
+    def endsWithNewline(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def writeSnapshot(self, snapshot, progress=None):
+        """Write a snapshot from beginSnapshot into the main file, from any thread
+
+        On failure, or if progress raises Cancelled, the retired records stay
+        in the journal for replay, so nothing is lost.
+        """
+        try:
+            writeWafer(snapshot, self.filename, progress)
+            if os.path.exists(self.filename + COMPACTING_SUFFIX):
+                os.remove(self.filename + COMPACTING_SUFFIX)
+            fsyncDirectory(self.filename)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.idle.set()
+
+    def compactInBackground(self, snapshot):
+        try:
+            self.writeSnapshot(snapshot)
+        except Exception as e:
+            sys.stderr.write("Could not compact the journal of %s: %s\n" % (self.filename, e))
+
+    def wait(self, timeout=None):
+        """Wait for a running compaction, returning False if it is still going after timeout seconds"""
+        return self.idle.wait(timeout)
+
+    def discard(self):
+        """Forget all records, after the wafer was saved in full to the main file
+
+        Waits for a running compaction first, so call it from a worker thread.
+        """
+        self.wait()
+        self.close()
+        self.records = 0
+        for path in journalFiles(self.filename):
+            if os.path.exists(path):
+                os.remove(path)
+        fsyncDirectory(self.filename)
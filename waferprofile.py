@@ -0,0 +1,204 @@
+"""Timing of the GUI's hot paths, for attaching real numbers to complaints
+
+Set WAFERTRACKER_PROFILE=1 (or use Tools > Profiling) to time drawing,
+clicks, loading, saving and wedge fits. The last durations of each are kept
+in a rolling window for percentiles and a histogram, which are printed to
+stderr on exit. Any one operation can also be captured on its next run,
+either as a cProfile dump (for pstats or snakeviz) or as collapsed stacks
+(one "outer;inner;leaf microseconds" line per stack, as read by
+flamegraph.pl and speedscope). WAFERTRACKER_PROFILE_CAPTURE=draw:/tmp/draw.prof
+does this from the environment.
+"""
+
+import collections
+import functools
+import os
+import sys
+import time
+
+PROFILE_ENV = "WAFERTRACKER_PROFILE"
+CAPTURE_ENV = "WAFERTRACKER_PROFILE_CAPTURE"
+
+CLOCK_MONOTONIC = 1 # From <linux/time.h>
+
+def monotonicClock():
+    """A monotonic high-resolution clock in seconds
+
+    Python 2 has no time.perf_counter, and its timeit.default_timer is
+    time.time outside Windows, which jumps with the wall clock; on Linux
+    clock_gettime(CLOCK_MONOTONIC) is read through ctypes instead.
+    """
+    if hasattr(time, "perf_counter"):
+        return time.perf_counter
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes, ctypes.util
+            class Timespec(ctypes.Structure):
+                _fields_ = [("sec", ctypes.c_long), ("nsec", ctypes.c_long)]
+            library = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"))
+            clockGettime = library.clock_gettime
+            clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+            def clock():
+                t = Timespec() # One per call, as loads and saves are timed from worker threads
+                clockGettime(CLOCK_MONOTONIC, ctypes.byref(t))
+                return t.sec + 1e-9*t.nsec
+            clock()
+            return clock
+        except (OSError, AttributeError, TypeError):
+            pass
+    import timeit
+    return timeit.default_timer
+
+clock = monotonicClock()
+
+# Histogram bucket edges in seconds
+BUCKETS = [0.0, 0.001, 0.002, 0.005, 0.010, 0.020, 0.050, 0.100, 0.200, 0.500, 1.0, float("inf")]
+
+class Timings(object):
+    """Rolling window of the durations of one operation"""
+    def __init__(self, size=500):
+        self.window = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.window.append(seconds)
+        self.count += 1
+
+    @property
+    def last(self):
+        return self.window[-1] if self.window else None
+
+    def percentile(self, p):
+        import numpy as np # Kept out of the module, which the GUI imports first to time its start-up
+        return float(np.percentile(list(self.window), p)) if self.window else None
+
+    def histogram(self):
+        """Counts of the windowed durations in each BUCKETS interval"""
+        import numpy as np
+        return np.histogram(list(self.window), bins=BUCKETS)[0].tolist()
+
+class CollapsedStacks(object):
+    """Deterministic tracer totalling own time per call stack, for flame graphs"""
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.stack = []
+        self.last = clock()
+
+    @staticmethod
+    def label(frame, arg, event):
+        if event.startswith("c_"):
+            return "%s (builtin)" % getattr(arg, "__name__", str(arg))
+        code = frame.f_code
+        return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def trace(self, frame, event, arg):
+        # Time since the previous event belongs to the innermost call only
+        if self.stack:
+            self.totals[";".join(self.stack)] += clock() - self.last
+        if event in ("call", "c_call"):
+            self.stack.append(self.label(frame, arg, event))
+        elif event in ("return", "c_return", "c_exception") and self.stack:
+            self.stack.pop()
+        self.last = clock()
+
+    def run(self, function, *args, **kwargs):
+        sys.setprofile(self.trace)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sys.setprofile(None)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            for stack, seconds in sorted(self.totals.items()):
+                f.write("%s %d\n" % (stack.replace(" ", "_"), int(round(seconds*1e6))))
+
+class Profiler(object):
+    """Per-operation timings, off unless enabled so the hooks cost one attribute check"""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timings = collections.defaultdict(Timings)
+        self.captures = {} # Operation -> file to profile its next run into
+
+    def timed(self, name):
+        """Decorator timing every call of a function as operation name"""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                return self.run(name, function, *args, **kwargs)
+            return wrapper
+        return decorate
+
+    def run(self, name, function, *args, **kwargs):
+        """Call function, timing it as operation name"""
+        if not self.enabled and name not in self.captures:
+            return function(*args, **kwargs)
+        return self.call(name, function, *args, **kwargs)
+
+    def call(self, name, function, *args, **kwargs):
+        filename = self.captures.pop(name, None)
+        start = clock()
+        try:
+            if filename is None:
+                return function(*args, **kwargs)
+            return self.capture(filename, function, *args, **kwargs)
+        finally:
+            if self.enabled:
+                self.timings[name].add(clock() - start)
+
+    def captureNext(self, name, filename):
+        """Profile the next run of an operation into filename
+
+        Files ending in .prof or .pstats get cProfile data, anything else
+        collapsed stacks.
+        """
+        self.captures[name] = filename
+
+    @staticmethod
+    def capture(filename, function, *args, **kwargs):
+        if os.path.splitext(filename)[1] in (".prof", ".pstats"):
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args, **kwargs)
+            finally:
+                profile.dump_stats(filename)
+        tracer = CollapsedStacks()
+        try:
+            return tracer.run(function, *args, **kwargs)
+        finally:
+            tracer.write(filename)
+
+    def summary(self, name):
+        """(last, p95) in seconds of an operation, or None if it has not run"""
+        timings = self.timings.get(name)
+        if timings is None or not timings.window:
+            return None
+        return timings.last, timings.percentile(95)
+
+    def report(self, stream=sys.stderr):
+        if not self.timings:
+            return
+        stream.write("%-8s %7s %9s %9s %9s %9s\n" % ("", "calls", "last ms", "p50 ms", "p95 ms", "max ms"))
+        for name in sorted(self.timings):
+            t = self.timings[name]
+            if not t.window:
+                continue
+            stream.write("%-8s %7d %9.2f %9.2f %9.2f %9.2f\n" %
+                         (name, t.count, 1000*t.last, 1000*t.percentile(50),
+                          1000*t.percentile(95), 1000*max(t.window)))
+            edges = ["<%gms" % (1000*edge) for edge in BUCKETS[1:-1]] + [">1s"]
+            stream.write("         " + "  ".join("%s:%d" % (edge, n)
+                                                for edge, n in zip(edges, t.histogram()) if n) + "\n")
+
+def fromEnvironment():
+    """Profiler configured from WAFERTRACKER_PROFILE and WAFERTRACKER_PROFILE_CAPTURE"""
+    profiler = Profiler(enabled=bool(os.environ.get(PROFILE_ENV)))
+    capture = os.environ.get(CAPTURE_ENV)
+    if capture and ":" in capture:
+        name, filename = capture.split(":", 1)
+        profiler.captureNext(name, filename)
+    return profiler
+
+# Shared by everything that is instrumented
+profiler = fromEnvironment()
@@ -0,0 +1,551 @@
+#!/usr/bin/python
+"""Drawing wafers into cairo contexts, independent of any widget
+
+exportWafer writes PNG, PDF and SVG maps without a display, e.g. for run
+reports. Large PNGs are rendered in horizontal bands that are compressed
+as they are finished, so memory does not grow with the image size.
+"""
+
+import math
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+import cairo
+from gi.repository import Pango, PangoCairo
+
+from waferio import atomicFile
+
+class WaferLayout(object):
+    """Pixel geometry of a wafer drawn into a w x h area
+
+    Coordinates are relative to the centre of the area, as in the drawing
+    code. The same object answers both "where is this device" for
+    drawing and "what is under this pixel" for clicks and hovering, so the
+    two can never disagree.
+    """
+    FRAME = 4 # Gap between a die and the frame drawn around it
+
+    def __init__(self, wafer, w, h):
+        self.width  = w
+        self.height = h
+        self.rad = 0.5*min(w,h)-10.0
+        self.usefulBoxSize = self.rad*1.3
+        self.waferCols, self.waferRows = wafer.waferCols, wafer.waferRows
+        self.dieCols,   self.dieRows   = wafer.dieCols,   wafer.dieRows
+
+        self.dieSizeX = (self.usefulBoxSize - (wafer.waferCols-1)*wafer.DieMargin)/wafer.waferCols
+        self.dieSizeY = (self.usefulBoxSize - (wafer.waferRows-1)*wafer.DieMargin)/wafer.waferRows
+        self.sampSizeX = (self.dieSizeX - 2*wafer.SampleMargin - (wafer.dieCols-1)*wafer.SampleMargin)/wafer.dieCols 
+        self.sampSizeY = (self.dieSizeY - 2*wafer.SampleMargin - (wafer.dieRows-1)*wafer.SampleMargin)/wafer.dieRows 
+        self.diePitchX  = self.dieSizeX + wafer.DieMargin
+        self.diePitchY  = self.dieSizeY + wafer.DieMargin
+        self.sampPitchX = self.sampSizeX + wafer.SampleMargin
+        self.sampPitchY = self.sampSizeY + wafer.SampleMargin
+        self.sampleMargin = wafer.SampleMargin
+
+        # Top left corners of every die, and of every device within its die
+        self.dieX  = (np.arange(wafer.waferCols)-0.5*(wafer.waferCols-1))*self.diePitchX - 0.5*self.dieSizeX
+        self.dieY  = (np.arange(wafer.waferRows)-0.5*(wafer.waferRows-1))*self.diePitchY - 0.5*self.dieSizeY
+        self.sampX = np.arange(wafer.dieCols)*self.sampPitchX + wafer.SampleMargin
+        self.sampY = np.arange(wafer.dieRows)*self.sampPitchY + wafer.SampleMargin
+        self.corners = None
+
+    def dieOrigin(self, i, j):
+        return (self.dieX[i], self.dieY[j])
+
+    def sampleOrigin(self, i, j, ii, jj):
+        return (self.dieX[i] + self.sampX[ii], self.dieY[j] + self.sampY[jj])
+
+    def sampleCorners(self):
+        """Top left corners of all devices as two arrays shaped like the model arrays"""
+        if self.corners is None:
+            xs = self.dieX[:,None,None,None] + self.sampX[None,None,:,None]
+            ys = self.dieY[None,:,None,None] + self.sampY[None,None,None,:]
+            self.corners = np.broadcast_arrays(xs, ys)
+        return self.corners
+
+    def dieRange(self, lo, hi, axis, margin=0.0):
+        """Slice of the die columns (axis 0) or rows (axis 1) meeting [lo, hi] in layout coordinates
+
+        margin widens every die, e.g. to take in labels drawn beside it.
+        """
+        starts, size = (self.dieX, self.dieSizeX) if axis == 0 else (self.dieY, self.dieSizeY)
+        first = int(np.searchsorted(starts + size + margin, lo))
+        last = int(np.searchsorted(starts - margin, hi, side="right"))
+        return slice(first, max(first, last))
+
+    def toLayout(self, x, y):
+        """Widget coordinates to layout coordinates"""
+        return (x - 0.5*self.width, y - 0.5*self.height)
+
+    def toWidget(self, x, y):
+        return (x + 0.5*self.width, y + 0.5*self.height)
+
+    def sampleRect(self, i, j, ii, jj):
+        """Device rectangle in widget coordinates"""
+        x, y = self.toWidget(*self.sampleOrigin(i, j, ii, jj))
+        return (x, y, self.sampSizeX, self.sampSizeY)
+
+    def hit(self, x, y):
+        """What lies under the widget pixel (x, y)
+
+        Returns (i, j, ii, jj) for a device, (i, j) for the margin inside a
+        die frame and None anywhere else.
+        """
+        x, y = self.toLayout(x, y)
+        i = self.locate(x, self.dieX[0] - self.FRAME, self.diePitchX, self.dieSizeX + 2*self.FRAME, self.waferCols)
+        j = self.locate(y, self.dieY[0] - self.FRAME, self.diePitchY, self.dieSizeY + 2*self.FRAME, self.waferRows)
+        if i is None or j is None:
+            return None
+        ii = self.locate(x, self.dieX[i] + self.sampleMargin, self.sampPitchX, self.sampSizeX, self.dieCols)
+        jj = self.locate(y, self.dieY[j] + self.sampleMargin, self.sampPitchY, self.sampSizeY, self.dieRows)
+        if ii is None or jj is None:
+            return (i, j)
+        return (i, j, ii, jj)
+
+    def samplesInRect(self, x1, y1, x2, y2):
+        """Mask of the devices touching the widget rectangle between two corners"""
+        left, top     = self.toLayout(min(x1, x2), min(y1, y2))
+        right, bottom = self.toLayout(max(x1, x2), max(y1, y2))
+        xs, ys = self.sampleCorners()
+        return ((xs <= right) & (xs + self.sampSizeX >= left) &
+                (ys <= bottom) & (ys + self.sampSizeY >= top))
+
+    def hitLabel(self, x, y):
+        """Which label lies under the widget pixel (x, y)
+
+        Returns ("col", i) or ("row", j) for the die labels, ("sampleCol", ii)
+        or ("sampleRow", jj) for the device labels next to the first die, and
+        None anywhere else.
+        """
+        x, y = self.toLayout(x, y)
+        F = self.FRAME
+        i = self.locate(x, self.dieX[0], self.diePitchX, self.dieSizeX, self.waferCols)
+        j = self.locate(y, self.dieY[0], self.diePitchY, self.dieSizeY, self.waferRows)
+        # Device labels sit between the first die and its die labels
+        sampleTop  = self.dieY[0] + self.sampY[0] - 1.1*self.sampSizeY - 6
+        sampleLeft = self.dieX[0] + self.sampX[0] - 1.1*self.sampSizeX - 6
+        if i is not None and self.dieY[0] - 0.6*self.dieSizeY <= y < self.dieY[0] - F:
+            if i == 0 and y >= sampleTop:
+                ii = self.locate(x, self.dieX[0] + self.sampleMargin, self.sampPitchX, self.sampSizeX, self.dieCols)
+                return None if ii is None else ("sampleCol", ii)
+            return ("col", i)
+        if j is not None and self.dieX[0] - 0.6*self.dieSizeX <= x < self.dieX[0] - F:
+            if j == 0 and x >= sampleLeft:
+                jj = self.locate(y, self.dieY[0] + self.sampleMargin, self.sampPitchY, self.sampSizeY, self.dieRows)
+                return None if jj is None else ("sampleRow", jj)
+            return ("row", j)
+        return None
+
+    def deviceColumns(self, xs):
+        """Device column across the wafer (i*dieCols + ii) under each widget x, or -1"""
+        return self.gridIndex(np.asarray(xs) - 0.5*self.width, self.dieX, self.diePitchX,
+                              self.waferCols, self.sampPitchX, self.sampSizeX, self.dieCols)
+
+    def deviceRows(self, ys):
+        """Device row across the wafer (j*dieRows + jj) under each widget y, or -1"""
+        return self.gridIndex(np.asarray(ys) - 0.5*self.height, self.dieY, self.diePitchY,
+                              self.waferRows, self.sampPitchY, self.sampSizeY, self.dieRows)
+
+    def gridIndex(self, x, dieStarts, diePitch, dies, sampPitch, sampSize, samples):
+        """Vectorized locate of die and then device along one axis"""
+        die = np.floor((x - dieStarts[0])/diePitch).astype(int)
+        inside = (die >= 0) & (die < dies)
+        die = np.clip(die, 0, dies-1)
+        offset = x - dieStarts[die] - self.sampleMargin
+        sample = np.floor(offset/sampPitch).astype(int)
+        inside &= (sample >= 0) & (sample < samples) & (offset - sample*sampPitch <= sampSize)
+        return np.where(inside, die*samples + sample, -1)
+
+    @staticmethod
+    def locate(x, start, pitch, size, count):
+        """Index of the cell of a regular grid containing x, if any"""
+        n = int(math.floor((x - start)/pitch))
+        if n < 0 or n >= count or x - start - n*pitch > size:
+            return None
+        return n
+
+# 256 entry colormap, dark blue through green to yellow, as native-endian
+# ARGB32 words ready for an image surface
+COLORMAP_ANCHORS = np.array([(0.267, 0.005, 0.329), (0.229, 0.322, 0.546), (0.128, 0.567, 0.551),
+                             (0.369, 0.789, 0.383), (0.993, 0.906, 0.144)])
+COLORMAP_RGB = np.stack([np.interp(np.linspace(0, 1, 256), np.linspace(0, 1, len(COLORMAP_ANCHORS)), c)
+                         for c in COLORMAP_ANCHORS.T], axis=-1)
+COLORMAP = np.array([0xff000000 | (int(255*r+0.5) << 16) | (int(255*g+0.5) << 8) | int(255*b+0.5)
+                     for r, g, b in COLORMAP_RGB], dtype=np.uint32)
+
+def colorize(values, lo, hi):
+    """ARGB32 colors of values between lo and hi, transparent for NaN"""
+    with np.errstate(invalid="ignore"):
+        level = np.clip((values - lo)*(255.0/(hi - lo) if hi > lo else 0.0), 0, 255)
+    known = ~np.isnan(level)
+    return np.where(known, COLORMAP[np.where(known, level, 0).astype(int)], np.uint32(0))
+
+class Heatmap(object):
+    """Devices colored by a value, rasterized by NumPy into one image surface
+
+    Each pixel looks up the value of the device under its centre and only
+    the pixels are colored, so apart from finding the range the cost does
+    not depend on the number of devices, and drawing is a single paint
+    rather than a fill per device. scale is the number of image pixels per
+    widget pixel, e.g. more than 1 when printing.
+    """
+    def __init__(self, layout, values, scale=1.0):
+        # fmin and fmax skip NaNs without copying out the known values
+        lo, hi = np.fmin.reduce(values, axis=None), np.fmax.reduce(values, axis=None)
+        self.lo = None if np.isnan(lo) else float(lo)
+        self.hi = None if np.isnan(hi) else float(hi)
+        self.size = (layout.width, layout.height)
+        self.scale = scale
+        cols, rows, dieCols, dieRows = values.shape
+        # Indexed [device column, device row] across the whole wafer
+        grid = values.transpose(0, 2, 1, 3).reshape(cols*dieCols, rows*dieRows)
+        width = int(math.ceil(layout.width*scale))
+        height = int(math.ceil(layout.height*scale))
+        x = layout.deviceColumns((np.arange(width) + 0.5)/scale)[None,:]
+        y = layout.deviceRows((np.arange(height) + 0.5)/scale)[:,None]
+        picked = np.where((x >= 0) & (y >= 0), grid[x, y], np.nan)
+        self.pixels = np.ascontiguousarray(colorize(picked, lo, hi), dtype=np.uint32)
+        self.surface = cairo.ImageSurface.create_for_data(self.pixels, cairo.FORMAT_ARGB32,
+                                                          width, height, 4*width)
+
+    def paint(self, cr):
+        cr.save()
+        cr.scale(1.0/self.scale, 1.0/self.scale)
+        cr.set_source_surface(self.surface, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_NEAREST)
+        cr.paint()
+        cr.restore()
+
+LOD_THRESHOLD = 4.0 # Device size in pixels below which outlines and note dots are skipped
+
+fontDescriptions = {}
+
+def fontDescription(font):
+    """Parsed Pango font description, cached by its string form"""
+    if font not in fontDescriptions:
+        fontDescriptions[font] = Pango.font_description_from_string(font)
+    return fontDescriptions[font]
+
+class WaferRenderer(object):
+    """Draws wafers into cairo contexts, keeping Pango layouts between frames"""
+    def __init__(self):
+        self.labelLayouts = {}
+
+    def render(self, cr, wafer, layout):
+        """Draw the whole wafer, background and devices"""
+        self.drawBackground(cr, wafer, layout)
+        self.drawDevices(cr, wafer, layout, cr.clip_extents())
+
+    def drawBackground(self, cr, wafer, layout):
+        """Wafer outline, wedge glyph, die frames and labels, the dies limited to the clip"""
+        cr.save()
+        rad = layout.rad
+        cr.translate ( 0.5*layout.width, 0.5*layout.height)
+        left, top, right, bottom = cr.clip_extents()
+
+        # Draw wafer with flat
+        cr.move_to( rad*np.cos(250.0*np.pi/180.0),  rad*np.sin(250.0*np.pi/180.0))
+        cr.line_to( rad*np.cos(290.0*np.pi/180.0),  rad*np.sin(290.0*np.pi/180.0))
+        cr.arc(0.0, 0.0, rad, 290.0*np.pi/180.0, 250.0*np.pi/180.0)
+        cr.set_line_width(3)
+        cr.set_source_rgb(0., 6./16., 1.0)
+        cr.stroke_preserve()
+        cr.set_source_rgb(0.8, 0.8, 0.8)
+        cr.fill()
+
+        # Draw wedge
+        ubs = layout.usefulBoxSize
+        if wafer.wedge == 1:
+            cr.move_to(-0.5*ubs, 0.5*ubs + 10)
+            cr.line_to( 0.5*ubs, 0.5*ubs + 10)
+            cr.line_to( 0.5*ubs, 0.5*ubs + 25)
+            cr.line_to(-0.5*ubs, 0.5*ubs + 10)
+            cr.set_source_rgb(0., 6./16., 1.0)
+            cr.stroke()
+        elif wafer.wedge == 2:
+            ubs = layout.usefulBoxSize
+            cr.move_to(-0.5*ubs, 0.5*ubs + 10)
+            cr.line_to(-0.5*ubs, 0.5*ubs + 25)
+            cr.line_to( 0.5*ubs, 0.5*ubs + 10)
+            cr.line_to(-0.5*ubs, 0.5*ubs + 10)
+            cr.set_source_rgb(0., 6./16., 1.0)
+            cr.stroke()
+        elif wafer.wedge == 4:
+            ubs = layout.usefulBoxSize
+            cr.move_to(0.5*ubs + 10, -0.5*ubs )
+            cr.line_to(0.5*ubs + 10,  0.5*ubs )
+            cr.line_to(0.5*ubs + 25,  0.5*ubs )
+            cr.line_to(0.5*ubs + 10, -0.5*ubs )
+            cr.set_source_rgb(0., 6./16., 1.0)
+            cr.stroke()
+        elif wafer.wedge == 3:
+            ubs = layout.usefulBoxSize
+            cr.move_to(0.5*ubs + 10, -0.5*ubs )
+            cr.line_to(0.5*ubs + 25, -0.5*ubs )
+            cr.line_to(0.5*ubs + 10,  0.5*ubs )
+            cr.line_to(0.5*ubs + 10, -0.5*ubs )
+            cr.set_source_rgb(0., 6./16., 1.0)
+            cr.stroke()
+
+        DieSizeX, DieSizeY = layout.dieSizeX, layout.dieSizeY
+        SampSizeX, SampSizeY = layout.sampSizeX, layout.sampSizeY
+        F = layout.FRAME
+        # Labels sit up to 0.6 of a die and a 24 point line outside their die
+        margin = max(DieSizeX, DieSizeY) + 40
+        cols = layout.dieRange(left, right, 0, margin)
+        rows = layout.dieRange(top, bottom, 1, margin)
+        for i in range(cols.start, cols.stop):
+            for j in range(rows.start, rows.stop):
+               
+                # Draw Dies
+                transX, transY = layout.dieOrigin(i, j)
+                cr.rectangle(transX-F, transY-F, DieSizeX+2*F, DieSizeY+2*F)
+                cr.set_line_width(1.0)
+                if (i,j) not in wafer.dieNotes:
+                    cr.set_source_rgb(0.1, 0.1, 0.1)
+                else:
+                    cr.set_source_rgb(0., 6./16., 1.0)
+                cr.stroke()
+
+                # Draw Label
+                cr.set_source_rgb(0.0, 0.0, 0.0)
+                if j==0:
+                    self.drawLabel(cr, chr(ord("Q")+i), "Sans Bold 24",
+                                   transX + DieSizeX*0.32, transY - 0.6*DieSizeY)
+                if i==0:
+                    self.drawLabel(cr, chr(ord("1")+j), "Sans Bold 24",
+                                   transX - 0.6*DieSizeX, transY + 0.35*DieSizeY)
+
+                # Sample labels
+                if i==0 and j==0:
+                    cr.set_source_rgb(0.2, 0.2, 0.2)
+                    for ii in range(wafer.dieCols):
+                        transXX, transYY = layout.sampleOrigin(i, j, ii, 0)
+                        self.drawLabel(cr, chr(ord("A")+ii), "Sans 10",
+                                       transXX + SampSizeX*0.15, transYY - 1.1*SampSizeY - 6)
+                    for jj in range(wafer.dieRows):
+                        transXX, transYY = layout.sampleOrigin(i, j, 0, jj)
+                        self.drawLabel(cr, chr(ord("1")+jj), "Sans 10",
+                                       transXX - 1.1*SampSizeX - 6 , transYY + 0.15*SampSizeY)
+        cr.restore()
+
+    def drawLabel(self, cr, text, font, x, y):
+        """Show text at (x, y), reusing the Pango layout from earlier frames"""
+        layout = self.labelLayouts.get((text, font))
+        if layout is None:
+            layout = PangoCairo.create_layout(cr)
+            layout.set_text(text, -1)
+            layout.set_font_description(fontDescription(font))
+            self.labelLayouts[(text, font)] = layout
+        else:
+            PangoCairo.update_layout(cr, layout)
+        cr.save()
+        cr.move_to(x, y)
+        PangoCairo.show_layout(cr, layout)
+        cr.restore()
+
+    def drawDevices(self, cr, wafer, layout, clip=None):
+        """Device rectangles and note markers, limited to the clip extents if given
+
+        Devices are batched into one path per status color, so the number of
+        fills and strokes does not depend on the number of devices, and only
+        the dies meeting the clip are looked at, so neither does the rest.
+        """
+        cr.save()
+        w, h = layout.width, layout.height
+        cr.translate ( 0.5*w, 0.5*h)
+        if clip is None:
+            clip = (-0.5*w, -0.5*h, 0.5*w, 0.5*h)
+        else:
+            clip = (clip[0]-0.5*w, clip[1]-0.5*h, clip[2]-0.5*w, clip[3]-0.5*h)
+
+        SampSizeX, SampSizeY = layout.sampSizeX, layout.sampSizeY
+        cols = layout.dieRange(clip[0], clip[2], 0)
+        rows = layout.dieRange(clip[1], clip[3], 1)
+        xs, ys = [a[cols, rows] for a in layout.sampleCorners()]
+        visible = ((xs <= clip[2]) & (xs + SampSizeX >= clip[0]) &
+                   (ys <= clip[3]) & (ys + SampSizeY >= clip[1]))
+        status = wafer.sampleStatus[cols, rows]
+
+        # Below the level-of-detail threshold outlines and note dots would be
+        # sub-pixel noise, so unmeasured devices get a flat fill instead.
+        # Sizes are measured on the output, which exports may scale.
+        deviceX, deviceY = cr.user_to_device_distance(SampSizeX, SampSizeY)
+        detailed = min(abs(deviceX), abs(deviceY)) >= LOD_THRESHOLD
+        colors = [(1, (0.0, 0.8, 0.0)), (2, (0.8, 0.0, 0.0))]
+        if not detailed:
+            colors.append((3, (0.65, 0.65, 0.65)))
+        for value, color in colors:
+            mask = visible & (status == value)
+            for x, y in zip(xs[mask].tolist(), ys[mask].tolist()):
+                cr.rectangle(x, y, SampSizeX, SampSizeY)
+            cr.set_source_rgb(*color)
+            cr.fill()
+
+        if detailed:
+            mask = visible & (status == 3)
+            for x, y in zip(xs[mask].tolist(), ys[mask].tolist()):
+                cr.rectangle(x, y, SampSizeX, SampSizeY)
+            cr.set_line_width(0.5)
+            cr.set_source_rgb(0.2, 0.2, 0.2)
+            cr.stroke()
+
+            for i, j, ii, jj in wafer.sampleNotes:
+                if not (cols.start <= i < cols.stop and rows.start <= j < rows.stop):
+                    continue
+                index = (i - cols.start, j - rows.start, ii, jj)
+                if visible[index]:
+                    cx = xs[index] + 0.5*SampSizeX
+                    cy = ys[index] + 0.5*SampSizeY
+                    cr.new_sub_path()
+                    cr.arc(cx, cy, 2, 0, 2.0*np.pi)
+            cr.set_source_rgb(0.1, 0.1, 0.1)
+            cr.fill()
+        cr.restore()
+
+    def drawColorBar(self, cr, layout, lo, hi, title):
+        """Colormap legend from lo to hi in the top right corner, outside the wafer"""
+        width, height = 14, 0.25*min(layout.width, layout.height)
+        x, y = layout.width - width - 10, 30
+        gradient = cairo.LinearGradient(0, y + height, 0, y)
+        for f in np.linspace(0, 1, 9):
+            gradient.add_color_stop_rgb(f, *COLORMAP_RGB[int(round(255*f))])
+        cr.save()
+        cr.rectangle(x, y, width, height)
+        cr.set_source(gradient)
+        cr.fill_preserve()
+        cr.set_line_width(1.0)
+        cr.set_source_rgb(0.2, 0.2, 0.2)
+        cr.stroke()
+        cr.select_font_face("sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        cr.set_font_size(11)
+        labels = [(title, y - 8)]
+        if lo is not None:
+            labels += [("%.4g" % hi, y + 8), ("%.4g" % (0.5*(lo + hi)), y + 0.5*height + 4),
+                       ("%.4g" % lo, y + height)]
+        for text, baseline in labels:
+            # Right aligned: the title with the bar, the values beside it
+            right = x + width if text == title else x - 4
+            cr.move_to(right - cr.text_extents(text)[4], baseline)
+            cr.show_text(text)
+        cr.restore()
+
+    def outlineDevices(self, cr, layout, mask, color, clip=None):
+        """Outline the devices of mask, just outside their rectangles, in one path"""
+        if clip is None:
+            clip = (0, 0, layout.width, layout.height)
+        mask = mask & layout.samplesInRect(*clip)
+        xs, ys = layout.sampleCorners()
+        x0, y0 = layout.toWidget(0.0, 0.0)
+        cr.save()
+        for x, y in zip(xs[mask].tolist(), ys[mask].tolist()):
+            cr.rectangle(x0 + x - 1, y0 + y - 1, layout.sampSizeX + 2, layout.sampSizeY + 2)
+        cr.set_line_width(2.0)
+        cr.set_source_rgb(*color)
+        cr.stroke()
+        cr.restore()
+
+    def drawSelection(self, cr, layout, selection, band=None, clip=None):
+        """Outline the selected devices in one path, plus the rubber band if dragging
+
+        band is (x1, y1, x2, y2) in widget coordinates.
+        """
+        cr.save()
+        if selection is not None:
+            self.outlineDevices(cr, layout, selection, (0.0, 0.3, 1.0), clip)
+        if band is not None:
+            x1, y1, x2, y2 = band
+            cr.rectangle(min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1))
+            cr.set_source_rgba(0.0, 0.3, 1.0, 0.15)
+            cr.fill_preserve()
+            cr.set_line_width(1.0)
+            cr.set_dash([4.0, 4.0])
+            cr.set_source_rgb(0.0, 0.3, 1.0)
+            cr.stroke()
+        cr.restore()
+
+def drawMap(cr, wafer, width, height, renderer=None, layoutSize=None):
+    """Draw a wafer map on white filling a width x height area of cr
+
+    The map is laid out at layoutSize, by default the area itself, and
+    scaled to fit, so that margins and labels keep their on-screen
+    proportions at any output size.
+    """
+    layoutWidth, layoutHeight = layoutSize or (width, height)
+    scale = min(float(width)/layoutWidth, float(height)/layoutHeight)
+    cr.save()
+    cr.rectangle(0, 0, width, height)
+    cr.set_source_rgb(1.0, 1.0, 1.0)
+    cr.fill()
+    cr.translate(0.5*(width - scale*layoutWidth), 0.5*(height - scale*layoutHeight))
+    cr.scale(scale, scale)
+    (renderer or WaferRenderer()).render(cr, wafer, WaferLayout(wafer, layoutWidth, layoutHeight))
+    cr.restore()
+
+EXPORT_EXTENSIONS = (".png", ".pdf", ".svg")
+BAND_PIXELS   = 1 << 22 # Pixels rendered at once for PNG export
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def pngChunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+def pngRows(surface, width, height):
+    """Filtered PNG scanlines of an RGB24 image surface"""
+    pixels = np.frombuffer(surface.get_data(), dtype=np.uint8)
+    pixels = pixels.reshape(height, surface.get_stride())[:, :4*width].reshape(height, width, 4)
+    # Each pixel is a native-endian 32-bit 0x00RRGGBB word
+    rgb = pixels[:, :, 2::-1] if sys.byteorder == "little" else pixels[:, :, 1:]
+    rows = np.zeros((height, 1 + 3*width), dtype=np.uint8) # Leading 0 is filter type None
+    rows[:, 1:] = rgb.reshape(height, 3*width)
+    return rows.tobytes()
+
+def writePNG(wafer, filename, width=800, height=800, scale=1.0, progress=None):
+    """Render a PNG of width x height times scale pixels, one band of rows at a time"""
+    pixelWidth, pixelHeight = int(round(width*scale)), int(round(height*scale))
+    band = max(1, min(pixelHeight, BAND_PIXELS // max(pixelWidth, 1)))
+    renderer = WaferRenderer()
+    compressor = zlib.compressobj(6)
+    with atomicFile(filename) as f:
+        f.write(PNG_SIGNATURE)
+        f.write(pngChunk(b"IHDR", struct.pack(">IIBBBBB", pixelWidth, pixelHeight, 8, 2, 0, 0, 0)))
+        for top in range(0, pixelHeight, band):
+            rows = min(band, pixelHeight - top)
+            surface = cairo.ImageSurface(cairo.FORMAT_RGB24, pixelWidth, rows)
+            cr = cairo.Context(surface)
+            cr.translate(0, -top)
+            # Lets the renderer skip the dies and devices outside this band
+            cr.rectangle(0, top, pixelWidth, rows)
+            cr.clip()
+            drawMap(cr, wafer, pixelWidth, pixelHeight, renderer, (width, height))
+            surface.flush()
+            data = compressor.compress(pngRows(surface, pixelWidth, rows))
+            if data:
+                f.write(pngChunk(b"IDAT", data))
+            if progress is not None:
+                progress(float(top + rows)/pixelHeight)
+        f.write(pngChunk(b"IDAT", compressor.flush()))
+        f.write(pngChunk(b"IEND", b""))
+
+def exportWafer(wafer, filename, width=800, height=800, scale=1.0, progress=None):
+    """Write a wafer map as PNG, PDF or SVG, chosen by the extension of filename
+
+    PDF and SVG pages are width x height points of vector graphics; PNGs
+    have scale pixels per point.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".png":
+        writePNG(wafer, filename, width, height, scale, progress)
+        return
+    if extension not in EXPORT_EXTENSIONS:
+        raise ValueError("cannot export to %s, use one of %s" % (filename, ", ".join(EXPORT_EXTENSIONS)))
+    surfaceType = cairo.PDFSurface if extension == ".pdf" else cairo.SVGSurface
+    with atomicFile(filename) as f:
+        surface = surfaceType(f, width, height)
+        drawMap(cairo.Context(surface), wafer, width, height)
+        surface.finish()
+    if progress is not None:
+        progress(1.0)
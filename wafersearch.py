@@ -0,0 +1,124 @@
+"""Full-text search over the notes of devices, dies and wafers
+
+NotesIndex is an inverted index from each lower-cased word to the notes
+containing it. Keys are (source, kind, index) with kind "sample", "die" or
+"wafer" as in Change records, and source naming the wafer file, so one
+index can hold the notes of many wafers. Attached to a wafer it follows
+the Change records of notes edits, re-indexing only the note that changed.
+
+A query matches the notes containing every one of its words, each as a
+word prefix ("remeas" finds "remeasure", "remeasured"). Prefixes are
+looked up by bisecting a sorted list of the words, which is sorted once
+and then kept in order as words come and go, so queries never scan the
+notes themselves.
+"""
+
+import bisect
+import re
+import numpy as np
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    return set(word.lower() for word in WORD.findall(text))
+
+class NotesIndex(object):
+    """Word index over the notes of one wafer or of many"""
+    def __init__(self, wafer=None, source=None):
+        self.postings = {}   # word -> set of keys
+        self.texts = {}      # key -> note
+        self.words = None    # Sorted postings keys for prefix matches, sorted on first use
+        self.wafer = wafer
+        self.source = source
+        if wafer is not None:
+            self.addWafer(wafer, source)
+
+    def attach(self):
+        self.wafer.addListener(self.record)
+
+    def detach(self):
+        self.wafer.removeListener(self.record)
+
+    def addWafer(self, wafer, source=None):
+        """Index every note of wafer under source"""
+        self.addNotes(source, notesOf(wafer))
+
+    def addNotes(self, source, notes):
+        """Index (kind, index, text) triples, e.g. from notesOf in another process"""
+        for kind, index, text in notes:
+            self.update((source, kind, tuple(index)), text)
+
+    def update(self, key, text):
+        """Replace the note at key, re-indexing only its words"""
+        old = self.texts.pop(key, "")
+        oldWords, newWords = tokenize(old), tokenize(text)
+        for word in oldWords - newWords:
+            keys = self.postings[word]
+            keys.discard(key)
+            if not keys:
+                del self.postings[word]
+                if self.words is not None:
+                    del self.words[bisect.bisect_left(self.words, word)]
+        for word in newWords - oldWords:
+            if word not in self.postings:
+                self.postings[word] = set()
+                if self.words is not None:
+                    bisect.insort(self.words, word)
+            self.postings[word].add(key)
+        if text:
+            self.texts[key] = text
+
+    def record(self, change):
+        if change.field != "notes":
+            return
+        if change.kind == "samples":
+            for n, text in enumerate(change.new):
+                self.update((self.source, "sample", tuple(int(a[n]) for a in change.index)), text)
+        else:
+            self.update((self.source, change.kind, tuple(change.index)), change.new)
+
+    def matching(self, prefix):
+        """Keys of the notes with a word starting with prefix"""
+        if self.words is None:
+            self.words = sorted(self.postings)
+        keys = set()
+        n = bisect.bisect_left(self.words, prefix)
+        while n < len(self.words) and self.words[n].startswith(prefix):
+            keys |= self.postings[self.words[n]]
+            n += 1
+        return keys
+
+    def search(self, query):
+        """Set of the keys of the notes matching every word of query"""
+        words = sorted(tokenize(query), key=len, reverse=True) # Longest, likely rarest, first
+        if not words:
+            return set()
+        found = self.matching(words[0])
+        for word in words[1:]:
+            if not found:
+                break
+            found &= self.matching(word)
+        return found
+
+def notesOf(wafer):
+    """(kind, index, text) of every note of a wafer"""
+    notes = [("wafer", (), wafer.notes)] if wafer.notes else []
+    notes += [("die", index, text) for index, text in wafer.dieNotes.items()]
+    notes += [("sample", index, text) for index, text in wafer.sampleNotes.items()]
+    return notes
+
+def matchMask(keys, shape, source=None):
+    """Mask of the devices that matched, whole dies for die notes, from search keys"""
+    mask = np.zeros(shape, dtype=bool)
+    for kind in ("sample", "die"):
+        indices = [index for keySource, keyKind, index in keys if keySource == source and keyKind == kind]
+        if indices:
+            mask[tuple(np.array(indices, dtype=int).T)] = True
+    return mask
+
+def describeMatches(keys):
+    kinds = [key[1] for key in keys]
+    text = "%d devices and %d dies" % (kinds.count("sample"), kinds.count("die"))
+    if "wafer" in kinds:
+        text += ", and the wafer's notes"
+    return text
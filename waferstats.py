@@ -0,0 +1,147 @@
+"""Yield and thickness statistics per die, die row, die column and wafer
+
+Everything is computed once with array reductions, then kept current from
+the Change records of Wafer.setField: a status change moves one count in
+each of the four levels and a thickness change adjusts running sums, so
+edits never rescan the wafer. Only the minimum and maximum thickness of the
+edited die are recomputed, from that die's devices alone.
+
+Thickness statistics only cover devices with a non-zero thickness, since
+zero means the device has not been measured.
+"""
+
+import collections
+import numpy as np
+
+STATUSES = (1, 2, 3) # Alive, dead, unmeasured
+
+ThicknessSummary = collections.namedtuple("ThicknessSummary", "count mean std min max")
+
+class YieldStats(object):
+    """Live device counts and thickness summaries of one wafer
+
+    Levels are picked with the die indices: (i, j) is one die, i alone a die
+    column, j alone a die row, and neither the whole wafer.
+    """
+    def __init__(self, wafer):
+        self.wafer = wafer
+        self.compute()
+
+    def attach(self):
+        self.wafer.addListener(self.record)
+
+    def detach(self):
+        self.wafer.removeListener(self.record)
+
+    def compute(self):
+        """Recount everything from the wafer arrays"""
+        status = self.wafer.sampleStatus
+        # Counts of each status, shaped (cols, rows, 3) per die
+        self.dieCounts = np.stack([np.sum(status == s, axis=(2, 3)) for s in STATUSES], axis=-1)
+        self.colCounts = self.dieCounts.sum(axis=1)
+        self.rowCounts = self.dieCounts.sum(axis=0)
+        self.waferCounts = self.dieCounts.sum(axis=(0, 1))
+
+        thick = self.wafer.sampleThick
+        measured = thick != 0.0
+        self.dieN     = measured.sum(axis=(2, 3))
+        self.dieSum   = np.where(measured, thick, 0.0).sum(axis=(2, 3))
+        self.dieSumSq = np.where(measured, thick**2, 0.0).sum(axis=(2, 3))
+        self.dieMin   = np.where(measured, thick, np.inf).min(axis=(2, 3))
+        self.dieMax   = np.where(measured, thick, -np.inf).max(axis=(2, 3))
+
+    def record(self, change):
+        if change.kind == "samples":
+            self.recordBulk(change)
+        if change.kind != "sample":
+            return
+        i, j = change.index[:2]
+        if change.field == "status":
+            for status, step in ((change.old, -1), (change.new, 1)):
+                if status in STATUSES:
+                    k = status - 1
+                    self.dieCounts[i, j, k] += step
+                    self.colCounts[i, k]    += step
+                    self.rowCounts[j, k]    += step
+                    self.waferCounts[k]     += step
+        elif change.field == "thick":
+            for thick, step in ((change.old, -1), (change.new, 1)):
+                if thick != 0.0:
+                    self.dieN[i, j]     += step
+                    self.dieSum[i, j]   += step*thick
+                    self.dieSumSq[i, j] += step*thick**2
+            self.updateRange(i, j)
+
+    def updateRange(self, i, j):
+        """Recompute the thickness range of one die from its own devices"""
+        dieThick = self.wafer.sampleThick[i, j]
+        measured = dieThick[dieThick != 0.0]
+        self.dieMin[i, j] = measured.min() if measured.size else np.inf
+        self.dieMax[i, j] = measured.max() if measured.size else -np.inf
+
+    def recordBulk(self, change):
+        """Vectorized version of record for a bulk edit of many devices"""
+        I, J = change.index[:2]
+        if change.field == "status":
+            for status, step in ((change.old, -1), (change.new, 1)):
+                status = np.asarray(status, dtype=int)
+                valid = np.isin(status, STATUSES)
+                i, j, k = I[valid], J[valid], status[valid] - 1
+                np.add.at(self.dieCounts, (i, j, k), step)
+                np.add.at(self.colCounts, (i, k), step)
+                np.add.at(self.rowCounts, (j, k), step)
+                np.add.at(self.waferCounts, k, step)
+        elif change.field == "thick":
+            for thick, step in ((change.old, -1), (change.new, 1)):
+                thick = np.asarray(thick, dtype=float)
+                measured = thick != 0.0
+                i, j, t = I[measured], J[measured], thick[measured]
+                np.add.at(self.dieN, (i, j), step)
+                np.add.at(self.dieSum, (i, j), step*t)
+                np.add.at(self.dieSumSq, (i, j), step*t**2)
+            for i, j in set(zip(I.tolist(), J.tolist())):
+                self.updateRange(i, j)
+
+    def select(self, i, j):
+        """Index into the per-die arrays for a die, a die column, a die row or the wafer"""
+        return (slice(None) if i is None else i, slice(None) if j is None else j)
+
+    def counts(self, i=None, j=None):
+        """(alive, dead, unmeasured) device counts"""
+        if i is not None and j is not None:
+            counts = self.dieCounts[i, j]
+        elif i is not None:
+            counts = self.colCounts[i]
+        elif j is not None:
+            counts = self.rowCounts[j]
+        else:
+            counts = self.waferCounts
+        return tuple(int(n) for n in counts)
+
+    def yieldFraction(self, i=None, j=None):
+        """Alive fraction of the measured devices, or None if none are measured"""
+        alive, dead, unmeasured = self.counts(i, j)
+        return float(alive)/(alive + dead) if alive + dead else None
+
+    def thickness(self, i=None, j=None):
+        """ThicknessSummary of the measured devices; mean etc. are None if there are none"""
+        index = self.select(i, j)
+        n = int(np.sum(self.dieN[index]))
+        if n == 0:
+            return ThicknessSummary(0, None, None, None, None)
+        mean = float(np.sum(self.dieSum[index]))/n
+        variance = max(float(np.sum(self.dieSumSq[index]))/n - mean**2, 0.0)
+        return ThicknessSummary(n, mean, variance**0.5,
+                                float(np.min(self.dieMin[index])), float(np.max(self.dieMax[index])))
+
+    def describe(self, i=None, j=None):
+        """One line summary for display"""
+        alive, dead, unmeasured = self.counts(i, j)
+        text = "%d alive, %d dead, %d unmeasured" % (alive, dead, unmeasured)
+        fraction = self.yieldFraction(i, j)
+        if fraction is not None:
+            text += ", yield %.1f%%" % (100.0*fraction)
+        thick = self.thickness(i, j)
+        if thick.count:
+            text += ", thick %.3g +/- %.2g (%.3g-%.3g)" % (thick.mean, thick.std, thick.min, thick.max)
+        return text
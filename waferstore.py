@@ -0,0 +1,319 @@
+"""SQLite store holding whole lots of wafers for cross-wafer queries
+
+Wafers, dies and devices become rows of the wafers, dies and samples tables,
+indexed by wafer, die position, status and thickness, so questions such as
+"alive devices between 8 and 10 nm across a lot" are one indexed query
+instead of a parse of every wafer file. A wafer in a store is named like a
+file as "<store>#<lot>/<wafer>", e.g. lots.wdb#2013Q2/W07.
+
+Wafers opened from a store remember which devices and dies were edited, and
+saving them back only rewrites those rows. Each thread gets its own
+connection, so loads and saves can run in a worker while the GUI goes on.
+"""
+
+import json
+import sqlite3
+import threading
+
+import numpy as np
+from wafercore import Wafer, CORNERS, WAFER_FIELDS, dieName, sampleName
+
+# Columns of the wafers table besides id and lot: the Wafer constructor
+# arguments, plain attributes, and the wedge fit state as JSON
+SHAPE_COLUMNS = ["name", "waferRows", "waferCols", "dieRows", "dieCols",
+                 "startingRowLetter", "startingColLetter"]
+ATTRIBUTE_COLUMNS = ["status", "wedgeMx", "wedgeMy", "wedgeC"] + [f for f in WAFER_FIELDS if f != "name"]
+WAFER_COLUMNS = SHAPE_COLUMNS + ATTRIBUTE_COLUMNS + ["wedgeFit"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS wafers (
+    id INTEGER PRIMARY KEY, lot TEXT NOT NULL, name TEXT NOT NULL,
+    waferRows INTEGER, waferCols INTEGER, dieRows INTEGER, dieCols INTEGER,
+    startingRowLetter TEXT, startingColLetter TEXT, status INTEGER,
+    wedgeMx REAL, wedgeMy REAL, wedgeC REAL, wedgeFit TEXT,
+    notes TEXT, wedge INTEGER, dieSpacingX REAL, dieSpacingY REAL,
+    sampleSpacingX REAL, sampleSpacingY REAL,
+    UNIQUE (lot, name));
+CREATE TABLE IF NOT EXISTS dies (
+    wafer INTEGER NOT NULL REFERENCES wafers(id), i INTEGER, j INTEGER, status INTEGER,
+    thickTopRight REAL, thickTopLeft REAL, thickBotLeft REAL, thickBotRight REAL, notes TEXT,
+    PRIMARY KEY (wafer, i, j));
+CREATE TABLE IF NOT EXISTS samples (
+    wafer INTEGER NOT NULL REFERENCES wafers(id), i INTEGER, j INTEGER, ii INTEGER, jj INTEGER,
+    status INTEGER, thick REAL, sizeX REAL, sizeY REAL, notes TEXT,
+    PRIMARY KEY (wafer, i, j, ii, jj));
+CREATE INDEX IF NOT EXISTS dies_position ON dies (i, j);
+CREATE INDEX IF NOT EXISTS samples_position ON samples (i, j, ii, jj);
+CREATE INDEX IF NOT EXISTS samples_status_thick ON samples (status, thick);
+CREATE INDEX IF NOT EXISTS samples_thick ON samples (thick);
+"""
+
+SAMPLE_UPDATE = ("UPDATE samples SET status=?, thick=?, sizeX=?, sizeY=?, notes=? "
+                 "WHERE wafer=? AND i=? AND j=? AND ii=? AND jj=?")
+DIE_UPDATE    = ("UPDATE dies SET status=?, %s, notes=? WHERE wafer=? AND i=? AND j=?"
+                 % ", ".join("%s=?" % corner for corner in CORNERS))
+
+class ChangeTracker(object):
+    """Indices of the devices and dies of one stored wafer edited since it was last saved"""
+    def __init__(self, waferId, key=None):
+        self.waferId = waferId
+        self.key     = key # (lot, name) the wafer is stored under, None until it is stored
+        self.clear()
+
+    def record(self, change):
+        if change.kind == "sample":
+            self.samples.add(change.index)
+        elif change.kind == "samples":
+            self.samples.update(zip(*[a.tolist() for a in change.index]))
+        elif change.kind == "die":
+            self.dies.add(change.index)
+        else:
+            self.wafer = True
+
+    def clear(self):
+        self.samples = set()
+        self.dies    = set()
+        self.wafer   = False
+
+    def take(self):
+        """Copy of the edits so far, which are cleared here"""
+        edits = ChangeTracker(self.waferId, self.key)
+        edits.samples, edits.dies, edits.wafer = self.samples, self.dies, self.wafer
+        self.clear()
+        return edits
+
+    def restore(self, edits):
+        """Put back edits taken for a save that failed"""
+        self.samples |= edits.samples
+        self.dies    |= edits.dies
+        self.wafer    = self.wafer or edits.wafer
+
+class PendingSave(object):
+    """What one save writes, taken from the wafer by WaferStore.beginSave"""
+    def __init__(self, wafer, tracker, lot):
+        self.wafer      = wafer
+        self.tracker    = tracker
+        self.edits      = tracker.take()
+        self.lot        = lot
+        self.name       = wafer.name
+        self.snapshot   = None # Copy of a wafer imported whole
+        self.waferRow   = None # Set if the wafers row is rewritten
+        self.dieRows    = []
+        self.sampleRows = []
+
+class WaferStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.db.executescript(SCHEMA)
+        self.trackers = {} # Wafer opened from the store -> ChangeTracker
+
+    @property
+    def db(self):
+        """This thread's connection, as sqlite3 connections may not be shared between threads"""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path)
+        return db
+
+    def close(self):
+        for wafer in list(self.trackers):
+            self.untrack(wafer)
+        self.db.close()
+        self.local.db = None
+
+    def waferId(self, lot, name):
+        row = self.db.execute("SELECT id FROM wafers WHERE lot=? AND name=?", (lot, name)).fetchone()
+        return row[0] if row else None
+
+    def listWafers(self, lot=None):
+        """(lot, name) of every stored wafer, optionally of one lot only"""
+        if lot is None:
+            return self.db.execute("SELECT lot, name FROM wafers ORDER BY lot, name").fetchall()
+        return self.db.execute("SELECT lot, name FROM wafers WHERE lot=? ORDER BY name", (lot,)).fetchall()
+
+    @staticmethod
+    def waferRow(wafer):
+        return ([getattr(wafer, column) for column in SHAPE_COLUMNS + ATTRIBUTE_COLUMNS] +
+                [json.dumps(wafer.wedgeFitState())])
+
+    def importWafer(self, wafer, lot=""):
+        """Store a whole wafer under lot, replacing a stored wafer of the same name
+
+        Other wafers opened from the replaced one are no longer tracked, so
+        their saves cannot write into the rows of the replacement.
+        """
+        with self.db:
+            waferId = self.waferId(lot, wafer.name)
+            if waferId is not None:
+                for other, tracker in list(self.trackers.items()):
+                    if tracker.waferId == waferId and other is not wafer:
+                        self.untrack(other)
+                for table in ("samples", "dies"):
+                    self.db.execute("DELETE FROM %s WHERE wafer=?" % table, (waferId,))
+                self.db.execute("DELETE FROM wafers WHERE id=?", (waferId,))
+            waferId = self.insertWafer(wafer, lot)
+        tracker = self.trackers.get(wafer)
+        if tracker is not None:
+            tracker.waferId, tracker.key = waferId, (lot, wafer.name)
+            tracker.clear()
+        return waferId
+
+    def insertWafer(self, wafer, lot):
+        cursor = self.db.execute("INSERT INTO wafers (lot, %s) VALUES (?%s)" %
+                                 (", ".join(WAFER_COLUMNS), ", ?"*len(WAFER_COLUMNS)),
+                                 [lot] + self.waferRow(wafer))
+        waferId = cursor.lastrowid
+        self.db.executemany("INSERT INTO dies VALUES (?,?,?,?,?,?,?,?,?)", self.dieRows(wafer, waferId))
+        self.db.executemany("INSERT INTO samples VALUES (?,?,?,?,?,?,?,?,?,?)", self.sampleRows(wafer, waferId))
+        return waferId
+
+    @staticmethod
+    def dieRows(wafer, waferId, indices=None):
+        """Rows for the dies table, for all dies or just the given (i, j)"""
+        if indices is None:
+            indices = [tuple(n) for n in np.ndindex(wafer.dieStatus.shape)]
+        notes = wafer.dieNotes
+        status = wafer.dieStatus.tolist()
+        thick = wafer.dieThick.tolist()
+        return ((waferId, i, j, status[i][j]) + tuple(thick[i][j]) + (notes.get((i, j)),)
+                for i, j in indices)
+
+    @staticmethod
+    def sampleRows(wafer, waferId):
+        indices = np.indices(wafer.sampleStatus.shape).reshape(4, -1).T.tolist()
+        columns = [getattr(wafer, field).ravel().tolist()
+                   for field in ("sampleStatus", "sampleThick", "sampleSizeX", "sampleSizeY")]
+        notes = wafer.sampleNotes
+        return ((waferId, i, j, ii, jj, status, thick, sizeX, sizeY, notes.get((i, j, ii, jj)))
+                for (i, j, ii, jj), status, thick, sizeX, sizeY in zip(indices, *columns))
+
+    def openWafer(self, lot, name):
+        """Load a stored wafer, tracking its edits so saveWafer only writes those rows"""
+        row = self.db.execute("SELECT id, %s FROM wafers WHERE lot=? AND name=?" %
+                              ", ".join(WAFER_COLUMNS), (lot, name)).fetchone()
+        if row is None:
+            raise KeyError("No wafer %s in lot %r of %s" % (name, lot, self.path))
+        waferId, values = row[0], dict(zip(WAFER_COLUMNS, row[1:]))
+        w = Wafer(*[values[column] for column in SHAPE_COLUMNS])
+        for column in ATTRIBUTE_COLUMNS:
+            setattr(w, column, values[column])
+        w.setWedgeFitState(json.loads(values["wedgeFit"]))
+
+        dies = np.array(self.db.execute("SELECT i, j, status, %s FROM dies WHERE wafer=?" %
+                                        ", ".join(CORNERS), (waferId,)).fetchall(), dtype=float)
+        if len(dies):
+            i, j = dies[:,0].astype(int), dies[:,1].astype(int)
+            w.dieStatus[i, j] = dies[:,2]
+            w.dieThick[i, j] = dies[:,3:]
+        samples = np.array(self.db.execute("SELECT i, j, ii, jj, status, thick, sizeX, sizeY "
+                                           "FROM samples WHERE wafer=?", (waferId,)).fetchall(), dtype=float)
+        if len(samples):
+            index = tuple(samples[:,:4].astype(int).T)
+            for column, field in enumerate(("sampleStatus", "sampleThick", "sampleSizeX", "sampleSizeY")):
+                getattr(w, field)[index] = samples[:,4+column]
+        for i, j, text in self.db.execute("SELECT i, j, notes FROM dies WHERE wafer=? AND notes IS NOT NULL",
+                                          (waferId,)):
+            w.dieNotes[(i, j)] = text
+        for i, j, ii, jj, text in self.db.execute("SELECT i, j, ii, jj, notes FROM samples "
+                                                  "WHERE wafer=? AND notes IS NOT NULL", (waferId,)):
+            w.sampleNotes[(i, j, ii, jj)] = text
+
+        self.track(w, waferId, (lot, name))
+        return w
+
+    def track(self, wafer, waferId, key=None):
+        tracker = ChangeTracker(waferId, key)
+        wafer.addListener(tracker.record)
+        self.trackers[wafer] = tracker
+        return tracker
+
+    def untrack(self, wafer):
+        """Stop tracking a wafer opened from the store, e.g. once it is closed"""
+        tracker = self.trackers.pop(wafer, None)
+        if tracker is not None:
+            wafer.removeListener(tracker.record)
+
+    def saveWafer(self, wafer, lot=None):
+        """Write back the edited rows of a wafer opened from this store, or import it whole
+
+        lot defaults to the one the wafer was opened from, or "" for a new
+        one. A tracked wafer saved under another lot, e.g. by Save As, is
+        imported there whole and tracked as that copy; a renamed one keeps
+        its rows. Either way later saves of the same wafer only write what
+        changed. Raises ValueError rather than overwrite another stored wafer.
+        """
+        pending = self.beginSave(wafer, lot)
+        try:
+            return self.writeSave(pending)
+        except:
+            self.abortSave(pending)
+            raise
+
+    def beginSave(self, wafer, lot=None):
+        """First half of saveWafer: take what it writes, on the thread editing the wafer
+
+        Only the edited rows are copied, or the whole wafer if it is imported.
+        writeSave may then run in another thread while editing goes on, and
+        the edits made meanwhile are tracked for the next save.
+        """
+        tracker = self.trackers.get(wafer)
+        if tracker is None:
+            tracker = self.track(wafer, None)
+        stored = tracker.key
+        if lot is None:
+            lot = stored[0] if stored else ""
+        pending = PendingSave(wafer, tracker, lot)
+        if stored is None or lot != stored[0]:
+            pending.snapshot = wafer.copy()
+            return pending
+        waferId, edits = tracker.waferId, pending.edits
+        if edits.wafer or wafer.name != stored[1]: # Renamed: the wafers row gets the new name
+            pending.waferRow = self.waferRow(wafer) + [waferId]
+        pending.dieRows = [row[3:] + row[:3] for row in self.dieRows(wafer, waferId, sorted(edits.dies))]
+        for index in sorted(edits.samples):
+            pending.sampleRows.append([wafer.getField("sample", index, field) for field in
+                                       ("status", "thick", "sizeX", "sizeY")] +
+                                      [wafer.sampleNotes.get(index), waferId] + list(index))
+        return pending
+
+    def writeSave(self, pending):
+        """Second half of saveWafer: write what beginSave took, from any thread"""
+        lot, name = pending.lot, pending.name
+        with self.db:
+            if (lot, name) != pending.edits.key and self.waferId(lot, name) is not None:
+                raise ValueError("lot %r of %s already holds a wafer named %s" % (lot, self.path, name))
+            if pending.snapshot is not None:
+                waferId = self.insertWafer(pending.snapshot, lot)
+            else:
+                waferId = pending.edits.waferId
+                if pending.waferRow is not None:
+                    self.db.execute("UPDATE wafers SET %s WHERE id=?" %
+                                    ", ".join("%s=?" % column for column in WAFER_COLUMNS), pending.waferRow)
+                self.db.executemany(DIE_UPDATE, pending.dieRows)
+                self.db.executemany(SAMPLE_UPDATE, pending.sampleRows)
+        pending.tracker.waferId, pending.tracker.key = waferId, (lot, name)
+        return waferId
+
+    def abortSave(self, pending):
+        """Undo beginSave after writeSave failed, on the thread editing the wafer"""
+        if pending.edits.key is None:
+            self.untrack(pending.wafer) # Never stored, so the next save imports it whole
+        elif self.trackers.get(pending.wafer) is pending.tracker:
+            pending.tracker.restore(pending.edits)
+
+    def findSamples(self, lot=None, wafer=None, status=None, thickMin=None, thickMax=None):
+        """Devices matching every given condition, as (lot, wafer, die, device, status, thick)"""
+        conditions, params = [], []
+        for clause, value in (("w.lot = ?", lot), ("w.name = ?", wafer), ("s.status = ?", status),
+                              ("s.thick >= ?", thickMin), ("s.thick <= ?", thickMax)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        sql = ("SELECT w.lot, w.name, w.startingColLetter, w.startingRowLetter, "
+               "s.i, s.j, s.ii, s.jj, s.status, s.thick FROM samples s JOIN wafers w ON s.wafer = w.id")
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY w.lot, w.name, s.i, s.j, s.ii, s.jj"
+        return [(r[0], r[1], dieName(r[4], r[5], r[2], r[3]), sampleName(r[6], r[7]), r[8], r[9])
+                for r in self.db.execute(sql, params)]
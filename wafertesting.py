@@ -0,0 +1,96 @@
+"""Synthetic wafers and random edits shared by the tests and the benchmarks
+
+randomEdits makes a reproducible mix of the edits a user can make, each
+through Wafer.setField or Wafer.setSamples so listeners see them, and
+assertSameWafer compares everything a wafer file holds.
+"""
+
+import numpy as np
+from wafercore import Wafer, ARRAY_FIELDS, WAFER_FIELDS
+
+NOTE_WORDS = ["remeasure", "remeasured", "crack", "cracked", "probe", "dust", "re"]
+
+def syntheticWafer(waferRows, waferCols, dieRows, dieCols, seed=0, noteFraction=0.01):
+    """A wafer with random statuses, a noisy thickness wedge and scattered notes"""
+    rng = np.random.RandomState(seed)
+    w = Wafer("Bench %dx%d/%dx%d" % (waferRows, waferCols, dieRows, dieCols),
+              waferRows, waferCols, dieRows, dieCols)
+    w.sampleStatus[...] = rng.randint(1, 4, w.sampleStatus.shape)
+    X, Y = w.getAllSampleCoords()
+    w.sampleThick[...] = 9.0 + 0.02*X - 0.01*Y + 0.05*rng.randn(*X.shape)
+    w.sampleSizeX[...] = rng.uniform(0.1, 0.5, X.shape)
+    w.sampleSizeY[...] = rng.uniform(0.1, 0.5, X.shape)
+    GX, GY = w.getAllGratingCoords()
+    w.dieThick[...] = 9.0 + 0.02*GX - 0.01*GY + 0.05*rng.randn(*GX.shape)
+    for index in zip(*np.nonzero(rng.rand(*X.shape) < noteFraction)):
+        w.sampleNotes[tuple(int(n) for n in index)] = "note %d" % rng.randint(1000)
+    for index in zip(*np.nonzero(rng.rand(waferCols, waferRows) < 0.1)):
+        w.dieNotes[tuple(int(n) for n in index)] = "die note"
+    return w
+
+def randomText(rng):
+    """A few note words, or now and then an empty note, which removes it"""
+    return " ".join(rng.choice(NOTE_WORDS, rng.randint(0, 3)))
+
+def randomThick(rng):
+    """A thickness, or now and then zero for an unmeasured device"""
+    return 0.0 if rng.rand() < 0.2 else round(rng.uniform(8, 10), 3)
+
+def randomMask(wafer, rng):
+    return rng.rand(*wafer.sampleStatus.shape) < 0.05
+
+def setStatus(wafer, rng, sample):
+    wafer.setField("sample", sample, "status", rng.randint(1, 4))
+
+def setThick(wafer, rng, sample):
+    wafer.setField("sample", sample, "thick", randomThick(rng))
+
+def setNotes(wafer, rng, sample):
+    wafer.setField("sample", sample, "notes", randomText(rng))
+
+def setDieStatus(wafer, rng, sample):
+    wafer.setField("die", sample[:2], "status", rng.randint(-1, 4))
+
+def setDieCorner(wafer, rng, sample):
+    wafer.setField("die", sample[:2], "thickTopLeft", randomThick(rng))
+
+def setDieNotes(wafer, rng, sample):
+    wafer.setField("die", sample[:2], "notes", randomText(rng))
+
+def setWaferNotes(wafer, rng, sample):
+    wafer.setField("wafer", (), "notes", randomText(rng))
+
+def bulkStatus(wafer, rng, sample):
+    wafer.setSamples(randomMask(wafer, rng), "status", rng.randint(1, 4))
+
+def bulkThick(wafer, rng, sample):
+    mask = randomMask(wafer, rng)
+    wafer.setSamples(mask, "thick", [randomThick(rng) for n in range(int(mask.sum()))])
+
+def bulkSize(wafer, rng, sample):
+    wafer.setSamples(randomMask(wafer, rng), "sizeX", round(rng.uniform(0.1, 0.5), 3))
+
+def bulkNotes(wafer, rng, sample):
+    wafer.setSamples(randomMask(wafer, rng), "notes", randomText(rng))
+
+STATUS_EDITS = [setStatus, bulkStatus]
+THICK_EDITS  = [setThick, bulkThick]
+NOTES_EDITS  = [setNotes, setDieNotes, bulkNotes, setWaferNotes]
+ALL_EDITS    = [setStatus, setThick, setNotes, setDieStatus, setDieCorner, setDieNotes,
+                setWaferNotes, bulkStatus, bulkThick, bulkSize, bulkNotes]
+
+def randomEdits(wafer, seed, count, edits=ALL_EDITS):
+    """Make count edits, taking turns through edits, at random devices and dies"""
+    rng = np.random.RandomState(seed)
+    for n in range(count):
+        sample = tuple(rng.randint(size) for size in wafer.sampleStatus.shape)
+        edits[n % len(edits)](wafer, rng, sample)
+
+def assertSameWafer(a, b):
+    """Fail unless the two wafers hold the same arrays, notes and wafer fields"""
+    for field, dtype in ARRAY_FIELDS:
+        assert np.array_equal(getattr(a, field), getattr(b, field)), field
+    for field in WAFER_FIELDS:
+        assert getattr(a, field) == getattr(b, field), field
+    assert a.sampleNotes == b.sampleNotes
+    assert a.dieNotes == b.dieNotes
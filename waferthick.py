@@ -0,0 +1,135 @@
+"""Predicted thickness of every device from the die corner gratings
+
+Within each die the four corner thicknesses are interpolated bilinearly to
+the device positions: one set of weights per device position, shared by all
+dies, applied to every die at once with a single tensordot. Corners that
+have not been measured (zero, as in Wafer.fitWedge) take the value of the
+wedge fit at their grating instead, so a die with missing corners still
+gets a prediction, and without any fit its devices are NaN. The gratings
+form a rectangle, so a linear wedge is reproduced exactly, even at devices
+lying outside the gratings.
+
+ThicknessMap keeps the result current: as a wafer listener it recomputes
+only the die whose corner changed, and a new wedge fit or new spacings
+(which are not Change records) are noticed when the map is next read.
+"""
+
+import csv
+import io
+import sys
+
+import numpy as np
+from wafercore import CORNERS, GRATING_OFFSETS
+from waferio import atomicFile, reportProgress, toText
+
+def hasWedgeFit(wafer):
+    return wafer.wedgeCoeffs is not None or wafer.wedgeC != 0.0
+
+def cornerWeights(wafer):
+    """Bilinear weight of each corner for each device position, shaped (dieCols, dieRows, 4)"""
+    X, Y = wafer.getAllSampleCoords()
+    centerX, centerY = wafer.dieCenterCoords()
+    # Device offsets from the die centre are the same in every die
+    offX = X[0,0,:,0] - centerX[0,0]
+    offY = Y[0,0,0,:] - centerY[0,0]
+    corners = dict(zip(CORNERS, GRATING_OFFSETS))
+    left, bottom = corners["thickBotLeft"]
+    right, top   = corners["thickTopRight"]
+    u = ((offX - left)/(right - left))[:,None]
+    v = ((offY - bottom)/(top - bottom))[None,:]
+    weights = {"thickTopRight": u*v,     "thickTopLeft":  (1-u)*v,
+               "thickBotLeft":  (1-u)*(1-v), "thickBotRight": u*(1-v)}
+    return np.stack(np.broadcast_arrays(*[weights[corner] for corner in CORNERS]), axis=-1)
+
+def cornerValues(wafer, index=Ellipsis):
+    """Corner thicknesses of the dies at index, with the fit standing in for unmeasured ones"""
+    values = np.array(wafer.dieThick[index], dtype=float)
+    missing = values == 0.0
+    if missing.any():
+        if hasWedgeFit(wafer):
+            X, Y = wafer.getAllGratingCoords()
+            values[missing] = wafer.wedgeThickness(X[index][missing], Y[index][missing])
+        else:
+            values[missing] = np.nan
+    return values
+
+def predictThickness(wafer):
+    """Predicted thickness of every device, shaped like sampleThick"""
+    return np.tensordot(cornerValues(wafer), cornerWeights(wafer), axes=([2], [2]))
+
+class ThicknessMap(object):
+    """Predicted device thicknesses of one wafer, computed once and kept current"""
+    def __init__(self, wafer):
+        self.wafer = wafer
+        self.predicted = None
+        self.weights = None
+        self.key = None
+
+    def attach(self):
+        self.wafer.addListener(self.record)
+
+    def detach(self):
+        self.wafer.removeListener(self.record)
+
+    def currentKey(self):
+        """Everything besides the corners that the prediction depends on"""
+        w = self.wafer
+        coeffs = None if w.wedgeCoeffs is None else tuple(w.wedgeCoeffs)
+        return (w.dieSpacingX, w.dieSpacingY, w.sampleSpacingX, w.sampleSpacingY,
+                w.wedgeMx, w.wedgeMy, w.wedgeC, w.wedgeOrder, coeffs)
+
+    def values(self):
+        """The predictions shaped like sampleThick; NaN where there is no data at all"""
+        key = self.currentKey()
+        if self.predicted is None or key != self.key:
+            self.weights = cornerWeights(self.wafer)
+            self.predicted = np.tensordot(cornerValues(self.wafer), self.weights, axes=([2], [2]))
+            self.key = key
+        return self.predicted
+
+    def record(self, change):
+        if self.predicted is not None and change.kind == "die" and change.field in CORNERS:
+            i, j = change.index
+            self.predicted[i, j] = np.tensordot(cornerValues(self.wafer, (i, j)), self.weights, axes=([0], [2]))
+
+    def value(self, i, j, ii, jj):
+        """Prediction for one device, or None if there is none"""
+        t = float(self.values()[i, j, ii, jj])
+        return None if np.isnan(t) else t
+
+TABLE_COLUMNS = ["wafer", "die", "device", "x", "y", "thick", "predicted"]
+
+def writeThicknessTable(wafer, filename, predicted=None, progress=None):
+    """Write measured and predicted thicknesses of all devices as CSV
+
+    The columns are those read by waferimport, plus predicted, so a table can
+    be screened in a spreadsheet and edited results read back. progress, if
+    given, is called with the fraction written every 10000 rows.
+    """
+    if predicted is None:
+        predicted = predictThickness(wafer)
+    X, Y = wafer.getAllSampleCoords()
+    I, J, II, JJ = [a.ravel().tolist() for a in np.indices(predicted.shape)]
+    dies = [[wafer.dieName(i, j) for j in range(wafer.waferRows)] for i in range(wafer.waferCols)]
+    devices = [[wafer.sampleName(ii, jj) for jj in range(wafer.dieRows)] for ii in range(wafer.dieCols)]
+    # Blank cells leave a field alone when the table is imported again
+    thick = ["" if t == 0.0 else repr(t) for t in wafer.sampleThick.ravel().tolist()]
+    predicted = ["" if t != t else "%.4f" % t for t in predicted.ravel().tolist()]
+    rows = zip(I, J, II, JJ, X.ravel().tolist(), Y.ravel().tolist(), thick, predicted)
+    name = toText(wafer.name)
+    with atomicFile(filename) as f:
+        # The csv module wants bytes under Python 2 and text under Python 3
+        if sys.version_info[0] < 3:
+            out, name = f, name.encode("utf-8")
+        else:
+            out = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(TABLE_COLUMNS)
+        for n, (i, j, ii, jj, x, y, t, p) in enumerate(rows):
+            writer.writerow([name, dies[i][j], devices[ii][jj], "%.4f" % x, "%.4f" % y, t, p])
+            if n % 10000 == 9999:
+                reportProgress(progress, n + 1, len(thick))
+        if out is not f:
+            out.flush()
+            out.detach() # Leave the file to atomicFile
+    reportProgress(progress, 1, 1)
@@ -0,0 +1,122 @@
+"""Undo and redo of wafer edits
+
+The history listens to Wafer.setField and keeps the Change records it
+reports, which hold just the index with the old and new value of one field.
+A bulk edit is one record, but counts against the limit once per device.
+A step is the list of changes made by one user action; edits made inside
+grouped() become a single step.
+"""
+
+import collections
+import contextlib
+
+def stepSize(step):
+    """Number of device or die edits in a step, counting each device of a bulk edit"""
+    return sum(len(change.old) if change.kind == "samples" else 1 for change in step)
+
+class UndoHistory(object):
+    """Undo and redo stacks for one wafer, holding at most maxChanges records
+
+    onChange, if given, is called whenever what can be undone or redone changes.
+    """
+    def __init__(self, wafer, maxChanges=10000, onChange=None):
+        self.wafer      = wafer
+        self.maxChanges = maxChanges
+        self.onChange   = onChange
+        self.undoSteps  = collections.deque()
+        self.redoSteps  = []
+        self.changes    = 0 # Records held by undoSteps
+        self.group      = None
+        self.depth      = 0
+        self.replaying  = False
+
+    def attach(self):
+        self.wafer.addListener(self.record)
+
+    def detach(self):
+        self.wafer.removeListener(self.record)
+
+    def record(self, change):
+        if self.replaying:
+            return
+        if self.group is not None:
+            self.group.append(change)
+        else:
+            self.push([change])
+
+    def begin(self):
+        """Start a step that lasts until the matching end(), e.g. across main loop callbacks"""
+        if self.depth == 0:
+            self.group = []
+        self.depth += 1
+
+    def end(self):
+        self.depth -= 1
+        if self.depth == 0:
+            step, self.group = self.group, None
+            if step:
+                self.push(step)
+
+    @contextlib.contextmanager
+    def grouped(self):
+        """Make every edit inside the block one undoable step; groups may nest"""
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end()
+
+    def push(self, step):
+        self.undoSteps.append(step)
+        self.changes += stepSize(step)
+        self.redoSteps = []
+        # Forget the oldest steps, but never the one just made
+        while self.changes > self.maxChanges and len(self.undoSteps) > 1:
+            self.changes -= stepSize(self.undoSteps.popleft())
+        self.changed()
+
+    def changed(self):
+        if self.onChange is not None:
+            self.onChange()
+
+    def canUndo(self):
+        return len(self.undoSteps) > 0
+
+    def canRedo(self):
+        return len(self.redoSteps) > 0
+
+    def undo(self):
+        """Revert the last step and return its changes, or None if there is nothing to undo"""
+        if not self.undoSteps:
+            return None
+        step = self.undoSteps.pop()
+        self.changes -= stepSize(step)
+        self.replay(reversed(step), True)
+        self.redoSteps.append(step)
+        self.changed()
+        return step
+
+    def redo(self):
+        """Repeat the last undone step and return its changes, or None"""
+        if not self.redoSteps:
+            return None
+        step = self.redoSteps.pop()
+        self.replay(step, False)
+        self.undoSteps.append(step)
+        self.changes += stepSize(step)
+        self.changed()
+        return step
+
+    def replay(self, changes, undo):
+        self.replaying = True
+        try:
+            for change in changes:
+                self.wafer.applyChange(change, undo)
+        finally:
+            self.replaying = False
+
+    def clear(self):
+        self.undoSteps.clear()
+        self.redoSteps = []
+        self.changes = 0
+        self.changed()